@@ -12,6 +12,7 @@ import sys
 import os
 import re
 import shutil
+import weakref
 from datetime import datetime
 
 import pyfits as pf
@@ -62,14 +63,92 @@ class VerificationError(Exception):
     pass
 
 
+def _fillColumn(column, values):
+    """ Fill a table column from values, one entry per row (rows are broadcast as needed) """
+    values = np.asarray(values)[:len(column)]
+    if values.ndim < column.ndim:
+        values = values.reshape(values.shape + (1,) * (column.ndim - values.ndim))
+    column[:] = values
+
+
+def _bufferOwner(arr):
+    """ Return the array that owns the memory arr is a view of (following arr.base)
+
+    Returns None unless arr is a writeable, C-contiguous view starting at the beginning
+    of a C-contiguous buffer, so that arr can be written over and the buffer shrunk.
+    """
+    owner = arr
+    while isinstance(owner.base, np.ndarray):
+        owner = owner.base
+    if not (owner.flags.owndata and owner.flags.c_contiguous and
+            arr.flags.c_contiguous and arr.flags.writeable):
+        return None
+    if arr.__array_interface__['data'][0] != owner.__array_interface__['data'][0]:
+        return None
+    return owner
+
+
+class _ArrayInterface(object):
+    """ Object exposing a raw __array_interface__, keeping its base array alive """
+    def __init__(self, interface, base):
+        self.__array_interface__ = interface
+        self.base = base
+
+
+def _complexView(flux):
+    """ View float FLUX rows of (re, im) pairs as complex, without copying
+
+    Strided arrays (e.g. a FLUX column of a memory-mapped FITS table) can be viewed too,
+    as long as the values within each row are contiguous. The byte order is kept.
+    Returns None if flux cannot be viewed as complex.
+    """
+    if not isinstance(flux, np.ndarray) or flux.dtype.kind != 'f' or flux.ndim != 2:
+        return None
+    if flux.shape[1] % 2 or (flux.shape[1] > 1 and flux.strides[1] != flux.itemsize):
+        return None
+    cmplx = np.dtype('c%i' % (2 * flux.itemsize)).newbyteorder(flux.dtype.byteorder)
+    interface = dict(flux.__array_interface__)
+    interface['typestr'] = cmplx.str
+    interface['descr']   = [('', cmplx.str)]
+    interface['shape']   = (flux.shape[0], flux.shape[1] / 2)
+    interface['strides'] = (flux.strides[0], cmplx.itemsize)
+    return np.asarray(_ArrayInterface(interface, flux))
+
+
+# Expected baseline order (lower, upper triangular) for each number of antennas,
+# see InterFits.verify_baseline_order
+_baseline_order_cache = {}
+
+def _baselineOrderTemplates(n_ant):
+    """ Return (lower, upper) triangular baseline ID orders for n_ant antennas """
+    if n_ant not in _baseline_order_cache:
+        bl_lower = coords.generateBaselineIds(n_ant)[0]
+        i, j = np.tril_indices(n_ant)
+        bl_upper = coords.antennasToBaseline(j + 1, i + 1)
+        bl_upper.flags.writeable = False
+        _baseline_order_cache[n_ant] = (bl_lower, bl_upper)
+    return _baseline_order_cache[n_ant]
+
+
 class InterFits(object):
     """ InterFits: UV-data interchange class
     """
 
-    def __init__(self, filename=None, filetype=None, verbose=True):
+    # Target size of the FLUX data in each HDF5 chunk (see exportHdf5)
+    hdf5_chunk_bytes = 2**20
+    # Approximate size of the FLUX data processed per block (average_time_frequency,
+    # verify_flux_finite)
+    average_block_bytes = 64 * 2**20
+
+    def __init__(self, filename=None, filetype=None, verbose=True, lazy=False):
         self.filename = filename
         self.verbose = verbose
 
+        # If lazy, FITS files are memory-mapped and UV_DATA columns are left as views
+        # into the file until an operation needs to modify them (see _loadUvColumns)
+        self.lazy = lazy
+        self._lazy_columns = set()
+
         # Set up some basic details
         self.telescope = ""
         self.instrument = ""
@@ -234,7 +313,7 @@ class InterFits(object):
 
         h1("Opening uvfits data")
 
-        self.fits = pf.open(self.filename)
+        self.fits = pf.open(self.filename, memmap=self.lazy or None)
         #print self.fits
 
         # Set if source / freq tables are present
@@ -333,6 +412,9 @@ class InterFits(object):
         self.h_uv_data['INSTRUME'] = self.instrument
         uv_datacols = ['UU', 'VV', 'WW', 'BASELINE', 'DATE']
         for k in uv_datacols: self.d_uv_data[k] = self.uvdata[k]
+        self._lazy_columns.clear()
+        if self.lazy:
+            self._lazy_columns.update(uv_datacols)
 
         s = self.uvdata['DATA'].shape
         # Find stokes axis type and values
@@ -408,7 +490,7 @@ class InterFits(object):
 
         if from_file:
             h1("Opening FITS-IDI data")
-            self.fits = pf.open(self.filename)
+            self.fits = pf.open(self.filename, memmap=self.lazy or None)
         else:
             pass  # Assumes that self.fits is already populated
 
@@ -540,12 +622,10 @@ class InterFits(object):
             uv_datacols = ['UU', 'VV', 'WW', 'BASELINE', 'DATE', 'FLUX', 'INTTIM', 'FREQID', 'SOURCE']
             for k in uv_datacols:
                 self.d_uv_data[k] = self.tbl_uv_data.data[k]
+            self._lazy_columns.clear()
             self.t_int = self.d_uv_data['INTTIM'][0]
-            self.bls_id = []
-            for bl in self.d_uv_data['BASELINE']:
-                if bl in self.bls_id:
-                    break
-                self.bls_id.append( bl )
+            # Baselines present in the first integration
+            self.bls_id = self.baseline_index.bl_id
 
             try:
                 self.d_uv_data["TIME"] = self.tbl_uv_data.data["TIME"]
@@ -553,7 +633,11 @@ class InterFits(object):
                 print "\tWARNING: TIME column does not exist."
                 raise
 
-            self.d_uv_data["FLUX"] = self.d_uv_data["FLUX"].astype('float32')
+            if self.lazy:
+                # Leave columns as views into the file; FLUX is converted on demand
+                self._lazy_columns.update(uv_datacols + ['TIME'])
+            else:
+                self.d_uv_data["FLUX"] = self.d_uv_data["FLUX"].astype('float32')
 
             # Find stokes axis type and values
             stokes_axid = 0
@@ -601,7 +685,8 @@ class InterFits(object):
 
         Notes
         -----
-        This expects the filename to be any *.json file in a directory of .json files
+        This expects the filename to be any *.json file in a directory of .json files.
+        Large arrays stored in .npy sidecar files are memory-mapped if lazy=True.
         """
 
         if filename:
@@ -649,6 +734,14 @@ class InterFits(object):
             self.h_uv_data = load_json(os.path.join(filepath, 'h_uv_data.json'))
         except IOError:
             print "\tWARNING: Could not load UV_DATA table header"
+        try:
+            h2("Loading UV_DATA")
+            # Large columns are in .npy files; if lazy, these are memory-mapped
+            mmap_mode = 'r' if self.lazy else None
+            self.d_uv_data = load_json(os.path.join(filepath, 'd_uv_data.json'), mmap_mode=mmap_mode)
+            self._lazy_columns = set([k for k in self.d_uv_data if isinstance(self.d_uv_data[k], np.memmap)])
+        except IOError:
+            print "\tWARNING: Could not load UV_DATA table"
         try:
             h2("Loading FLAG")
             self.h_flag = load_json(os.path.join(filepath, 'h_flag.json'))
@@ -678,9 +771,15 @@ class InterFits(object):
 
 
     def readHdf5(self):
-        """ Read data from HDF5 file. """
+        """ Read data from HDF5 file.
+
+        If the object was created with lazy=True, d_uv_data columns are left as h5py
+        datasets, so only the rows that are used (e.g. after extract_integrations or
+        select_baselines) are read from disk. The file is then kept open.
+        """
         h1("Reading HDF5 file %s" % self.filename)
         self.hdf = h5py.File(self.filename, "r")
+        self._lazy_columns.clear()
         try:
             ifds = [self.h_antenna, self.h_source, self.h_array_geometry, self.h_frequency, self.h_uv_data,
                     self.d_antenna, self.d_source, self.d_array_geometry, self.d_frequency, self.d_uv_data,
@@ -717,6 +816,10 @@ class InterFits(object):
                                 #print "STRING"
                                 ifd[key] = str(h5d[key][0])
                                 #print type(ifd[key])
+                        elif ifd_name == "d_uv_data" and self.lazy:
+                            # Keep the dataset; rows are only read when accessed
+                            ifd[key] = h5d[key]
+                            self._lazy_columns.add(key)
                         else:
                             ifd[key] = h5d[key][:]
 
@@ -734,6 +837,9 @@ class InterFits(object):
         self.telescope = self.h_uv_data["TELESCOP"]
         self.instrument = self.h_array_geometry["ARRNAM"]
         self.source = self.d_source["SOURCE"][0]
+        self.n_ant = len(self.d_array_geometry["ANNAME"])
+        if "INTTIM" in self.d_uv_data:
+            self.t_int = self.d_uv_data["INTTIM"][0]
 
     def setXml(self, table, keyword, value):
         """ Find a header parameter and replace it """
@@ -754,15 +860,7 @@ class InterFits(object):
     def setDefaults(self, n_uv_rows):
         """ FIll headers and data with default data """
 
-        zero_vec = np.zeros(n_uv_rows).astype('float32')
-        ones_vec = np.ones(n_uv_rows).astype('float32')
-        self.d_uv_data["DATE"] = zero_vec
-        self.d_uv_data["UU"] = zero_vec
-        self.d_uv_data["VV"] = zero_vec
-        self.d_uv_data["WW"] = zero_vec
-        self.d_uv_data["FREQID"] = ones_vec
-        self.d_uv_data["INTTIM"] = ones_vec
-        self.d_uv_data["SOURCE"] = ones_vec
+        self.setDefaultsUvData(n_uv_rows)
 
         self.stokes_axis = ['XX', 'YY', 'XY', 'YX']
         self.stokes_vals = [-5, -6, -7, -8]
@@ -783,13 +881,26 @@ class InterFits(object):
 
         self.h_uv_data["DATE-OBS"] = '2013-01-01T00:00:00.0'
 
+    def setDefaultsUvData(self, n_uv_rows):
+        """ Fill UV_DATA coordinate and ID columns with default data """
+
+        zero_vec = np.zeros(n_uv_rows).astype('float32')
+        ones_vec = np.ones(n_uv_rows).astype('float32')
+        self.d_uv_data["DATE"] = zero_vec
+        self.d_uv_data["UU"] = zero_vec
+        self.d_uv_data["VV"] = zero_vec
+        self.d_uv_data["WW"] = zero_vec
+        self.d_uv_data["FREQID"] = ones_vec
+        self.d_uv_data["INTTIM"] = ones_vec
+        self.d_uv_data["SOURCE"] = ones_vec
+
     def generateFitsidiXml(self, xmlbase=None, filename_out=None):
         """ Generate XML file that encodes fitsidi structure 
         
         xmlbase: str
             name of basic input xml file
         filename_out: str
-            name of output file
+            name of output file. It is left alone if it already has the same content.
         """
 
         if xmlbase is None:
@@ -836,11 +947,15 @@ class InterFits(object):
         self.setXml("UV_DATA", "CRVAL3", self.h_common['REF_FREQ'])
 
         if filename_out:
+            xml_str = etree.tostring(self.xmlData)
             if os.path.isfile(filename_out):
+                with open(filename_out) as f:
+                    if f.read() == xml_str:
+                        return
                 os.remove(filename_out)
             print "Writing to %s" % filename_out
             with open(filename_out, 'w') as f:
-                f.write(etree.tostring(self.xmlData))
+                f.write(xml_str)
 
     def exportJson(self, dirname_out, dump_uv_data=False, clobber=False):
         """ Export data as a directory of JSON files.
@@ -859,6 +974,7 @@ class InterFits(object):
             if clobber:
                 print 'Removing existing directory %s...' % dirname_out
                 shutil.rmtree(dirname_out)
+                os.mkdir(dirname_out)
             else:
                 raise IOError("Output directory %s already exists" % dirname_out)
                 
@@ -882,19 +998,38 @@ class InterFits(object):
             dump_json(self.h_flag, os.path.join(dirname_out, 'h_flag.json'))
 
         if dump_uv_data:
-            if getattr(self, "_baselineList", None) is not None:
-                sel = self._baselineList
-                dump_json(self.d_uv_data[sel,:], os.path.join(dirname_out, 'd_uv_data.json'))
-            else:
-                dump_json(self.d_uv_data, os.path.join(dirname_out, 'd_uv_data.json'))
+            dump_json(self._selectedUvData(), os.path.join(dirname_out, 'd_uv_data.json'))
 
-    def exportHdf5(self, filename_out, clobber=False):
+    def exportHdf5(self, filename_out, clobber=False, compression=None, shuffle=False):
         """ Export data as HDF5 file
 
+        UV_DATA columns are chunked in whole integrations, so integrations can be read
+        (and decompressed) independently of each other.
+
         filename_out: str
             name of output files into.
         clobber: bool
             Whether or not to overwrite the existing file if it exists
+        compression: str or int
+            Compression filter for UV_DATA columns: 'gzip', 'lzf', or a gzip level
+            (0-9). Default None (no compression).
+        shuffle: bool
+            Apply the HDF5 shuffle filter before compression (improves compression
+            of floating point data).
+        """
+        self._createHdf5(filename_out, clobber=clobber, compression=compression, shuffle=shuffle)
+        self.hdf.close()
+
+    def _createHdf5(self, filename_out, clobber=False, resizable=False, compression=None, shuffle=False):
+        """ Create HDF5 file and write all tables to it (see exportHdf5)
+
+        resizable: bool
+            Create d_uv_data datasets that can be extended along the row axis,
+            so further UV_DATA rows can be added with _appendHdf5UvData.
+        compression, shuffle:
+            UV_DATA filters, see exportHdf5
+
+        Returns the (open) h5py File object.
         """
         h1("Exporting to %s" % filename_out)
         if os.path.exists(filename_out):
@@ -906,15 +1041,9 @@ class InterFits(object):
                 
         self.hdf = h5py.File(filename_out, "w")
         
-        if getattr(self, "_baselineList", None) is not None:
-             sel = self._baselineList
-             ifds = [self.h_antenna, self.h_source, self.h_array_geometry, self.h_frequency, self.h_uv_data,
-                     self.d_antenna, self.d_source, self.d_array_geometry, self.d_frequency, self.d_uv_data[sel,:],
-                     self.h_common, self.h_params]
-        else:
-             ifds = [self.h_antenna, self.h_source, self.h_array_geometry, self.h_frequency, self.h_uv_data,
-                     self.d_antenna, self.d_source, self.d_array_geometry, self.d_frequency, self.d_uv_data,
-                     self.h_common, self.h_params]
+        ifds = [self.h_antenna, self.h_source, self.h_array_geometry, self.h_frequency, self.h_uv_data,
+                self.d_antenna, self.d_source, self.d_array_geometry, self.d_frequency, self.d_uv_data,
+                self.h_common, self.h_params]
                      
         ifd_names = ["h_antenna", "h_source", "h_array_geometry", "h_frequency", "h_uv_data",
                      "d_antenna", "d_source", "d_array_geometry", "d_frequency", "d_uv_data",
@@ -930,16 +1059,109 @@ class InterFits(object):
 
             h2("Creating %s" % ifd_name)
             hgroup = self.hdf.create_group(ifd_name)
+            if ifd_name == "d_uv_data":
+                self._createHdf5UvData(hgroup, resizable=resizable, compression=compression,
+                                       shuffle=shuffle)
+                continue
             for key in ifd:
                 if type(ifd[key]) in (str, int, float, unicode):
                     hgroup.create_dataset(key, data=[ifd[key]])
                 else:
-                    hgroup.create_dataset(key, data=ifd[key])
-        self.hdf.close()
+                    data = ifd[key]
+                    if type(data) is list and len(data) and type(data[0]) is unicode:
+                        # HDF5 has no fixed-width unicode type (e.g. lists loaded from JSON)
+                        data = np.array(data, dtype='S')
+                    hgroup.create_dataset(key, data=data)
+        return self.hdf
+
+    def _createHdf5UvData(self, hgroup, resizable=False, compression=None, shuffle=False):
+        """ Write (selected) UV_DATA rows to HDF5, a chunk of integrations at a time
+
+        Datasets are chunked along the row axis in whole integrations, targeting
+        hdf5_chunk_bytes of FLUX per chunk. Rows are read, selected and written
+        one chunk at a time, so no full copy of the UV_DATA columns is made.
+
+        hgroup: h5py Group
+            d_uv_data group to create datasets in
+        resizable, compression, shuffle:
+            see _createHdf5 and exportHdf5
+        """
+        uvd    = self.d_uv_data
+        mask   = self._selectionMask()
+        n_rows = len(uvd["BASELINE"])
+        n_sel  = n_rows if mask is None else int(mask.sum())
+
+        # Rows per chunk: whole integrations (of selected baselines) where possible
+        bl_index  = self.baseline_index
+        row_bytes = max(1, np.asarray(uvd.get("FLUX", uvd["BASELINE"])[:1]).nbytes)
+        if bl_index.regular and n_sel > 0:
+            n_bls_sel = n_sel / bl_index.n_int
+            n_int_chunk = max(1, self.hdf5_chunk_bytes / (n_bls_sel * row_bytes))
+            rows_in, rows_out = n_int_chunk * bl_index.n_bls, n_int_chunk * n_bls_sel
+        else:
+            rows_in = rows_out = max(1, self.hdf5_chunk_bytes / row_bytes)
+        if not resizable:
+            rows_out = min(rows_out, n_sel)
+
+        keys = []
+        for key in uvd:
+            data = uvd[key]
+            if np.ndim(data) == 0 or len(data) != n_rows:
+                hgroup.create_dataset(key, data=data if np.ndim(data) else [data])
+                continue
+            first = np.asarray(data[:1])
+            maxshape = (None,) + first.shape[1:] if resizable else None
+            chunks = (rows_out,) + first.shape[1:] if rows_out > 0 else None
+            hgroup.create_dataset(key, shape=(n_sel,) + first.shape[1:], dtype=first.dtype,
+                                  maxshape=maxshape, chunks=chunks,
+                                  compression=compression, shuffle=shuffle)
+            keys.append(key)
+
+        i_out = 0
+        for start in xrange(0, n_rows, rows_in):
+            stop = min(start + rows_in, n_rows)
+            sel = None if mask is None else mask[start:stop]
+            for key in keys:
+                data = np.asarray(uvd[key][start:stop])
+                if sel is not None:
+                    data = data[sel]
+                hgroup[key][i_out:i_out + len(data)] = data
+            i_out += stop - start if sel is None else int(sel.sum())
+
+    def _appendHdf5UvData(self, hgroup):
+        """ Append the current (selected) d_uv_data rows to resizable HDF5 datasets
+
+        As in _createHdf5UvData, only the rows chosen with select_baselines are written.
+        Only the per-row datasets (those created resizable) are extended; datasets for
+        scalar and other non-row keys are left as they are.
+
+        hgroup: h5py Group
+            d_uv_data group, as created by _createHdf5(..., resizable=True)
+        """
+        keys = [key for key in hgroup.keys() if hgroup[key].maxshape[:1] == (None,)]
+        if not keys:
+            raise IOError("%s has no resizable datasets (see _createHdf5)" % hgroup.name)
+        missing = [key for key in keys if key not in self.d_uv_data]
+        if missing:
+            raise KeyError("UV_DATA has no %s column(s) to append" % ", ".join(missing))
+
+        mask = self._selectionMask()
+        n_sel = len(self.d_uv_data["BASELINE"]) if mask is None else int(mask.sum())
+        h2("Appending %i rows to %s" % (n_sel, hgroup.name))
+        for key in keys:
+            data = np.asarray(self.d_uv_data[key])
+            if mask is not None:
+                data = data[mask]
+            n_rows = hgroup[key].shape[0]
+            hgroup[key].resize(n_rows + data.shape[0], axis=0)
+            hgroup[key][n_rows:] = data
 
     def exportFitsidi(self, filename_out, config_xml=None, clobber=False):
         """ Export data as FITS IDI 
         
+        UV_DATA rows are streamed to disk in blocks (see pyFitsidi.BinTableWriter),
+        so peak memory does not depend on the number of rows.
+
         filename_out: str
             output filename
         config_xml: str
@@ -949,6 +1171,30 @@ class InterFits(object):
         """
 
         h1("Exporting to FITS-IDI")
+        fitsidi, tbl_flag = self._createFitsidi(filename_out, config_xml=config_xml, clobber=clobber)
+        try:
+            self._appendFitsidiUvData(fitsidi)
+        finally:
+            fitsidi.close()
+
+        if tbl_flag is not None:
+            h2('Appending FLAG')
+            pf.append(filename_out, tbl_flag.data, tbl_flag.header)
+
+    def _createFitsidi(self, filename_out, config_xml=None, clobber=False):
+        """ Write all FITS-IDI tables to file, leaving UV_DATA open for appending rows
+
+        filename_out: str
+            output filename
+        config_xml: str
+            path to config file
+        clobber: bool
+            Whether or not to overwrite the existing file if it exists
+
+        Returns a (BinTableWriter, FLAG table HDU) tuple. UV_DATA rows are added with
+        _appendFitsidiUvData, and the writer must then be closed. The FLAG table (None
+        if there are no flags) needs to be appended after UV_DATA.
+        """
 
         h2('Generating FITS-IDI XML schema')
         if config_xml is None:
@@ -956,7 +1202,7 @@ class InterFits(object):
             config_xml = os.path.join(dirname, 'config/config.xml')
         xmlfile = filename_out.replace(".fitsidi", "").replace(".fits", "") + ".xml"
         self.generateFitsidiXml(config_xml, xmlfile)
-        config_xml = xmlfile
+        config_xml = self.xmlData # Parsed once per config, see pyFitsidi.parseConfig
 
         h2('Creating Primary HDU')
         hdu_primary = make_primary(config=config_xml)
@@ -992,42 +1238,12 @@ class InterFits(object):
             tbl_calibration = None
 
         h2('Creating UV_DATA')
-        uvd = self.d_uv_data
-        if type(uvd['BASELINE']) is list:
-            uvd['BASELINE'] = np.array(uvd['BASELINE'])
-
-        try:
-            jtime = uvd['TIME']
-        except KeyError:
-            print "\tWARNING: TIME column does not exist."
-            jtime = None
-
-
-        # TODO: Fix time and date to Julian date
-        if getattr(self, "_baselineList", None) is not None:
-            sel = self._baselineList
-            num_rows = self.d_uv_data['FLUX'][sel,:].shape[0]
-            tbl_uv_data = make_uv_data(config=config_xml, num_rows=num_rows,
-                                      uu_data=uvd['UU'][sel], vv_data=uvd['VV'][sel], ww_data=uvd['WW'][sel],
-                                      date_data=uvd['DATE'][sel], time_data=jtime[sel],
-                                      baseline_data=uvd['BASELINE'][sel].astype('int32'),
-                                      source_data=uvd['SOURCE'][sel].astype('int32'), freqid_data=uvd['FREQID'][sel].astype('int32'),
-                                      inttim_data=uvd['INTTIM'][sel],
-                                      weights_data=None, flux_data=uvd['FLUX'][sel,:], weights_col=False)
-        else:
-            num_rows = self.d_uv_data['FLUX'].shape[0]
-            tbl_uv_data = make_uv_data(config=config_xml, num_rows=num_rows,
-                                   uu_data=uvd['UU'], vv_data=uvd['VV'], ww_data=uvd['WW'],
-                                   date_data=uvd['DATE'], time_data=jtime,
-                                   baseline_data=uvd['BASELINE'].astype('int32'),
-                                   source_data=uvd['SOURCE'].astype('int32'), freqid_data=uvd['FREQID'].astype('int32'),
-                                   inttim_data=uvd['INTTIM'],
-                                   weights_data=None, flux_data=uvd['FLUX'], weights_col=False)
-
+        # Only the header is used: rows are streamed to file by _appendFitsidiUvData
+        tbl_uv_data = make_uv_data(config=config_xml, num_rows=1, weights_col=False)
         if self.verbose: print tbl_uv_data.header.ascardlist()
 
+        n_rows_flag = 0
         if self.write_flags:
-            n_rows_flag = 0
             if self.d_flag.get("SOURCE_ID"):
                 n_rows_flag = len(self.d_flag["SOURCE_ID"])
             if n_rows_flag > 0:
@@ -1036,24 +1252,23 @@ class InterFits(object):
                 if self.verbose: print tbl_flag.header.ascardlist()
 
         h2('Filling in data')
+        # Columns are filled whole: element-wise access to pyfits tables is slow
         h3("ARRAY_GEOMETRY")
-        for i in range(self.n_ant):
-            for k in ['ANNAME', 'STABXYZ', 'NOSTA', 'MNTSTA', 'STAXOF']:
-                tbl_array_geometry.data[k][i] = self.d_array_geometry[k][i]
+        for k in ['ANNAME', 'STABXYZ', 'NOSTA', 'MNTSTA', 'STAXOF']:
+            _fillColumn(tbl_array_geometry.data[k], self.d_array_geometry[k])
 
         h3("ANTENNA")
-        for i in range(self.n_ant):
-            # TODO: 'POLCALB' and POLCALA               
-            for k in ['POLTYA', 'POLAA', 'POLTYB', 'POLAB']:
-                try:
-                    tbl_antenna.data['ANNAME'][i] = self.d_array_geometry['ANNAME'][i]
-                    tbl_antenna.data['ANTENNA_NO'][i] = i + 1
-                    tbl_antenna.data['ARRAY'][i] = 1
-                    tbl_antenna.data['FREQID'][i] = 1
-                    tbl_antenna.data['NO_LEVELS'][i] = 255
-                    tbl_antenna.data[k][i] = self.d_antenna[k][i]
-                except:
-                    print "\tWARNING: keyword error: %s" % k
+        _fillColumn(tbl_antenna.data['ANNAME'], self.d_array_geometry['ANNAME'])
+        tbl_antenna.data['ANTENNA_NO'][:] = np.arange(1, self.n_ant + 1)
+        tbl_antenna.data['ARRAY'][:] = 1
+        tbl_antenna.data['FREQID'][:] = 1
+        tbl_antenna.data['NO_LEVELS'][:] = 255
+        # TODO: 'POLCALB' and POLCALA
+        for k in ['POLTYA', 'POLAA', 'POLTYB', 'POLAB']:
+            try:
+                _fillColumn(tbl_antenna.data[k], self.d_antenna[k])
+            except:
+                print "\tWARNING: keyword error: %s" % k
 
         h3("FREQUENCY")
         tbl_frequency.data["FREQID"][0] = 1
@@ -1085,30 +1300,16 @@ class InterFits(object):
         if tbl_calibration is not None:
             h3("CALIBRATION")
             h3("(Pre-filled)")
-            
-        h3("UV_DATA")
-        h3("(Pre-filled)")
-        # NOTE: This is now superfluous, thanks to the make_uv_data call above
-        #for i in range(self.d_uv_data['DATA'].shape[0]):
-        #    LinePrint("Row %i of %i"%(i+1, self.d_uv_data['DATA'].shape[0]))
-        #    for k in ['UU','VV','WW','BASELINE','DATE']:
-        #        try:
-        #            tbl_uv_data.data[k][i] = self.d_uv_data[k][i]
-        #            #tbl_uv_data.data['FLUX'][i] = self.d_uv_data['FLUX'][i]
-        #        except:
-        #            raise
 
-        if self.write_flags:
-            if n_rows_flag > 0:
-                h3("FLAG")
-                for i in range(n_rows_flag):
-                    flag_keywords = ['SOURCE_ID', 'ARRAY', 'ANTS', 'FREQID', 'BANDS', 'CHANS', 'PFLAGS', 'REASON',
-                                     'SEVERITY']
-                    for k in flag_keywords:
-                        try:
-                            tbl_flag.data[k][i] = self.d_flag[k][i]
-                        except:
-                            print "\tWARNING: keyword error: %s" % k
+        if n_rows_flag > 0:
+            h3("FLAG")
+            flag_keywords = ['SOURCE_ID', 'ARRAY', 'ANTS', 'FREQID', 'BANDS', 'CHANS', 'PFLAGS', 'REASON',
+                             'SEVERITY']
+            for k in flag_keywords:
+                try:
+                    _fillColumn(tbl_flag.data[k], self.d_flag[k])
+                except:
+                    print "\tWARNING: keyword error: %s" % k
 
         # Add history and comments to header
         hdu_primary.header.add_comment("FITS-IDI: FITS Interferometry Data Interchange Convention")
@@ -1121,19 +1322,16 @@ class InterFits(object):
                 tbl_array_geometry,
                 tbl_frequency,
                 tbl_antenna,
-                tbl_source,
-                tbl_uv_data
+                tbl_source
                ]
         if tbl_calibration is not None:
-            hdus.insert(5, tbl_calibration)
-            
-        if self.write_flags and n_rows_flag > 0:
-            hdus.append(tbl_flag)
+            hdus.append(tbl_calibration)
         hdulist = pf.HDUList(hdus)
         if self.verbose: print hdulist.info()
 
         if self.verbose: print '\nVerifying integrity...'
         hdulist.verify()
+        tbl_uv_data.verify()
 
         print 'Writing to file %s...' % filename_out
         if os.path.isfile(filename_out):
@@ -1144,50 +1342,70 @@ class InterFits(object):
                 raise IOError("Output file %s already exists" % filename_out)
         hdulist.writeto(filename_out, clobber=clobber)
 
+        fitsidi = BinTableWriter(open(filename_out, 'r+b'), tbl_uv_data)
+        if n_rows_flag == 0:
+            tbl_flag = None
+        return fitsidi, tbl_flag
+
+    def _appendFitsidiUvData(self, fitsidi):
+        """ Append (selected) UV_DATA rows to a FITS-IDI file from _createFitsidi
+
+        Rows are read, selected and written a block at a time, so no full copy of
+        the UV_DATA columns is made.
+
+        fitsidi: BinTableWriter
+            UV_DATA table writer
+        """
+        h2("Writing UV_DATA")
+        if 'TIME' not in self.d_uv_data:
+            print "\tWARNING: TIME column does not exist."
+
+        uv_datacols = ['UU', 'VV', 'WW', 'DATE', 'TIME', 'BASELINE', 'SOURCE', 'FREQID', 'INTTIM', 'FLUX']
+        uv_datacols = [k for k in uv_datacols if k in self.d_uv_data]
+        mask = self._selectionMask()
+
+        n_rows = len(self.d_uv_data['FLUX'])
+        for start in xrange(0, n_rows, fitsidi.chunk_rows):
+            stop = min(start + fitsidi.chunk_rows, n_rows)
+            uvd = {}
+            for k in uv_datacols:
+                uvd[k] = np.asarray(self.d_uv_data[k][start:stop])
+                if mask is not None:
+                    uvd[k] = uvd[k][mask[start:stop]]
+            fitsidi.write(uvd)
+
     def verify_baseline_order(self):
-        """ Check baseline IDs are in order """
+        """ Check baseline IDs are in order
+
+        Every dump must have its baselines in either lower triangular (1-1, 1-2, ...,
+        2-2, 2-3, ...) or upper triangular (1-1, 1-2, 2-2, 1-3, 2-3, ...) order.
+        """
 
         if self.verbose: print "Verification: Checking uv_data baseline order..."
 
-        bls = [int(b) for b in self.d_uv_data['BASELINE']]
-
-        # Generate lower an upper triangular matrices
-        bl_lower, bl_upper = [], []
-        for i in range(1, self.n_ant + 1):
-            for j in range(1, self.n_ant + 1):
-                if j >= i:
-                    if j >= 256:
-                        bl_lower.append(2048 * i + j + 65536)
-                    else:
-                        bl_lower.append(256 * i + j)
-                elif j <= i:
-                    if j >= 256:
-                        bl_upper.append(2048 * j + i + 65536)
-                    else:
-                        bl_upper.append(256 * j + i)
-
-        # Check every baseline is right, over all dumps
-        n_bls = self.n_ant * (self.n_ant - 1) / 2 + self.n_ant
-        n_dumps = len(bls) / n_bls
+        bls = np.asarray(self.d_uv_data['BASELINE']).astype('int64')
+        bl_lower, bl_upper = _baselineOrderTemplates(self.n_ant)
 
-        lower_t, upper_t = False, False
-        for i in range(n_dumps):
-            if bls[i * n_bls:(i + 1) * n_bls] == bl_lower:
-                #print "LOWER"
-                upper_t = False
-                lower_t = True
-            if bls[i * n_bls:(i + 1) * n_bls] == bl_upper:
-                #print "UPPER"
-                lower_t = False
-                upper_t = True
-
-            if not lower_t and not upper_t:
-                raise VerificationError("Baseline order neither upper or lower triangular.")
-
-        if lower_t:
+        # Check every baseline is right, over all dumps at once
+        n_bls = len(bl_lower)
+        n_dumps = len(bls) / n_bls
+        if n_dumps == 0 or len(bls) != n_dumps * n_bls:
+            raise VerificationError("Number of UV_DATA rows is not a multiple of the number of baselines.")
+
+        bls = bls.reshape(n_dumps, n_bls)
+        lower_t = np.all(bls == bl_lower, axis=1)
+        upper_t = np.all(bls == bl_upper, axis=1)
+        bad = ~(lower_t | upper_t)
+        if bad.any():
+            raise VerificationError("Baseline order neither upper or lower triangular (dump %i)."
+                                    % np.flatnonzero(bad)[0])
+
+        if lower_t.all():
             print "Verification: OK. Baselines in lower triangular order."
-        if upper_t:
+        elif upper_t.all():
             print "Verification: OK. Baselines in upper triangular order."
+        else:
+            print "Verification: OK. Baselines in lower or upper triangular order."
 
         return True
 
@@ -1195,15 +1413,15 @@ class InterFits(object):
         """ Basic diagnostics on UV_DATA table """
         if self.verbose: print "Verification: checking UV_DATA for null entries"
 
-        freq_ids   = self.d_uv_data["FREQID"]
-        source_ids = self.d_uv_data["SOURCE"]
-        baselines  = self.d_uv_data["BASELINE"]
+        freq_ids   = np.asarray(self.d_uv_data["FREQID"])
+        source_ids = np.asarray(self.d_uv_data["SOURCE"])
+        baselines  = np.asarray(self.d_uv_data["BASELINE"])
 
-        if 0 in freq_ids:
+        if not freq_ids.all():
             raise VerificationError("FREQID in UV_DATA references non-existent FREQ with ID 0")
-        if 0 in source_ids:
+        if not source_ids.all():
             raise VerificationError("SOURCE in UV_DATA references non-existent SOURCE with ID 0")
-        if 0 in baselines:
+        if not baselines.all():
             raise VerificationError("BASELINE in UV_DATA references non-existent BASELINE with ID 0")
 
         print "Verification: OK. UV_DATA does not contain null (zero) entries in required fields"
@@ -1217,8 +1435,55 @@ class InterFits(object):
         except ValueError:
             raise VerificationError("Frequency values are fubarred")
 
-    def verify(self):
-        """ Run a series of diagnostics to test data validity """
+    def verify_time(self):
+        """ Check that UV_DATA timestamps (DATE + TIME) never decrease """
+        if self.verbose: print "Verification: checking UV_DATA timestamps are monotonic"
+
+        t = np.asarray(self.d_uv_data["DATE"], dtype='float64') + np.asarray(self.d_uv_data["TIME"])
+        backwards = np.diff(t) < 0
+        if backwards.any():
+            raise VerificationError("TIME in UV_DATA goes backwards (row %i)." % (np.flatnonzero(backwards)[0] + 1))
+
+        print "Verification: OK. UV_DATA timestamps are monotonic."
+        return True
+
+    def verify_inttim(self):
+        """ Check that the integration time (INTTIM) is the same for all rows """
+        if self.verbose: print "Verification: checking UV_DATA integration time is constant"
+
+        inttim = np.asarray(self.d_uv_data["INTTIM"])
+        if np.any(inttim != inttim[0]):
+            raise VerificationError("INTTIM in UV_DATA is not constant.")
+
+        print "Verification: OK. UV_DATA integration time is constant."
+        return True
+
+    def verify_flux_finite(self):
+        """ Check that FLUX contains no NaN or infinite values
+
+        FLUX is checked in blocks of rows, so no full-size temporary is created.
+        """
+        if self.verbose: print "Verification: checking UV_DATA FLUX values are finite"
+
+        flux = self.d_uv_data["FLUX"]
+        n_rows = len(flux)
+        block = max(1, self.average_block_bytes / max(1, np.asarray(flux[:1]).nbytes))
+        for start in xrange(0, n_rows, block):
+            finite = np.isfinite(flux[start:start + block]).all(axis=1)
+            if not finite.all():
+                raise VerificationError("FLUX in UV_DATA is not finite (row %i)."
+                                        % (start + np.flatnonzero(~finite)[0]))
+
+        print "Verification: OK. UV_DATA FLUX values are finite."
+        return True
+
+    def verify(self, check_time=False, check_inttim=False, check_finite=False):
+        """ Run a series of diagnostics to test data validity
+
+        check_time (bool): also check that timestamps are monotonic (verify_time)
+        check_inttim (bool): also check that INTTIM is constant (verify_inttim)
+        check_finite (bool): also check that FLUX is finite (verify_flux_finite)
+        """
         h1("Data verification")
         self.verify_uv_table()
         try:
@@ -1226,31 +1491,57 @@ class InterFits(object):
         except AttributeError:
             self.verify_baseline_order()
         self.verify_frequency_axis()
+        if check_time:
+            self.verify_time()
+        if check_inttim:
+            self.verify_inttim()
+        if check_finite:
+            self.verify_flux_finite()
 
     def formatStokes(self):
-        """ Return data as complex stokes vector """
-        data = self.d_uv_data["FLUX"]
-
-        #xx_data = data[:, 0::8] + 1j * data[:, 1::8]
-        #yy_data = data[:, 2::8] + 1j * data[:, 3::8]
-        #xy_data = data[:, 4::8] + 1j * data[:, 5::8]
-        #yx_data = data[:, 6::8] + 1j * data[:, 7::8]
-
-        if self.d_uv_data["FLUX"].dtype == 'float32':
-            data = data.view('complex64')
-        elif self.d_uv_data["FLUX"].dtype == 'float64':
-            data = data.view('complex128')
+        """ Return data as complex stokes vector
 
+        This returns a copy (except for a single stokes parameter); see stokes for a
+        view into FLUX.
+        """
         if self.h_params["NSTOKES"] == 1:
-            return data
-        elif self.h_params["NSTOKES"] == 2:
-            return  np.array((data[:, ::2], data[:, 1::2]))
-        elif self.h_params["NSTOKES"] == 4:
-            data2 = np.array((data[:, ::4], data[:, 1::4], data[:, 2::4], data[:, 3::4]))
-            return data2
-        else:
+            return self.stokes[0]
+        return np.array(self.stokes)
+
+    @property
+    def stokes(self):
+        """ Complex visibilities, as an array of shape (n_stokes, n_rows, n_chan)
+
+        stokes[i] is a strided view of FLUX for the i-th polarisation product (e.g. XX,
+        YY, XY, YX), so no data are copied. This includes FLUX read lazily from FITS.
+        The view is cached through weak references only, so the cache never keeps a
+        replaced FLUX buffer alive. FLUX that cannot be viewed (e.g. read lazily from
+        HDF5) is copied, and the copy is not cached.
+        """
+        flux  = self.d_uv_data["FLUX"]
+        n_stk = self.h_params["NSTOKES"]
+        cache = getattr(self, '_stokes_cache', None)
+        if cache is not None and cache[0]() is flux and cache[1] == n_stk:
+            data = cache[2]()
+            if data is not None:
+                return data
+
+        if n_stk not in (1, 2, 4):
             raise ValueError("NSTOKES in h_params is not valid!")
 
+        if isinstance(flux, np.ndarray) and flux.dtype.kind == 'c':
+            data = flux
+        else:
+            data = _complexView(flux)
+        is_view = data is not None
+        if not is_view:
+            data = _complexView(np.ascontiguousarray(flux))
+        data = data.reshape(data.shape[0], -1, n_stk).transpose(2, 0, 1)
+
+        if is_view:
+            self._stokes_cache = (weakref.ref(flux), n_stk, weakref.ref(data))
+        return data
+
     def formatFreqs(self):
         """ Convert FITS keywords to frequency array """
         ref_delt = self.h_common["CHAN_BW"]
@@ -1269,27 +1560,82 @@ class InterFits(object):
         return freqs
 
 
+    def _loadUvColumns(self, keys=None):
+        """ Load lazily read UV_DATA columns into memory.
+
+        Columns read with lazy=True are views into the (memory-mapped) file, in the
+        file's byte order. This copies them into native-endian arrays (float32 for
+        FLUX), which is needed before any operation that modifies them in place.
+
+        keys (list): columns to load. Defaults to all lazily read columns.
+        """
+        if keys is None:
+            keys = list(self._lazy_columns)
+        for k in keys:
+            if k not in self._lazy_columns:
+                continue
+            if k == 'FLUX':
+                self.d_uv_data[k] = np.array(self.d_uv_data[k], dtype='float32')
+            else:
+                col = np.asarray(self.d_uv_data[k])
+                self.d_uv_data[k] = np.array(col, dtype=col.dtype.newbyteorder('='))
+            self._lazy_columns.discard(k)
+
+    @property
+    def baseline_index(self):
+        """ Baseline index (coords.BaselineIndex) of the UV_DATA table.
+
+        The index is built on first use, and rebuilt whenever the BASELINE column is
+        replaced. Use it to find rows for an antenna or baseline, e.g.
+            rows = self.baseline_index.antenna_rows(ref_ant)
+        """
+        bls = self.d_uv_data["BASELINE"]
+        index = getattr(self, '_baseline_index', None)
+        if index is None or index.baselines is not bls:
+            index = coords.BaselineIndex(bls)
+            self._baseline_index = index
+        return index
+
+    def _baselineLayout(self, autocorrs=True):
+        """ Baseline IDs and antenna pairs of a single integration.
+
+        Baselines are in coords.generateBaselineIds order. If the UV data has been
+        loaded from file (i.e. bls_id is set), only baselines present in the file are
+        included. Results are cached until n_ant or bls_id change.
+
+        autocorrs (bool): include autocorrelations
+
+        returns (bls, ant_arr, good): baseline IDs, antenna pairs with shape (n_bls, 2),
+        and a boolean mask of the baselines kept out of all generated baselines.
+        """
+        bls_id = getattr(self, 'bls_id', None)
+        cache  = self.__dict__.setdefault('_baseline_layouts', {})
+        key    = (self.n_ant, autocorrs)
+        if key in cache and cache[key][0] is bls_id:
+            return cache[key][1]
+
+        bls, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=autocorrs)
+        bls, ant_arr = np.array(bls), np.array(ant_arr).reshape(-1, 2)
+        if bls_id is not None:
+            good = np.in1d(bls, bls_id)
+        else:
+            good = np.ones(len(bls), dtype=bool)
+        layout = (bls[good], ant_arr[good], good)
+        cache[key] = (bls_id, layout)
+        return layout
+
     def get_antenna_id(self, bl_id):
         """ Convert baseline ID into an antenna pair.
 
         Uses MIRIAD convention for antennas > 256
-        Returns a tuple of antenna IDs.
+        Returns a tuple of antenna IDs. If an array of baseline IDs is passed,
+        returns a tuple of arrays.
         """
-        if bl_id > 65536:
-            ant1 = (bl_id - 65536) / 2048
-            ant2 = (bl_id - 65536) % 2048
-        else:
-            ant1 = bl_id / 256
-            ant2 = bl_id % 256
-        return ant1, ant2
+        return coords.baselineToAntennas(bl_id)
 
     def get_baseline_id(self, ant1, ant2):
-        """ Convert antenna pair into baseline ID """
-        if ant1 > 255 or ant2 > 255:
-            bl_id = ant1 * 2048 + ant2 + 65536
-        else:
-            bl_id = ant1 * 256 + ant2
-        return bl_id
+        """ Convert antenna pair into baseline ID (works on arrays of IDs too) """
+        return coords.antennasToBaseline(ant1, ant2)
 
     def search_baselines(self, ref_ant, autocorrs=True):
         """ Retrieve baseline ids that contain a given antenna
@@ -1306,21 +1652,10 @@ class InterFits(object):
         except AssertionError:
             raise RuntimeError("Ref ant is larger than number of antennas: %i > %i"%(ref_ant, self.n_ant))
 
-        bls, ant_arr = [], []
-        for ii in range(1, self.n_ant + 1):
-            for jj in range(1, self.n_ant + 1):
-                if jj >= ii:
-                    if autocorrs is False and ii == jj:
-                        pass
-                    else:
-                        ant_arr.append((ii, jj))
-                        if ii > 255 or jj > 255:
-                            bl_id = ii * 2048 + jj + 65536
-                        else:
-                            bl_id = 256 * ii + jj
-                        if ii == ref_ant or jj == ref_ant:
-                            bls.append(bl_id)
-        return bls
+        ant1, ant2 = np.triu_indices(self.n_ant, 0 if autocorrs else 1)
+        ant1, ant2 = ant1 + 1, ant2 + 1
+        match = (ant1 == ref_ant) | (ant2 == ref_ant)
+        return coords.antennasToBaseline(ant1[match], ant2[match]).tolist()
 
 
     def extract_integrations(self, start=None, stop=None):
@@ -1369,24 +1704,18 @@ class InterFits(object):
         if timestamps arg is set to True, returns (timestamps, data)
         """
 
-        bls   = self.d_uv_data["BASELINE"]
         bl_id = antenna_id * 256 + antenna_id
+        rows  = self.baseline_index.rows(bl_id)
 
-        try:
-            stokes = self.stokes
-        except AttributeError:
-            self.stokes = self.formatStokes()
-            stokes = self.stokes
-
-        data = stokes[:, bls == bl_id]
+        data = self.stokes[:, rows]
         if timestamps is False:
             return data
         else:
-            ts = self.d_uv_data["TIME"]
-            ts = ts[bls == bl_id]
+            ts = np.asarray(self.d_uv_data["TIME"])[rows]
             return ts, data
 
-    def average_time_frequency(self, temporalDecimation=1, spectralDecimation=1, mode='exact'):
+    def average_time_frequency(self, temporalDecimation=1, spectralDecimation=1, mode='exact',
+                               weights=None, in_place=False, block_size=None):
         """Average down a dataset in time and/or frequency using the specified 
         temporal and spectral decimation factors.  This modifies the in-memory
         UV_DATA and adjusts the various header keywords as needed.
@@ -1399,6 +1728,19 @@ class InterFits(object):
           * nearset - data sets that are not an integer multiple of the deci-
                       mation factors are resized to the nearest multiple and
                       then averaged
+        
+        Data are averaged in time and summed in frequency, block_size output 
+        integrations at a time (by default, enough to read about
+        average_block_bytes of FLUX per block).  The other keywords are:
+          * weights - per-row weights (or flags, with False for flagged rows) 
+                      used for a weighted time average of FLUX.  Output 
+                      visibilities with zero total weight are set to zero.
+          * in_place - write the averaged FLUX over the input FLUX buffer, 
+                       which is then shrunk, rather than allocating a new 
+                       array.  FLUX may be a view (e.g. after phasing), in 
+                       which case the buffer it views is used.  Falls back 
+                       to a new array if FLUX is not a contiguous view of 
+                       the start of that buffer.
                       
         .. note::
            If the data dimensions are not an integer multiple of the specified temporal 
@@ -1407,37 +1749,16 @@ class InterFits(object):
         # Validate the operating mode
         if mode.lower() not in ('exact', 'nearest'):
             raise ValueError("Unknown averaging mode '%s'" % mode)
+        self._loadUvColumns()
             
         # Generate frequency array from metadata
         freqs = self.formatFreqs()
         nFreq = freqs.size
         
         # Get the baseline information
-        bls, ant_arr = coords.generateBaselineIds(self.n_ant)
-        try:
-            good = []
-            for i,id in enumerate(bls):
-                if id in self.bls_id:
-                    good.append( i )
-            bls = [bls[i] for i in good]
-            ant_arr = [ant_arr[i] for i in good]
-        except AttributeError:
-            pass
+        bls, ant_arr, good = self._baselineLayout()
         nBL = len(bls)
-        bls = self.d_uv_data["BASELINE"]
-        
-        # Get the coordinates (of various kinds)
-        uu = self.d_uv_data["UU"]
-        vv = self.d_uv_data["VV"]
-        ww = self.d_uv_data["WW"]
-        source = self.d_uv_data["SOURCE"]
-        freqid = self.d_uv_data["FREQID"]
-        nInt = uu.size/nBL
-        
-        # Get the temporal information
-        dObs = self.d_uv_data["DATE"]
-        tObs = self.d_uv_data["TIME"]
-        tInt = self.d_uv_data["INTTIM"]
+        nInt = len(self.d_uv_data["UU"])/nBL
         
         # Load in the data
         try:
@@ -1449,6 +1770,11 @@ class InterFits(object):
         nCmp = 2
         nStk = flux.shape[1] / nFreq / nCmp
         
+        if weights is not None:
+            weights = np.asarray(weights, dtype='float32')
+            if weights.shape != (flux.shape[0],):
+                raise ValueError("Expected one weight per UV_DATA row, got shape %s" % str(weights.shape))
+        
         # Validate what we are about to do
         tKeep = (nInt / temporalDecimation) * temporalDecimation
         fKeep = (nFreq / spectralDecimation) * spectralDecimation
@@ -1469,85 +1795,73 @@ class InterFits(object):
                 print "\tWARNING: The number of integrations is not an integer multiple of the decimation amount"
             if nFreq % spectralDecimation != 0:
                 print "\tWARNING: The number of channels is not an integer multiple of the decimation amount"
-                
-        # Re-order and prepare for averaging
-        uu.shape     = (nInt, nBL)
-        vv.shape     = (nInt, nBL)
-        ww.shape     = (nInt, nBL)
-        bls.shape    = (nInt, nBL)
-        source.shape = (nInt, nBL)
-        freqid.shape = (nInt, nBL)
-        dObs.shape   = (nInt, nBL)
-        tObs.shape   = (nInt, nBL)
-        tInt.shape   = (nInt, nBL)
-        flux.shape   = (nInt, nBL, nFreq, nStk, nCmp)
-        
-        # Temporal averaging - setup
-        if nInt % temporalDecimation != 0:
-            ## Some trimming is needed
-            uu     = uu[:tKeep, :]
-            vv     = vv[:tKeep, :]
-            ww     = ww[:tKeep, :]
-            bls    = bls[:tKeep, :]
-            source = source[:tKeep, :]
-            freqid = freqid[:tKeep, :]
-            dObs   = dObs[:tKeep, :]
-            tObs   = tObs[:tKeep, :]
-            tInt   = tInt[:tKeep, :]
-            flux   = flux[:tKeep, :, :, :, :]
-        uu.shape     = (nInt/temporalDecimation, temporalDecimation, nBL)
-        vv.shape     = (nInt/temporalDecimation, temporalDecimation, nBL)
-        ww.shape     = (nInt/temporalDecimation, temporalDecimation, nBL)
-        bls.shape    = (nInt/temporalDecimation, temporalDecimation, nBL)
-        source.shape = (nInt/temporalDecimation, temporalDecimation, nBL)
-        freqid.shape = (nInt/temporalDecimation, temporalDecimation, nBL)
-        dObs.shape   = (nInt/temporalDecimation, temporalDecimation, nBL)
-        tObs.shape   = (nInt/temporalDecimation, temporalDecimation, nBL)
-        tInt.shape   = (nInt/temporalDecimation, temporalDecimation, nBL)
-        flux.shape   = (nInt/temporalDecimation, temporalDecimation, nBL, nFreq, nStk, nCmp)
         
-        # Temporal averaging
-        uu = uu.mean(axis=1)
-        vv = vv.mean(axis=1)
-        ww = ww.mean(axis=1)
-        bls = bls[:,0,:]			# First one
-        source = source[:,0,:]	# First one
-        freqid = freqid[:,0,:]	# First one
-        dObs = dObs[:,0,:]		# First one
-        tObs = tObs[:,0,:]		# First one
-        tInt = tInt.sum(axis=1)	# Sum
-        flux = flux.mean(axis=1)
+        nOut     = nInt / temporalDecimation
+        nFreqOut = nFreq / spectralDecimation
+        nColOut  = nFreqOut*nStk*nCmp
+        if block_size is None:
+            block_size = max(1, self.average_block_bytes / (temporalDecimation*nBL*flux.strides[0]))
         
-        # Spectral averaging - setup
-        if nFreq % spectralDecimation != 0:
-            ## Some trimming is needed
-            flux = flux[:, :, :fKeep, :, :]
-        flux.shape = (nInt/temporalDecimation, nBL, nFreq/spectralDecimation, spectralDecimation, nStk, nCmp)
-        flux = flux.sum(axis=3)
+        # Output arrays; with in_place, FLUX is written over the start of the buffer holding it
+        owner = _bufferOwner(flux) if in_place else None
+        in_place = owner is not None
+        uvd_out = {}
+        for k in ("UU", "VV", "WW", "BASELINE", "SOURCE", "FREQID", "DATE", "TIME", "INTTIM"):
+            uvd_out[k] = np.empty(nOut*nBL, dtype=np.asarray(self.d_uv_data[k][:1]).dtype)
+        if in_place:
+            flux_flat = flux.reshape(-1)
+        else:
+            flux_out = np.empty((nOut*nBL, nColOut), dtype='float32')
         
-        # Final reshape
-        uu.shape   = (nInt/temporalDecimation*nBL,)
-        vv.shape   = (nInt/temporalDecimation*nBL,)
-        ww.shape   = (nInt/temporalDecimation*nBL,)
-        bls        = np.reshape(bls, (nInt/temporalDecimation*nBL,))
-        source     = np.reshape(source, (nInt/temporalDecimation*nBL,))
-        freqid     = np.reshape(freqid, (nInt/temporalDecimation*nBL,))
-        dObs       = np.reshape(dObs, (nInt/temporalDecimation*nBL,))
-        tObs       = np.reshape(tObs, (nInt/temporalDecimation*nBL,))
-        tInt       = np.reshape(tInt, (nInt/temporalDecimation*nBL,))
-        flux.shape = (nInt/temporalDecimation*nBL, nFreq/spectralDecimation*nStk*nCmp)
+        for i0 in xrange(0, nOut, block_size):
+            i1 = min(i0 + block_size, nOut)
+            rows_in  = slice(i0*temporalDecimation*nBL, i1*temporalDecimation*nBL)
+            rows_out = slice(i0*nBL, i1*nBL)
+            shape = (i1 - i0, temporalDecimation, nBL)
+            
+            # Temporal averaging
+            for k in ("UU", "VV", "WW"):
+                uvd_out[k][rows_out] = np.reshape(self.d_uv_data[k][rows_in], shape).mean(axis=1).ravel()
+            for k in ("BASELINE", "SOURCE", "FREQID", "DATE", "TIME"):
+                uvd_out[k][rows_out] = np.reshape(self.d_uv_data[k][rows_in], shape)[:,0,:].ravel()	# First one
+            uvd_out["INTTIM"][rows_out] = np.reshape(self.d_uv_data["INTTIM"][rows_in], shape).sum(axis=1).ravel()	# Sum
+            
+            blk = np.reshape(flux[rows_in], shape + (nFreq, nStk, nCmp))
+            if weights is None:
+                blk = blk.mean(axis=1)
+            else:
+                w = np.reshape(weights[rows_in], shape)
+                w_sum = w.sum(axis=1)
+                blk = (blk * w[..., np.newaxis, np.newaxis, np.newaxis]).sum(axis=1)
+                blk /= np.where(w_sum > 0, w_sum, 1)[..., np.newaxis, np.newaxis, np.newaxis]
+                blk[w_sum == 0] = 0
+            
+            # Spectral averaging (trimming if needed)
+            blk = blk[:, :, :fKeep, :, :]
+            blk = blk.reshape((i1 - i0, nBL, nFreqOut, spectralDecimation, nStk, nCmp)).sum(axis=3)
+            
+            if in_place:
+                # The input rows for this block have been read, so this is safe to overwrite
+                flux_flat[rows_out.start*nColOut:rows_out.stop*nColOut] = blk.ravel()
+            else:
+                flux_out[rows_out] = blk.reshape((i1 - i0)*nBL, nColOut)
         
         # Data update
-        self.d_uv_data["UU"] = uu
-        self.d_uv_data["VV"] = vv
-        self.d_uv_data["WW"] = ww
-        self.d_uv_data["BASELINE"] = bls
-        self.d_uv_data["SOURCE"] = source
-        self.d_uv_data["FREQID"] = freqid
-        self.d_uv_data["DATE"] = dObs
-        self.d_uv_data["TIME"] = tObs
-        self.d_uv_data["INTTIM"] = tInt
-        self.d_uv_data["FLUX"] = flux
+        for k in uvd_out:
+            self.d_uv_data[k] = uvd_out[k]
+        if in_place:
+            nBytes = nOut*nBL*nColOut*flux.itemsize
+            del self.d_uv_data["FLUX"], flux, flux_flat
+            try:
+                # Release the unused end of the buffer
+                owner.resize((nBytes + owner.itemsize - 1) / owner.itemsize)
+            except ValueError:
+                # Other references to the buffer exist, so it is left as is
+                pass
+            flux = owner.reshape(-1).view('uint8')[:nBytes].view('float32')
+            self.d_uv_data["FLUX"] = flux.reshape(nOut*nBL, nColOut)
+        else:
+            self.d_uv_data["FLUX"] = flux_out
         
         # Header/metadata update
         ## Integration time
@@ -1575,14 +1889,40 @@ class InterFits(object):
         if type(blsToKeep) == str:
             if blsToKeep.lower() == 'all':
                  # If 'all' is specified, keep all baselines
-                 self._baselineList = None
+                 self._baselineMask = None
         else:
-            # Otherwise loop through the integrations and figure out which 
-            # ones to keep.
-            self._baselineList = []
-            bls = self.d_uv_data["BASELINE"]
-            for i,bl in enumerate(bls):
-                if bl in blsToKeep:
-                    self._baselineList.append(i)
+            # Otherwise build a boolean mask of the UV_DATA rows to keep
+            mask = self.baseline_index.mask(np.asarray(list(blsToKeep)))
+            self._baselineMask = None if mask.all() else mask
+
+    def _selectionMask(self):
+        """ Boolean mask of the UV_DATA rows chosen with select_baselines, or None for all rows """
+        mask = getattr(self, "_baselineMask", None)
+        if mask is not None and len(mask) != len(self.d_uv_data["BASELINE"]):
+            # UV_DATA has changed shape since the selection was made
+            self.select_baselines(self._baselineSelectionCriteria)
+            mask = self._baselineMask
+        return mask
+
+    def _selectedUvData(self):
+        """ Return the UV_DATA columns, restricted to the rows chosen with select_baselines.
+
+        If no selection is active, d_uv_data itself is returned (no copies are made).
+        Columns that are HDF5 datasets (lazy read) only have the selected rows read.
+        """
+        mask = self._selectionMask()
+        if mask is None:
+            return self.d_uv_data
+
+        n_rows = len(mask)
+        rows = np.flatnonzero(mask)
+        uvd = {}
+        for key, data in self.d_uv_data.items():
+            if isinstance(data, h5py.Dataset) and data.ndim and data.shape[0] == n_rows:
+                uvd[key] = data[rows] if len(rows) else data[:0]
+                continue
+            data = np.asarray(data)
+            uvd[key] = data[mask] if data.ndim and data.shape[0] == n_rows else data
+        return uvd
                     
         
\ No newline at end of file
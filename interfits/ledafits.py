@@ -27,6 +27,10 @@ import ledafits_config
 __version__ = '0.0'
 __all__ = ['HeaderDataUnit', 'LedaFits', '__version__', '__all__']
 
+# Process-wide cache of cable delay corrections (see LedaFits.apply_cable_delays),
+# keyed on telescope, electrical length DATE-GEN, frequencies and baselines
+_cable_delay_cache = {}
+
 
 class HeaderDataUnit(object):
     """ Very basic object with header and data units """
@@ -87,48 +91,72 @@ class LedaFits(InterFits):
                 'dada': self.readDada
         }.get(filetype, self.readError)()
 
-    def _readLfile(self, n_ant=32, n_pol=2, n_chans=600, n_stk=4):
+    def _readLfile(self, n_ant=32, n_pol=2, n_chans=600, n_stk=4, first_dump=0, n_dumps=None):
         """ Main L-File reading subroutine.
-        Opens L-files and forms a visibility matrix.
-        See readLfile for main routine """
+        Memory-maps the L-files and gathers the requested dumps into FLUX rows.
+        See readLfile for main routine
+
+        returns (flux, n_dumps)
+        """
 
         n_antpol = n_ant * n_pol
         n_blcc = n_antpol * (n_antpol - 1) / 2
 
-        filename = self.filename.rstrip('.LA').rstrip('.LC')
+        filename = self.filename
+        if os.path.splitext(filename)[1] in ('.LA', '.LC'):
+            filename = os.path.splitext(filename)[0]
 
-        # Autocorrs
+        # Autocorrs, shape (n_dumps, n_antpol, n_chans)
         #h2("Opening autocorrs (.LA)")
-        lfa = np.fromfile(filename + '.LA', dtype='float32')
-        lfa = lfa.reshape([len(lfa) / n_chans / n_antpol, n_antpol, n_chans, 1])
-        lfa = np.concatenate((lfa, np.zeros_like(lfa)), axis=3)
+        lfa = np.memmap(filename + '.LA', dtype='float32', mode='r')
+        lfa = lfa[:len(lfa) / (n_antpol * n_chans) * n_antpol * n_chans]
+        lfa = lfa.reshape([-1, n_antpol, n_chans])
         if self.verbose:
             print "LFA shape:", lfa.shape
 
-        # Cross-corrs
+        # Cross-corrs, shape (n_dumps, n_blcc, n_chans, 2)
         #h2("Opening cross-corrs (.LC)")
-        lfc = np.fromfile(filename + '.LC', dtype='float32')
-        lfc = lfc.reshape([len(lfc) / n_chans / n_blcc / 2, n_blcc, n_chans, 2])
+        lfc = np.memmap(filename + '.LC', dtype='float32', mode='r')
+        lfc = lfc[:len(lfc) / (n_blcc * n_chans * 2) * n_blcc * n_chans * 2]
+        lfc = lfc.reshape([-1, n_blcc, n_chans, 2])
         if self.verbose:
             print "LFC shape:", lfc.shape
 
-        #h2("Forming visibility matrix")
-        # Create a visibility matrix, and use indexing to populate upper triangle
-        n_dumps = lfa.shape[0]
-        vis = np.zeros([n_dumps, n_antpol, n_antpol, n_chans, 2], dtype='float32')
-        iup = np.triu_indices(n_antpol, 1)
-        idiag = (np.arange(0, n_antpol), np.arange(0, n_antpol))
-
-        for ii in range(0, vis.shape[0]):
-            LinePrint("%i of %i" % (ii, vis.shape[0]))
-            vis[ii][iup] = lfc[ii]
-            vis[ii][idiag] = lfa[ii]
+        # Select the range of dumps to read
+        n_dumps_file = min(lfa.shape[0], lfc.shape[0])
+        if n_dumps is None:
+            n_dumps = n_dumps_file - first_dump
+        n_dumps = min(n_dumps, n_dumps_file - first_dump)
+        if n_dumps < 1:
+            raise IOError("No dumps to read from %s (file has %i)" % (filename, n_dumps_file))
+        lfa = lfa[first_dump:first_dump + n_dumps]
+        lfc = lfc[first_dump:first_dump + n_dumps]
+
+        # Index table: position of each upper triangle (row < col) product in .LC
+        lc_idx = np.zeros([n_antpol, n_antpol], dtype='int64') - 1
+        lc_idx[np.triu_indices(n_antpol, 1)] = np.arange(n_blcc)
+
+        # Correlator inputs for each FLUX (baseline, stokes) position
+        ant1, ant2 = np.triu_indices(n_ant)
+        rows = ant1[:, np.newaxis] * n_pol + dada.FLUX_POLS[:, 0]
+        cols = ant2[:, np.newaxis] * n_pol + dada.FLUX_POLS[:, 1]
+        bl, stk = np.indices(rows.shape)
+
+        # Gather cross-correlations from .LC and autocorrelations (real) from .LA.
+        # Note: the lower triangle (YX of autocorrelations) is not stored, so is left as zero
+        #h2("Forming FLUX rows")
+        flux = np.zeros([n_dumps, len(ant1), n_chans, n_stk, 2], dtype='float32')
+        cc, aa = rows < cols, rows == cols
+        # Advanced indexes are separated by a slice, so they become the first axis
+        flux[:, bl[cc], :, stk[cc], :] = lfc[:, lc_idx[rows[cc], cols[cc]]].transpose(1, 0, 2, 3)
+        flux[:, bl[aa], :, stk[aa], 0] = lfa[:, rows[aa]].transpose(1, 0, 2)
         if self.verbose:
-            print "vis shape:", vis.shape
+            print "flux shape:", flux.shape
 
-        return vis
+        return flux.reshape(n_dumps * len(ant1), n_chans * n_stk * 2), n_dumps
 
-    def readLfile(self, n_ant=32, n_pol=2, n_chans=600, n_stk=4, config_xml=None):
+    def readLfile(self, n_ant=32, n_pol=2, n_chans=600, n_stk=4, config_xml=None,
+                  first_dump=0, n_dumps=None):
         """ Read a LEDA L-file 
         
         filename: str
@@ -143,6 +171,10 @@ class LedaFits(InterFits):
             Number of stokes parameters in file. Defaults to 4
         config_xml: str
             Filename of XML schema file. If None, will default to [filename].xml
+        first_dump: int
+            Index of the first dump (integration) to read. Defaults to 0
+        n_dumps: int
+            Number of dumps to read. Defaults to None (all remaining dumps)
 
         Notes
         -----
@@ -163,7 +195,9 @@ class LedaFits(InterFits):
         """
 
         h1("Opening L-file")
-        filename = self.filename.rstrip('.LA').rstrip('.LC')
+        filename = self.filename
+        if os.path.splitext(filename)[1] in ('.LA', '.LC'):
+            filename = os.path.splitext(filename)[0]
         if config_xml is None:
             config_xml = filename + '.xml'
         try:
@@ -173,27 +207,14 @@ class LedaFits(InterFits):
             exit()
 
         # Load visibility data
-        h2("Loading visibility data")
-        vis = self._readLfile()
+        h2("Loading visibility data as FLUX columns")
+        flux, n_dumps = self._readLfile(n_ant, n_pol, n_chans, n_stk,
+                                        first_dump=first_dump, n_dumps=n_dumps)
 
         h2("Generating baseline IDs")
         # Create baseline IDs using MIRIAD >255 antenna format (which sucks)
         bls, ant_arr = coords.generateBaselineIds(n_ant)
-
-        bl_lower = []
-        for dd in range(vis.shape[0]):
-            bl_lower += bls
-
-        h2("Converting visibilities to FLUX columns")
-        flux = np.zeros([len(bl_lower), n_chans * n_stk * 2], dtype='float32')
-        for ii in range(len(bl_lower)):
-            ant1, ant2 = ant_arr[ii % len(ant_arr)]
-            idx1, idx2 = 2 * (ant1 - 1), 2 * (ant2 - 1)
-            xx = vis[0, idx1, idx2]
-            yy = vis[0, idx1 + 1, idx2 + 1]
-            xy = vis[0, idx1, idx2 + 1]
-            yx = vis[0, idx1 + 1, idx2]
-            flux[ii] = np.column_stack((xx, yy, xy, yx)).flatten()
+        bl_lower = np.tile(bls, n_dumps)
 
         self.d_uv_data["BASELINE"] = bl_lower
         self.d_uv_data["FLUX"] = flux
@@ -230,12 +251,15 @@ class LedaFits(InterFits):
         self.baselineList = None
 
 
-    def readDada(self, n_int=None, xmlbase=None, header_dict=None, data_arr=None, inspectOnly=False):
+    def readDada(self, n_int=None, xmlbase=None, header_dict=None, data_arr=None, inspectOnly=False,
+                 input_map=None):
             """ Read a LEDA DADA file.
 
             header_dict (dict): psrdada header. Defaults to None. If a dict is passed, then instead of
                                 loading data from file, data will be loaded from data_arr
             data_arr (np.ndarray): data array. This should be a preformatted FLUX data array.
+            input_map (str or dict): Correlator input remapping, as a dict or JSON file of
+                                {"255A": "238A", ...} entries (see _loadInputMap). Default None.
             """
 
             h1("Loading DADA data")
@@ -245,37 +269,108 @@ class LedaFits(InterFits):
                 flux = data_arr
                 h2("Generating baseline IDs")
                 bls, ant_arr = coords.generateBaselineIds(n_ant)
-                bl_lower = []
-                while len(bl_lower) < len(flux):
-                    bl_lower += bls
+                n_int = len(flux) / len(bls)
             else:
                 h2("Loading visibility data")
-                d   = dada.DadaReader(self.filename, n_int, inspectOnly=inspectOnly)
-                vis = d.data
+                # Raw data is memory-mapped, and only unpacked into FLUX rows below
+                d   = dada.DadaReader(self.filename, n_int, inspectOnly=inspectOnly, memmap=True)
+                d.input_map = self._loadInputMap(input_map, d.n_station)
                 self.dada_header = d.header
                 try:
                     n_chans = d.n_chans
                     n_pol   = d.n_pol
                     n_ant   = d.n_ant
-                    n_int   = d.n_int
                     self.n_ant = n_ant
                 except ValueError:
                     raise RuntimeError("Cannot load NCHAN / NPOL / NSTATION from dada file")
 
             if not header_dict:
                 h2("Converting visibilities to FLUX columns")
-                do_remap = False
-                if d.header["TELESCOPE"] in ('LEDA', 'LWAOVRO', 'LWA-OVRO', 'LEDAOVRO', 'LEDA512', 'LEDA-OVRO'):
-                    do_remap = False
-                flux = self._vis_matrix_to_flux(vis, remap=do_remap)
-                bls, ant_arr = coords.generateBaselineIds(n_ant)
-                bl_lower = []
-                for dd in range(vis.shape[0] / n_int):
-                    bl_lower += bls
+                if n_int is None:
+                    n_int = d.n_int if d.raw is None else d.raw.shape[0]
+                flux  = d.read_flux(0, n_int)
+                n_int = len(flux) / (n_ant * (n_ant + 1) / 2)
 
-            self.d_uv_data["BASELINE"] = np.array([bl_lower for ii in range(n_int)]).flatten()
-            self.d_uv_data["FLUX"] = flux
+            self._readDadaTables(d, n_ant, xmlbase=xmlbase)
+            self._readDadaUvData(d, flux, n_int)
+
+    def iterDada(self, chunk=16, xmlbase=None, input_map=None):
+            """ Read a LEDA DADA file, a block of integrations at a time.
+
+            The header and supporting tables are loaded once. For each block, d_uv_data is
+            replaced by the (zenith phased) UV_DATA rows of that block only, and a
+            (first_int, n_int) tuple is yielded. Peak memory thus depends on the chunk
+            size, not the length of the file.
+
+            chunk (int): Maximum number of integrations per block.
+            input_map (str or dict): Correlator input remapping (see readDada).
+            """
+
+            h1("Streaming DADA data")
+            d = dada.DadaReader(self.filename, inspectOnly=True)
+            d.input_map = self._loadInputMap(input_map, d.n_station)
+            self.dada_header = d.header
+            self.n_ant = d.n_ant
+
+            n_bls = d.n_ant * (d.n_ant + 1) / 2
+            for first_int, flux in d.iter_integrations(chunk=chunk, mode='flux'):
+                n_int = len(flux) / n_bls
+                h2("Converting integrations %i to %i" % (first_int, first_int + n_int - 1))
+
+                if first_int == 0:
+                    self._readDadaTables(d, d.n_ant, xmlbase=xmlbase)
+                self._readDadaUvData(d, flux, n_int, first_int=first_int)
+                yield first_int, n_int
+
+    def convertDada(self, filename_out, chunk=16, xmlbase=None, clobber=False, input_map=None,
+                    compression=None, shuffle=False):
+            """ Convert a LEDA DADA file, streaming blocks of integrations to disk.
+
+            Unlike readDada + export, only chunk integrations are held in memory at a time.
+            Output format is taken from the file extension; HDF5 and FITS-IDI are supported.
+
+            filename_out (str): name of output file
+            chunk (int): Maximum number of integrations to convert at a time.
+            clobber (bool): Whether or not to overwrite the existing file if it exists
+            input_map (str or dict): Correlator input remapping (see readDada).
+            compression, shuffle: HDF5 compression filters (see exportHdf5).
+            """
+            file_ext = os.path.splitext(filename_out)[1][1:]
+            if file_ext in ('fitsidi', 'fidi', 'idifits'):
+                fitsidi, tbl_flag = None, None
+                try:
+                    for first_int, n_int in self.iterDada(chunk=chunk, xmlbase=xmlbase,
+                                                            input_map=input_map):
+                        if fitsidi is None:
+                            fitsidi, tbl_flag = self._createFitsidi(filename_out, clobber=clobber)
+                        self._appendFitsidiUvData(fitsidi)
+                finally:
+                    if fitsidi is not None:
+                        fitsidi.close()
+
+                # As in exportFitsidi, FLAG follows UV_DATA
+                if tbl_flag is not None:
+                    h2('Appending FLAG')
+                    pf.append(filename_out, tbl_flag.data, tbl_flag.header)
+                return
+            elif file_ext not in ('hdf5', 'hdf', 'h5'):
+                raise IOError("Cannot stream to %s" % filename_out)
+
+            hdf = None
+            try:
+                for first_int, n_int in self.iterDada(chunk=chunk, xmlbase=xmlbase,
+                                                        input_map=input_map):
+                    if hdf is None:
+                        hdf = self._createHdf5(filename_out, clobber=clobber, resizable=True,
+                                               compression=compression, shuffle=shuffle)
+                    else:
+                        self._appendHdf5UvData(hdf["d_uv_data"])
+            finally:
+                if hdf is not None:
+                    hdf.close()
 
+    def _readDadaTables(self, d, n_ant, xmlbase=None):
+            """ Generate FITS-IDI tables and metadata for a dada file (see readDada) """
 
             h1("Generating FITS-IDI schema from XML")
             if xmlbase is None:
@@ -307,16 +402,13 @@ class LedaFits(InterFits):
             self.readFitsidi(from_file=False, load_uv_data=False)
 
             h2("Populating interfits dictionaries")
-            self.setDefaults(n_uv_rows=len(bl_lower * n_int))
+            self.setDefaults(n_uv_rows=0)
             self.obs_code = ''
             self.correlator = d.header["INSTRUMENT"]
             self.instrument = d.header["INSTRUMENT"]
             self.telescope  = d.header["TELESCOPE"]
             
             # Compute the integration time
-            tsamp  = float(d.header["TSAMP"]) * 1e-6 # Sampling time per channel, in microseconds
-            navg   = int(d.header["NAVG"])           # Number of averages per integration
-            int_tim = tsamp * navg                   # Integration time is tsamp * navg
             self.t_int = d.t_int
             
             # Compute time offset
@@ -333,6 +425,8 @@ class LedaFits(InterFits):
                 print "NEW START:   %s"%date_obs
 
             self.date_obs = date_obs
+            self.h_uv_data["TELESCOP"] = self.telescope
+            self.h_uv_data["DATE-OBS"] = date_obs
             self.h_params["NSTOKES"]  = 4
             self.h_params["NBAND"]    = 1
             self.h_params["NCHAN"]    = d.n_chans
@@ -351,31 +445,28 @@ class LedaFits(InterFits):
             self.d_array_geometry["ANNAME"] = ["Stand%03d"%i for i in range(len(self.d_array_geometry["ANNAME"]))]
             self.d_array_geometry["NOSTA"]  = [i for i in range(len(self.d_array_geometry["NOSTA"]))]
 
+            # Load array geometry from file, based on TELESCOP name
+            self.loadAntArr()
+
+    def _readDadaUvData(self, d, flux, n_int, first_int=0):
+            """ Fill UV_DATA from dada FLUX rows, and phase them to zenith (see readDada)
+
+            first_int (int): index of first integration in flux, relative to the start of the file.
+            """
+            bls, ant_arr = coords.generateBaselineIds(self.n_ant)
+
+            self.setDefaultsUvData(n_uv_rows=len(bls) * n_int)
+            self.d_uv_data["BASELINE"] = np.tile(bls, n_int)
+            self.d_uv_data["FLUX"] = flux
             self.d_uv_data["INTTIM"] = np.ones_like(self.d_uv_data["INTTIM"]) * d.t_int
 
-            # Recreate list of baselines
-            bl_ids, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=False)
-            n_iters = int(len(self.d_uv_data["BASELINE"]) / len(bl_ids))
-
-            h2("Generating timestamps")
-            dd, tt = [], []
-            for ii in range(n_iters):
-                jd, jt = coords.convertToJulianTuple(self.date_obs)
-                tdelta = int_tim * ii / 86400.0 # In days
-                jds = [jd for jj in range(len(ant_arr))]
-                jts = [jt + tdelta for jj in range(len(ant_arr))]
-                dd.append(jds)
-                tt.append(jts)
-
-            self.d_uv_data["DATE"] = np.array(dd, dtype='float64').ravel()
-            self.d_uv_data["TIME"] = np.array(tt, dtype='float64').ravel()
-            
             # Update the list of baselines to work with
             self.baselineList = None
-            
-            # Load array geometry from file, based on TELESCOP name
-            self.loadAntArr()
+
+            # Note: generateUVW (called by phase_to_src) creates DATE and TIME, which
+            # start at DATE-OBS, so these are offset to the start of this block
             self.phase_to_src('ZEN')
+            self.d_uv_data["TIME"] += first_int * self.t_int / 86400.0 # In days
 
     def _initialize_site(self):
         """ Setup site (ephem observer)
@@ -412,7 +503,25 @@ class LedaFits(InterFits):
             print "Longitude: %s"%self.site.long
             print "Elevation: %s"%self.site.elev
 
-    def _vis_matrix_to_flux(self, vis, remap=False):
+    def _loadInputMap(self, input_map, n_ant):
+        """ Load a correlator input mapping as an input permutation
+
+        input_map (str, dict or np.ndarray): dict of what each input should be : what it
+            actually is, e.g. {"255A": "238A", ...}, or a JSON file containing this dict
+            (see ledafits_config.json_input_map). An array is assumed to already be a
+            permutation, and None means no remapping.
+        n_ant (int): number of antennas
+
+        returns permutation array, or None (see dada.input_map_to_permutation)
+        """
+        if input_map is None or isinstance(input_map, np.ndarray):
+            return input_map
+        if isinstance(input_map, (str, unicode)):
+            input_map = load_json(input_map)
+        h2("Remapping %i correlator inputs" % len(input_map))
+        return dada.input_map_to_permutation(input_map, n_ant, n_pol=2)
+
+    def _vis_matrix_to_flux(self, vis, input_map=None):
         """Convert a visibility matrix to FITS-IDI flux standard
 
         Notes
@@ -423,7 +532,9 @@ class LedaFits(InterFits):
             (xx, yy, xy, yx)
         where each xx is (re_chan0, im_chan0, ... re_chanX, im_chanX).
 
-        We only read one triangle of the visibility matrix, with ant1 >= ant2
+        We only read one triangle of the visibility matrix, with ant1 <= ant2.
+        If an input mapping is given (see _loadInputMap), products that are moved to the
+        other triangle are read from their conjugate.
         """
 
         # h2("Generating baseline IDs")
@@ -433,103 +544,31 @@ class LedaFits(InterFits):
         n_stk   = 4
         n_bls   = n_ant * (n_ant - 1) / 2 + n_ant
 
-        bls, ant_arr = coords.generateBaselineIds(n_ant)
-        ant_arr0     = np.array(ant_arr) - 1 # Zero indexed
-        flux         = np.zeros([n_bls * n_int, n_chans * n_stk * 2], dtype='float32')
-
         try:
             assert vis.dtype == 'complex64'
         except AssertionError:
             raise RuntimeError('Vis data is not complex64, but is instead %s'%vis.dtype)
 
-        for int_num in xrange(n_int):
-            idx = int_num * n_bls
-            vis_int = vis[int_num, ...]
-            for ii in xrange(n_bls):
-                ant1, ant2 = ant_arr0[ii]
-                vv = vis_int[ant1, ant2, ...]
-                xx = vv[:, 0, 0]
-                yy = vv[:, 1, 1]
-                xy = vv[:, 0, 1]
-                yx = vv[:, 1, 0]
-                flux[idx + ii] = np.column_stack((xx, yy, xy, yx)).flatten().view('float32')
-
-        if remap:
-            h2("Remapping antennas")
-            mapping = {
-                "255A" : "238A",
-                "255B" : "240B",
-                "242B" : "253B",
-                "240B" : "252B",
-                "252A" : "254A",
-                "252B" : "244B",
-                "256B" : "248B",
-                "248B" : "256B",
-                "245B" : "255B",
-                "253B" : "245B",
-                "253A" : "255A",
-                "244B" : "254B",
-                "238A" : "252A",
-                "250B" : "242B",
-                "250A" : "253A",
-                "254B" : "250B",
-                "254A" : "250A"
-            }
-            map_keys = set(mapping.keys())
-            bls_all, ants = coords.generateBaselineIds(self.n_ant, autocorrs=True)
-
-            for int_num in xrange(n_int):
-                idx = int_num * n_bls
-                vis_int = vis[int_num, ...]
-
-                # For every antenna remapping
-                for k in map_keys:
-                    ant_old, pol_id = int(k[:3]), 0 if k[3] == 'B' else 1
-                    ant_new         = int(mapping[k][:3])
-
-                    # Find affected baselines
-                    bls_old = self.search_baselines(ant_old)
-                    bls_new = self.search_baselines(ant_new)
-
-                    # For every baseline affected
-                    for bb in range(len(bls_old)):
-                        # Find new antenna pair indexes
-                        bl_old, bl_new = bls_old[bb], bls_new[bb]
-                        bl_idx = bls_all.index(bl_old)
-
-                        if bl_new >= 65536:
-                            a1, a2   = (bl_new - 65536) / 2048 - 1, (bl_new - 65536) % 2048 - 1
-                        else:
-                            a1, a2   = bl_new / 256 - 1, bl_new % 256 - 1
-
-                        # Grab all the visibility data for this baseline
-                        xx = vis_int[a1, a2, :, 0, 0]
-                        xy = vis_int[a1, a2, :, 0, 1]
-                        yx = vis_int[a1, a2, :, 1, 0]
-                        yy = vis_int[a1, a2, :, 1, 1]
-
-                        # Now we need to figure out what we need to update
-                        # Are we updating pol A or pol B? Ant1 or Ant2?
-                        data = flux[idx + bl_idx]
-                        sp = len(xx) * 2
-                        if ant_new == a1:
-                            if pol_id == 0:
-                                data[0:sp]      = xx.flatten().view('float32')
-                                data[2*sp:3*sp] = xy.flatten().view('float32')
-                            else:
-                                data[1*sp:2*sp] = yy.flatten().view('float32')
-                                data[3*sp:]     = yx.flatten().view('float32')
-                        else:
-                            if pol_id == 0:
-                                data[0:sp]      = xx.flatten().view('float32')
-                                data[2*sp:3*sp] = yx.flatten().view('float32')
-                            else:
-                                data[1*sp:2*sp] = yy.flatten().view('float32')
-                                data[3*sp:]     = xy.flatten().view('float32')
-
-                        # Write this back into the right baseline
-                        flux[idx + bl_idx] = data
-        return flux
+        flux = np.zeros([n_int, n_bls, n_chans, n_stk], dtype='complex64')
+
+        if input_map is None:
+            # Fill all baselines at once, one stokes (xx, yy, xy, yx) at a time
+            bls, ant_arr = coords.generateBaselineIds(n_ant)
+            ant_arr0     = np.array(ant_arr) - 1 # Zero indexed
+            ant1, ant2   = ant_arr0[:, 0], ant_arr0[:, 1]
+            for stk, (pola, polb) in enumerate(dada.FLUX_POLS):
+                flux[..., stk] = vis[..., pola, polb][:, ant1, ant2]
+        else:
+            perm = self._loadInputMap(input_map, n_ant)
+            rows, cols, conj = dada.flux_input_pairs(n_ant, 2, perm)
+            for stk in range(n_stk):
+                ant1, pola = rows[:, stk] / 2, rows[:, stk] % 2
+                ant2, polb = cols[:, stk] / 2, cols[:, stk] % 2
+                # Note: advanced indexes are separated, so baselines come first
+                flux[..., stk] = vis[:, ant1, ant2, :, pola, polb].transpose(1, 0, 2)
+            np.conjugate(flux, out=flux, where=conj[:, np.newaxis, :])
+
+        return flux.view('float32').reshape(n_bls * n_int, n_chans * n_stk * 2)
 
 
     def inspectFile(self, filename=None, filetype=None):
@@ -583,10 +622,7 @@ class LedaFits(InterFits):
                 d = HeaderDataUnit(header_dict, data_arr)
                 flux = data_arr
                 h2("Generating baseline IDs")
-                bls, ant_arr = self.generateBaselineIds(n_ant)
-                bl_lower = []
-                while len(bl_lower) < len(flux):
-                    bl_lower += bls
+                bls, ant_arr = coords.generateBaselineIds(n_ant)
             else:
                 h2("Inspecting visibility data")
                 d   = dada.DadaReader(self.filename, n_int, inspectOnly=True)
@@ -691,14 +727,20 @@ class LedaFits(InterFits):
             fits.close()
             return metadata
             
-    def _compute_lst_ha(self, src):
+    def _compute_lst_ha(self, src, t_offsets=None):
         """ Helper function for computing LST, HA, and RA from timestamp
 
+        src (str): Source name (see generateUVW)
+        t_offsets (np.ndarray): Times (s) since DATE-OBS. If given, LST and HA are
+                                returned as arrays, with one entry per time.
+
         returns (ra_deg, dec_deg, lst_deg, ha_deg)
         """
         # First, compute LST
         tt_source = coords.parse_timestring(self.date_obs)
         ts_source = calendar.timegm(tt_source)
+        if t_offsets is not None:
+            ts_source = ts_source + np.asarray(t_offsets, dtype='float64')
         lst_deg = self.computeSiderealTime(ts_source)
 
         # Find HA and DEC of source
@@ -706,7 +748,7 @@ class LedaFits(InterFits):
             H, d     = 0, float(self.site.lat)
             dec_deg  = np.rad2deg(d)
             ra_deg   = lst_deg
-            ha_deg   = 0
+            ha_deg   = np.zeros_like(lst_deg)
         else:
             try:
                 src_names = ledafits_config.src_names
@@ -764,26 +806,24 @@ class LedaFits(InterFits):
         """ Computes the LST for a given timestamp.
 
         ts (float): Timestamp to use. If none is given, DATE-OBS value
-                    is used in lieu.
+                    is used in lieu. If an array of timestamps is given, an
+                    array of LSTs is returned.
 
         returns LST in degrees
         """
 
         h2("Computing LST from UTC")
-        if ts is not None:
-            dt_utc = datetime.utcfromtimestamp(ts)
-        else:
-            dt_utc = datetime.strptime(self.date_obs, "%Y-%m-%dT%H:%M:%S")
+        if ts is None:
+            ts = calendar.timegm(coords.parse_timestring(self.date_obs))
 
-        site = self.site
-        site.date = dt_utc
-        lst, lst_deg = site.sidereal_time(), site.sidereal_time() / 2 / np.pi * 360
+        lst_deg = coords.computeLST(ts, self.site)
         if self.verbose:
-            print "UTC: %s"%dt_utc
-            print "LST: %s (%s)"%(lst, lst_deg)
+            print "UTC: %s"%datetime.utcfromtimestamp(np.ravel(ts)[0])
+            print "LST: %s (%s)"%(ephem.hours(np.deg2rad(np.ravel(lst_deg)[0])), np.ravel(lst_deg)[0])
         return lst_deg
 
-    def generateUVW(self, src='ZEN', update_src=True, conjugate=False, use_stored=False):
+    def generateUVW(self, src='ZEN', update_src=True, conjugate=False, use_stored=False,
+                    time_dependent=False):
         """ Generate UVW coordinates based on timestamps and array geometry
 
         Updates UVW coordinates to phase to a given source. Uses pyEphem observer
@@ -800,82 +840,66 @@ class LedaFits(InterFits):
                            this is faster than recomputing.
         update_src (bool): Default True, update the SOURCE table.
         conjugate (bool): Conjuagte UVW coordinates? Do this if things are flipped in map.
+        time_dependent (bool): Default False, which computes the hour angle at DATE-OBS and
+                               uses it for all integrations. If True, the hour angle of each
+                               integration is used, so UVW coordinates track the source.
         """
 
         h1("Generating UVW coordinates")
-        ra_deg, dec_deg, lst_deg, ha_deg = self._compute_lst_ha(src)
+
+        # Recreate list of baselines
+        xyz   = self.d_array_geometry['STABXYZ']
+        autocorrs = 257 in self.baseline_index
+        bl_ids, ant_arr, good = self._baselineLayout(autocorrs=autocorrs)
+        bl_vecs = coords.computeBaselineVectors(xyz, autocorrs=autocorrs)[good, :]
+
+        n_bls   = len(bl_ids)
+        n_iters = int(len(self.d_uv_data["BASELINE"]) / n_bls)
+        t_offsets = self.t_int * np.arange(n_iters) # Seconds since DATE-OBS
+
+        if time_dependent:
+            ra_deg, dec_deg, lst_deg, ha_deg = self._compute_lst_ha(src, t_offsets)
+        else:
+            ra_deg, dec_deg, lst_deg, ha_deg = self._compute_lst_ha(src)
         H = np.deg2rad(ha_deg)
         d = np.deg2rad(dec_deg)
-        
+
         if self.verbose:
-            print "LST:        %2.3f deg"%lst_deg
-            print "Source RA:  %2.3f deg"%ra_deg
+            # Values are for the first integration if time_dependent
+            print "LST:        %2.3f deg"%np.ravel(lst_deg)[0]
+            print "Source RA:  %2.3f deg"%np.ravel(ra_deg)[0]
             print "Source DEC: %2.3f deg"%dec_deg
-            print "HA:         %2.3f deg"%np.rad2deg(H)
+            print "HA:         %2.3f deg"%np.rad2deg(np.ravel(H)[0])
 
         try:
-            assert H < 2 * np.pi and d < 2 * np.pi
+            assert np.all(H < 2 * np.pi) and d < 2 * np.pi
         except AssertionError:
             raise ValueError("HA and DEC are too large (may not be in radians).")
 
-        # Recreate list of baselines
-        h2("Computing UVW coordinates for %s"%src)
-        xyz   = self.d_array_geometry['STABXYZ']
-        if 257 in set(self.d_uv_data["BASELINE"]):
-            bl_ids, ant_arr = coords.generateBaselineIds(self.n_ant)
-            bl_vecs = coords.computeBaselineVectors(xyz)
-        else:
-            bl_ids, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=False)
-            bl_vecs = coords.computeBaselineVectors(xyz, autocorrs=False)
-        try:
-            good = []
-            for i,id in enumerate(bl_ids):
-                if id in self.bls_id:
-                    good.append( i )
-            bl_ids = [bl_ids[i] for i in good]
-            ant_arr = [ant_arr[i] for i in good]
-            bl_vecs = bl_vecs[good,:]
-        except AttributeError:
-            pass
-            
-        n_iters = int(len(self.d_uv_data["BASELINE"]) / len(bl_ids))
-
-
         h2("Generating timestamps")
-        dd, tt = [], []
-        for ii in range(n_iters):
-            jd, jt = coords.convertToJulianTuple(self.date_obs)
-            tdelta = self.t_int * ii / 86400.0 # In days
-            jds = [jd for jj in range(len(ant_arr))]
-            jts = [jt + tdelta for jj in range(len(ant_arr))]
-            dd.append(jds)
-            tt.append(jts)
-
-        self.d_uv_data["DATE"] = np.array(dd, dtype='float64').ravel()
-        self.d_uv_data["TIME"] = np.array(tt, dtype='float64').ravel()
+        self.d_uv_data["DATE"], self.d_uv_data["TIME"] = \
+            coords.convertToJulianArrays(self.date_obs, t_offsets, n_bls) # TIME in days
 
-        
         if use_stored:
             h2("Loading stored values")
             self.loadUVW()
         else:
-
+            h2("Computing UVW coordinates for %s"%src)
             uvw = coords.computeUVW(bl_vecs, H, d)
 
-            # Fill with data
-            # TODO: update this so that it can lock to zenith or phase to src
-            uu, vv, ww = [], [], []
-            for ii in range(n_iters):
-                uu.append(uvw[:, 0])
-                vv.append(uvw[:, 1])
-                ww.append(uvw[:, 2])
+            # Fill with data, with shape (n_iters * n_bls, 3)
+            if time_dependent:
+                uvw = uvw.reshape(n_iters * n_bls, 3)
+            else:
+                uvw = np.tile(uvw, (n_iters, 1))
 
-            self.d_uv_data["UU"]   = np.array(uu).ravel()
-            self.d_uv_data["VV"]   = np.array(vv).ravel()
-            self.d_uv_data["WW"]   = np.array(ww).ravel()
+            self.d_uv_data["UU"]   = np.array(uvw[:, 0])
+            self.d_uv_data["VV"]   = np.array(uvw[:, 1])
+            self.d_uv_data["WW"]   = np.array(uvw[:, 2])
 
         if update_src:
             h2("Updating SOURCE table")
+            ra_deg = np.ravel(ra_deg)[0] # At DATE-OBS if time_dependent
             self.d_source["SOURCE"] = self.s2arr(src)
             self.d_source["RAEPO"]  = self.s2arr(ra_deg)
             self.d_source["DECEPO"] = self.s2arr(dec_deg)
@@ -1001,7 +1025,7 @@ class LedaFits(InterFits):
         self.d_flag["SEVERITY"].append(severity)
         self.d_flag["CHANS"].append((0, 4096))
 
-    def phase_to_src(self, src='ZEN', generate_uvw=True):
+    def phase_to_src(self, src='ZEN', generate_uvw=True, time_dependent=False):
         """ Apply phase corrections to phase to source.
 
         Generates new UVW coordinates, then applies geometric delay (W component)
@@ -1016,56 +1040,21 @@ class LedaFits(InterFits):
             TAU or TauA: Taurus A
             VIR or VirA: Virgo A
         generate_uvw (bool): Skip regeneration of UVW coords?
+        time_dependent (bool): Phase each integration using its own hour angle,
+            rather than that at DATE-OBS (see generateUVW).
 
         """
         h1("Phasing flux data to %s"%src)
 
         current_tgs = self.d_uv_data["WW"]
         if generate_uvw is True:
-            self.generateUVW(src, update_src=True)
-        freqs = self.formatFreqs()
-        w     = 2 * np.pi * freqs # Angular freq
+            self.generateUVW(src, update_src=True, time_dependent=time_dependent)
         # Note WW *is* the geometric delay tg
         new_tgs   = self.d_uv_data["WW"]
 
-        try:
-            assert self.d_uv_data["FLUX"].dtype == 'float32'
-        except AssertionError:
-             raise RuntimeError("Unexpected data type for FLUX: %s" % str(self.d_uv_data["FLUX"].dtype))
-        flux  = self.d_uv_data["FLUX"].view('complex64')
-
-        bls = set(self.d_uv_data["BASELINE"])
-        if not 257 in bls:
-            bls, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=False)
-        else:
-            bls, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=True)
-        try:
-            good = []
-            for i,id in enumerate(bls):
-                if id in self.bls_id:
-                    good.append( i )
-            bls = [bls[i] for i in good]
-            ant_arr = [ant_arr[i] for i in good]
-        except AttributeError:
-            pass
-        n_int = len(flux) / len(bls)
+        self._apply_geometric_delays(new_tgs - current_tgs)
 
-        for nn in range(n_int):
-            for ii in range(len(bls)):
-                # Compute phases for X and Y pol on antennas A and B
-                tg = new_tgs[nn*len(bls) + ii] - current_tgs[nn*len(bls) + ii]
-                #if ant1 < ant2:
-                #    tg *= -1    # Compensate for geometry
-                p = np.exp(-1j * w * tg) # Needs to be -ve as compensating delay
-                phase_corrs = np.column_stack((p, p, p, p)).flatten()
-                flux[nn*len(bls) + ii] = flux[nn*len(bls) + ii] * phase_corrs
-
-        # Now we have applied geometric delays, we need to
-        # convert from viewing as complex to viewing as floats
-        assert flux.dtype == 'complex64'
-        self.d_uv_data["FLUX"] = flux.view('float32')
-
-    def unphase_to_src(self, src='ZEN', generate_uvw=True):
+    def unphase_to_src(self, src='ZEN', generate_uvw=True, time_dependent=False):
         """ Unapply phase corrections to phase to source.
 
         Generates new UVW coordinates, then unapplies geometric delay (W component)
@@ -1080,54 +1069,65 @@ class LedaFits(InterFits):
             TAU or TauA: Taurus A
             VIR or VirA: Virgo A
         generate_uvw (bool): Skip regeneration of UVW coords?
+        time_dependent (bool): Use the hour angle of each integration (see generateUVW).
 
         """
         h1("Unphasing flux data to %s"%src)
 
         current_tgs = self.d_uv_data["WW"]
         if generate_uvw is True:
-            self.generateUVW(src, update_src=True)
-        freqs = self.formatFreqs()
-        w     = 2 * np.pi * freqs # Angular freq
+            self.generateUVW(src, update_src=True, time_dependent=time_dependent)
         # Note WW *is* the geometric delay tg
         new_tgs   = self.d_uv_data["WW"]
 
+        self._apply_geometric_delays(new_tgs - current_tgs, unapply=True)
+
+    def _apply_geometric_delays(self, tgs, unapply=False, block_size=4096):
+        """ Apply (or unapply) geometric delays to FLUX data, in place
+
+        Each row of FLUX is multiplied by exp(-i w tg) across all channels and
+        stokes, where w is angular frequency. Phasors are computed in blocks of
+        rows, to bound memory usage.
+
+        tgs (np.ndarray): geometric delay (s) for each row of FLUX
+        unapply (bool): Divide by the phasor instead, undoing a previous call
+        block_size (int): Number of rows to compute phasors for at a time
+        """
+        freqs = self.formatFreqs()
+        w     = 2 * np.pi * freqs # Angular freq
+
+        flux  = self._complexFlux()
+
+        # View as (row, chan, stokes), so phasors broadcast across stokes
+        n_rows = flux.shape[0]
+        flux_3d = flux.reshape(n_rows, len(w), -1)
+
+        for ii in xrange(0, n_rows, block_size):
+            tg = tgs[ii:ii + block_size]
+            p  = np.exp(-1j * np.outer(tg, w))[..., np.newaxis] # Needs to be -ve as compensating delay
+            if unapply:
+                flux_3d[ii:ii + block_size] /= p
+            else:
+                flux_3d[ii:ii + block_size] *= p
+
+    def _complexFlux(self):
+        """ Return a complex64 view of FLUX, through which corrections are applied in place
+
+        FLUX is first made a writeable, C-contiguous float32 array (copying it only if
+        needed), so that reshaped views of the returned array always write through to
+        FLUX, and d_uv_data["FLUX"] itself is left in place.
+        """
+        self._loadUvColumns(['FLUX'])
         try:
             assert self.d_uv_data["FLUX"].dtype == 'float32'
         except AssertionError:
              raise RuntimeError("Unexpected data type for FLUX: %s" % str(self.d_uv_data["FLUX"].dtype))
-        flux  = self.d_uv_data["FLUX"].view('complex64')
 
-        bls = set(self.d_uv_data["BASELINE"])
-        if not 257 in bls:
-            bls, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=False)
-        else:
-            bls, ant_arr = coords.generateBaselineIds(self.n_ant, autocorrs=True)
-        try:
-            good = []
-            for i,id in enumerate(bls):
-                if id in self.bls_id:
-                    good.append( i )
-            bls = [bls[i] for i in good]
-            ant_arr = [ant_arr[i] for i in good]
-        except AttributeError:
-            pass
-        n_int = len(flux) / len(bls)
-
-        for nn in range(n_int):
-            for ii in range(len(bls)):
-                # Compute phases for X and Y pol on antennas A and B
-                tg = new_tgs[nn*len(bls) + ii] - current_tgs[nn*len(bls) + ii]
-                #if ant1 < ant2:
-                #    tg *= -1    # Compensate for geometry
-                p = np.exp(-1j * w * tg) # Needs to be -ve as compensating delay
-                phase_corrs = np.column_stack((p, p, p, p)).flatten()
-                flux[nn*len(bls) + ii] = flux[nn*len(bls) + ii] / phase_corrs
-
-        # Now we have applied geometric delays, we need to
-        # convert from viewing as complex to viewing as floats
-        assert flux.dtype == 'complex64'
-        self.d_uv_data["FLUX"] = flux.view('float32')
+        flux = self.d_uv_data["FLUX"]
+        if not (flux.flags.c_contiguous and flux.flags.writeable):
+            flux = np.array(flux, order='C')
+            self.d_uv_data["FLUX"] = flux
+        return flux.view('complex64')
 
     def apply_cable_delays(self, debug=True):
         """ Apply antenna cable delays
@@ -1169,57 +1169,48 @@ class LedaFits(InterFits):
              
         # Generate frequency array from metadata
         freqs = self.formatFreqs()
-        # Compute phase delay for each antenna pair
-        try:
-            assert self.d_uv_data["FLUX"].dtype == 'float32'
-        except AssertionError:
-            raise RuntimeError("Unexpected data type for FLUX: %s" % str(self.d_uv_data["FLUX"].dtype))
-            
-        # Convert the data to complex values
-        flux  = self.d_uv_data["FLUX"].view('complex64')
+        # Convert the data to complex values (see _complexFlux)
+        flux  = self._complexFlux()
         
         # Pre-compute the phasing information
-        bls, ant_arr = coords.generateBaselineIds(self.n_ant)
-        try:
-            good = []
-            for i,id in enumerate(bls):
-                if id in self.bls_id:
-                    good.append( i )
-            bls = [bls[i] for i in good]
-            ant_arr = [ant_arr[i] for i in good]
-        except AttributeError:
-            pass
-        w = 2 * np.pi * freqs # Angular freq
-        delayCorrs = np.zeros((4, len(bls), len(freqs)), dtype=flux.dtype)
-        for ii in range(len(bls)):
-            ant1, ant2 = ant_arr[ii]
-            bl         = bls[ii]
-            td1, td2   = tdelts[ant1-1,:], tdelts[ant2-1,:]
-            
-            # Compute phases for X and Y pol on antennas A and B
-            pxa, pya, pxb, pyb = w * td1[0], w * td1[1], w * td2[0], w * td2[1]
-            
-            # Corrections require negative sign (otherwise reapplying delays)
-            delayCorrs[0,ii,:] = np.exp(1j * (pxa - pxb))	# XX
-            delayCorrs[1,ii,:] = np.exp(1j * (pya - pyb))	# YY
-            delayCorrs[2,ii,:] = np.exp(1j * (pxa - pyb))	# XY
-            delayCorrs[3,ii,:] = np.exp(1j * (pya - pxb))	# YX
-            
+        bls, ant_arr, good = self._baselineLayout()
+
+        key = (self.telescope, self.z_elength['DATE-GEN'], freqs.tostring(), bls.tostring())
+        if key not in _cable_delay_cache:
+            _cable_delay_cache[key] = self._compute_cable_delay_corrs(tdelts, freqs, ant_arr)
+        delayCorrs = _cable_delay_cache[key]
+
+        # Apply to all integrations at once, broadcasting over the integration axis
+        # Note: flux is C-contiguous, so flux_4d is a view and this updates FLUX
         n_int = len(flux) / len(bls)
-        for nn in range(n_int):
-            for ii in range(len(bls)):
-                e_xx = delayCorrs[0,ii,:].flatten()
-                e_yy = delayCorrs[1,ii,:].flatten()
-                e_xy = delayCorrs[2,ii,:].flatten()
-                e_yx = delayCorrs[3,ii,:].flatten()
-                
-                phase_corrs = np.column_stack((e_xx, e_yy, e_xy, e_yx)).flatten()
-                flux[nn*len(bls) + ii] = flux[nn*len(bls) + ii] * phase_corrs
+        flux_4d = flux[:n_int * len(bls)].reshape(n_int, len(bls), len(freqs), 4)
+        flux_4d *= delayCorrs
 
+    def _compute_cable_delay_corrs(self, tdelts, freqs, ant_arr):
+        """ Compute cable delay corrections for a set of baselines
+
+        tdelts (np.ndarray): cable delays (s), with shape (n_ant, 2) for X and Y pols
+        freqs (np.ndarray): frequency of each channel (Hz)
+        ant_arr (np.ndarray): antenna pairs (1-indexed), shape (n_bls, 2)
+
+        returns (read-only) complex64 array with shape (n_bls, n_chans, 4), ordered XX, YY, XY, YX
+        """
+        w = 2 * np.pi * freqs # Angular freq
+        td1, td2 = tdelts[ant_arr[:, 0] - 1], tdelts[ant_arr[:, 1] - 1]
+
+        # Compute phases for X and Y pol on antennas A and B
+        pxa, pya = np.outer(td1[:, 0], w), np.outer(td1[:, 1], w)
+        pxb, pyb = np.outer(td2[:, 0], w), np.outer(td2[:, 1], w)
+
+        # Corrections require negative sign (otherwise reapplying delays)
+        delayCorrs = np.zeros((len(ant_arr), len(freqs), 4), dtype='complex64')
+        delayCorrs[..., 0] = np.exp(1j * (pxa - pxb))    # XX
+        delayCorrs[..., 1] = np.exp(1j * (pya - pyb))    # YY
+        delayCorrs[..., 2] = np.exp(1j * (pxa - pyb))    # XY
+        delayCorrs[..., 3] = np.exp(1j * (pya - pxb))    # YX
+        delayCorrs.flags.writeable = False
+        return delayCorrs
 
-        assert flux.dtype == 'complex64'
-        self.d_uv_data["FLUX"] = flux.view('float32')
-        
     def extractTotalPower(self, antenna_id, timestamps=False):
          """ Extract autocorrelation of a give antenna
   
@@ -1237,21 +1228,14 @@ class LedaFits(InterFits):
          if timestamps arg is set to True, returns (timestamps, data)
          """
          
-         bls   = self.d_uv_data["BASELINE"]
          bl_id = antenna_id * 256 + antenna_id
+         rows  = self.baseline_index.rows(bl_id)
          
-         try:
-             stokes = self.stokes
-         except AttributeError:
-             self.stokes = self.formatStokes()
-             stokes = self.stokes
-             
-         data = stokes[:, bls == bl_id]
+         data = self.stokes[:, rows]
          if timestamps is False:
              return data
          else:
-             ts = self.d_uv_data["TIME"]
-             ts = ts[bls == bl_id]
+             ts = np.asarray(self.d_uv_data["TIME"])[rows]
              return ts, data
              
     def _remap_antenna_hack(self):
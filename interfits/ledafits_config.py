@@ -12,16 +12,19 @@ import os
 import ephem
 
 __version__ = '0.0'
-__all__ = ['SPEED_OF_LIGHT', 'OFFSET_DELTA', 'INT_TIME', 'N_INT_PER_FILE', 
+__all__ = ['SPEED_OF_LIGHT', 'SIDEREAL_RATE', 'OFFSET_DELTA', 'INT_TIME', 'N_INT_PER_FILE', 
            'CH_WIDTH', 'SUB_BW', 'TELESCOP', 'ARRNAM', 
            'ovro', 'json_h_array_geometry', 'json_d_array_geometry', 'json_h_antenna', 'json_d_antenna', 'json_antenna_el_lens', 
-           'lwa1', 'json_h_array_geometry_nm', 'json_d_array_geometry_nm', 'json_h_antenna_nm', 'json_d_antenna_nm', 'json_antenna_el_lens_nm', 
+           'json_input_map', 'lwa1', 'json_h_array_geometry_nm', 'json_d_array_geometry_nm', 'json_h_antenna_nm', 'json_d_antenna_nm', 'json_antenna_el_lens_nm', 
            'src_names', 'src_ras', 'src_decs', '__version__', '__all__']
 
 
 # Speed of light in m/s
 SPEED_OF_LIGHT = 299792458
 
+# Sidereal seconds per (solar) second
+SIDEREAL_RATE  = 1.002737909350795
+
 ########
 # PSR-DADA Settings
 ########
@@ -69,6 +72,9 @@ json_h_antenna         = os.path.join(fileroot, 'config/leda512/h_antenna.json')
 json_d_antenna         = os.path.join(fileroot, 'config/leda512/d_antenna.json')
 json_antenna_el_lens   = os.path.join(fileroot, 'config/leda512/z_antenna_el_lens.json')
 
+# Correlator input remapping for LEDA512, Jan 2014+ (what it should be : what it actually is)
+json_input_map         = os.path.join(fileroot, 'config/leda512/z_input_map.json')
+
 json_h_array_geometry_nm  = os.path.join(fileroot, 'config/leda64_nm/h_array_geometry.json')
 json_d_array_geometry_nm  = os.path.join(fileroot, 'config/leda64_nm/d_array_geometry.json')
 json_h_antenna_nm         = os.path.join(fileroot, 'config/leda64_nm/h_antenna.json')
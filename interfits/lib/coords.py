@@ -19,11 +19,16 @@ from datetime import datetime
 from numpy import sin, cos
 
 __version__ = '0.0'
-__all__ = ['AntArray', 'makeSource', 'generateBaselineIds', 'computeUVW', 'computeBaselineVectors', 'coordTransform', 
-           'geo2ecef', 'ecef2geo', 'convertToJulianTuple', 'parse_timestring', 'LIGHT_SPEED', '__version__', '__all__']
+__all__ = ['AntArray', 'makeSource', 'generateBaselineIds', 'generateBaselineIdList', 'baselineToAntennas', 'antennasToBaseline',
+           'BaselineIndex', 'computeUVW', 'computeBaselineVectors', 'coordTransform', 
+           'geo2ecef', 'ecef2geo', 'convertToJulianTuple', 'convertToJulianArrays', 'computeLST',
+           'parse_timestring', 'LIGHT_SPEED', '__version__', '__all__']
 
 
 LIGHT_SPEED = 299792458.0 # From Google
+SIDEREAL_RATE = 1.002737909350795 # Sidereal days per solar day
+UNIX_EPOCH_JD = 2440587.5 # Julian date of 1970-01-01 00:00 UTC
+EPHEM_EPOCH_JD = 2415020.0 # Julian date of ephem's zero date, 1899-12-31 12:00
 
 class AntArray(ephem.Observer):
     """ An antenna array class.
@@ -74,8 +79,10 @@ def makeSource(name, ra, dec, flux=0, epoch=2000):
     body = ephem.readdb(line)
     return body
 
+_baseline_id_cache = {}
+
 def generateBaselineIds(n_ant=32, autocorrs=True):
-    """ Generate a list of unique baseline IDs and antenna pairs
+    """ Generate arrays of unique baseline IDs and antenna pairs
 
     This uses the MIRIAD definition for >256 antennas:
     bl_id = 2048*ant1 + ant2 + 65536
@@ -83,32 +90,176 @@ def generateBaselineIds(n_ant=32, autocorrs=True):
     n_ant: number of antennas in the array
     autocorrs: include antenna autocorrelations?
 
-    TODO: Rewrite for speed (itertools?)
+    Returns (bls, ant_arr), where bls is an (n_bl,) array of baseline IDs and
+    ant_arr an (n_bl, 2) array of antenna pairs, in upper-triangular order.
+    Results are cached per (n_ant, autocorrs) and are read-only, so copy them
+    before modifying.
     """
+    key = (int(n_ant), bool(autocorrs))
+    try:
+        return _baseline_id_cache[key]
+    except KeyError:
+        pass
+
+    ant1, ant2 = np.triu_indices(n_ant, k=0 if autocorrs else 1)
+    ant_arr = np.column_stack((ant1, ant2)).astype('int64') + 1
+    bls = antennasToBaseline(ant_arr[:, 0], ant_arr[:, 1])
+    bls.flags.writeable = False
+    ant_arr.flags.writeable = False
 
-    bls, ant_arr = [], []
-    for ii in range(1, n_ant + 1):
-        for jj in range(1, n_ant + 1):
-            if jj >= ii:
-                if autocorrs is False and ii == jj:
-                    pass
-                else:
-                    ant_arr.append((ii, jj))
-                    if ii > 255 or jj > 255:
-                        bl_id = ii * 2048 + jj + 65536
-                    else:
-                        bl_id = 256 * ii + jj
-                    bls.append(bl_id)
+    _baseline_id_cache[key] = (bls, ant_arr)
     return bls, ant_arr
 
+def generateBaselineIdList(n_ant=32, autocorrs=True):
+    """ List version of generateBaselineIds, for code expecting python lists
+
+    Returns (bls, ant_arr) as a list of baseline IDs and a list of (ant1, ant2) tuples.
+    """
+    bls, ant_arr = generateBaselineIds(n_ant, autocorrs)
+    return bls.tolist(), [tuple(pair) for pair in ant_arr.tolist()]
+
+def baselineToAntennas(bl_ids):
+    """ Convert baseline IDs into antenna pairs
+
+    Uses the MIRIAD convention for antennas > 255 (see generateBaselineIds)
+
+    bl_id: baseline ID, or array of baseline IDs
+
+    Returns (ant1, ant2) tuple of antenna IDs (or arrays of IDs)
+    """
+    bl_ids = np.asarray(bl_ids).astype('int64')
+    miriad = bl_ids > 65536
+    ant1 = np.where(miriad, (bl_ids - 65536) / 2048, bl_ids / 256)
+    ant2 = np.where(miriad, (bl_ids - 65536) % 2048, bl_ids % 256)
+    if ant1.ndim == 0:
+        return int(ant1), int(ant2)
+    return ant1, ant2
+
+def antennasToBaseline(ant1, ant2):
+    """ Convert antenna pairs into baseline IDs
+
+    Uses the MIRIAD convention for antennas > 255 (see generateBaselineIds)
+
+    ant1, ant2: antenna IDs, or arrays of antenna IDs
+
+    Returns baseline ID (or array of IDs)
+    """
+    ant1 = np.asarray(ant1).astype('int64')
+    ant2 = np.asarray(ant2).astype('int64')
+    miriad = (ant1 > 255) | (ant2 > 255)
+    bl_ids = np.where(miriad, ant1 * 2048 + ant2 + 65536, ant1 * 256 + ant2)
+    if bl_ids.ndim == 0:
+        return int(bl_ids)
+    return bl_ids
+
+class BaselineIndex(object):
+    """ Index of the baselines in a UV_DATA table.
+
+    UV_DATA tables store integrations one after another, with the same baselines in
+    the same order in each. The index holds arrays of the baseline IDs, antennas and
+    row offsets of a single integration, so that table rows for a given antenna or
+    baseline can be found without scanning the table.
+
+    Parameters
+    ----------
+    baselines: np.ndarray
+        BASELINE column of the UV_DATA table
+
+    Attributes
+    ----------
+    bl_id, ant1, ant2, offset: np.ndarray
+        Baseline ID, antennas and row offset within an integration of each baseline
+    n_bls, n_int, n_rows: int
+        Number of baselines per integration, integrations and rows in the table
+    regular: bool
+        Whether every integration has the same baselines, in the same order. If not,
+        row lookups fall back to searching the BASELINE column.
+    """
+    def __init__(self, baselines):
+        self.baselines = baselines
+        bls = np.asarray(baselines).astype('int64')
+
+        # The first integration runs up to the first repeat of the first baseline
+        n_rows  = len(bls)
+        repeats = np.flatnonzero(bls == bls[0]) if n_rows else np.array([0])
+        n_bls   = repeats[1] if len(repeats) > 1 else n_rows
+
+        self.bl_id  = bls[:n_bls]
+        self.ant1, self.ant2 = baselineToAntennas(self.bl_id)
+        self.offset = np.arange(n_bls)
+        self.n_bls  = n_bls
+        self.n_rows = n_rows
+        self.n_int  = n_rows / n_bls if n_bls else 0
+        self.regular = n_bls > 0 and n_rows % n_bls == 0 and \
+            np.all(bls.reshape(-1, n_bls) == self.bl_id)
+        if not self.regular:
+            self._bls = bls
+
+        # Sorted IDs, for vectorized lookups with searchsorted
+        self._order  = np.argsort(self.bl_id, kind='mergesort')
+        self._sorted = self.bl_id[self._order]
+
+    def __len__(self):
+        return self.n_bls
+
+    def __contains__(self, bl_id):
+        return bool(self.contains(bl_id))
+
+    def contains(self, bl_ids):
+        """ Check if baseline ID(s) are in the table. Returns bool or bool array. """
+        bl_ids = np.asarray(bl_ids).astype('int64')
+        if self.n_bls == 0:
+            return np.zeros(bl_ids.shape, dtype=bool)
+        pos = np.searchsorted(self._sorted, bl_ids).clip(0, self.n_bls - 1)
+        return self._sorted[pos] == bl_ids
+
+    def get_offset(self, bl_ids):
+        """ Row offset within an integration for baseline ID(s)
+
+        Raises KeyError if a baseline is not in the table.
+        """
+        bl_ids = np.asarray(bl_ids).astype('int64')
+        found  = self.contains(bl_ids)
+        if not np.all(found):
+            raise KeyError("Baseline(s) not found: %s" % str(np.ravel(bl_ids)[~np.ravel(found)]))
+        return self._order[np.searchsorted(self._sorted, bl_ids)]
+
+    def search(self, ref_ant, autocorrs=True):
+        """ Baseline IDs that contain a given antenna (or any of an array of antennas) """
+        ref_ant = np.atleast_1d(ref_ant)
+        match = np.in1d(self.ant1, ref_ant) | np.in1d(self.ant2, ref_ant)
+        if not autocorrs:
+            match &= self.ant1 != self.ant2
+        return self.bl_id[match]
+
+    def mask(self, bl_ids):
+        """ Boolean mask over all table rows, True where BASELINE is one of bl_ids """
+        if self.regular:
+            return np.tile(np.in1d(self.bl_id, bl_ids), self.n_int)
+        return np.in1d(self._bls, bl_ids)
+
+    def rows(self, bl_ids):
+        """ Indexes of all table rows for baseline ID(s), in table order """
+        if self.regular:
+            offsets = self.offset[np.in1d(self.bl_id, bl_ids)]
+            return (np.arange(self.n_int)[:, np.newaxis] * self.n_bls + offsets).ravel()
+        return np.flatnonzero(self.mask(bl_ids))
+
+    def antenna_rows(self, ref_ant, autocorrs=True):
+        """ Indexes of all table rows for baselines containing a given antenna """
+        return self.rows(self.search(ref_ant, autocorrs=autocorrs))
+
 def computeUVW(xyz, H, d, in_seconds=True, conjugate=False):
     """ Converts X-Y-Z baselines into U-V-W
 
     Parameters
     ----------
     xyz: should be a numpy array [x,y,z] of baselines (NOT ANTENNAS!)
-    H: float (float, radians) is the hour angle of the phase reference position
-    d: float (float, radians) is the declination
+    H: float (float, radians) is the hour angle of the phase reference position.
+       If an array of hour angles (e.g. one per integration) is given, UVW coordinates
+       are computed for each, and an array of shape (n_H, n_bl, 3) is returned.
+    d: float (float, radians) is the declination. May also be an array, which is
+       broadcast against H (e.g. for a source with a per-integration declination).
     conjugate: (bool): Conjugate UVW coordinates?
     in_seconds (bool): Return in seconds (True) or meters (False)
     Returns uvw vector (in microseconds)
@@ -131,36 +282,42 @@ def computeUVW(xyz, H, d, in_seconds=True, conjugate=False):
     Here (H, d) are usually the hour angle and declination of the phase reference
     position.
 
+    For arrays of (H, d) a stack of rotation matrices is built, and applied to all
+    baselines with a single matrix product.
     """
-    is_list = True
-    if type(xyz) in (list, tuple):
-        x, y, z = xyz
-    if type(xyz) == type(np.array([1])):
-        is_list = False
-        try:
-            #print xyz.shape
-            x, y, z = np.split(xyz, 3, axis=1)
-        except:
-            print xyz.shape
-            raise
+    is_list = type(xyz) in (list, tuple)
+    if is_list:
+        xyz = np.concatenate([np.asarray(c, dtype='float64')[..., np.newaxis]
+                              for c in np.broadcast_arrays(*xyz)], axis=-1)
+    else:
+        xyz = np.asarray(xyz)
+        if xyz.shape[-1] != 3:
+            raise ValueError("Cannot understand input XYZ array of shape %s" % str(xyz.shape))
+
+    batched = np.ndim(H) > 0 or np.ndim(d) > 0
+    H, d = np.broadcast_arrays(np.ravel(H), np.ravel(d)) if batched else (H, d)
 
     sh, sd = sin(H), sin(d)
     ch, cd = cos(H), cos(d)
-    u  = sh * x + ch * y
-    v  = -sd * ch * x + sd * sh * y + cd * z
-    w  = cd * ch * x - cd * sh * y + sd * z
-
-    if is_list:
-        uvw = np.array((u, v, w))
-    else:
-        uvw = np.column_stack((u, v, w))
+    rot = np.array([[sh,       ch,       np.zeros_like(sh)],
+                    [-sd * ch, sd * sh,  cd],
+                    [cd * ch,  -cd * sh, sd]], dtype='float64')
 
+    # Fold the sign and units into the matrix, rather than the (much larger) output
     if conjugate:
-        uvw *= -1
+        rot *= -1
     if in_seconds:
-        return uvw / LIGHT_SPEED
+        rot /= LIGHT_SPEED
+
+    if batched:
+        # rot is (3, 3, n_H): uvw[t, ..., i] = sum_j rot[i, j, t] * xyz[..., j]
+        uvw = np.einsum('ijt,...j->t...i', rot, xyz)
     else:
-        return uvw
+        uvw = np.dot(xyz, rot.T)
+
+    if is_list:
+        uvw = np.rollaxis(uvw, -1)
+    return uvw
 
 def computeBaselineVectors(xyz, autocorrs=True):
     """ Compute all the possible baseline combos for antenna array
@@ -174,29 +331,12 @@ def computeBaselineVectors(xyz, autocorrs=True):
     -------
     XYZ array of all antenna combinations, in ascending antenna IDs.
     """
-    try:
-        assert type(xyz) == type(np.array([1]))
-    except AssertionError:
-        xyz = np.array(xyz)
-        if xyz.shape[1] != 3:
-            raise ValueError("Cannot understand input XYZ array")
-
-    n_ant = xyz.shape[0]
-    if autocorrs:
-        bls = np.zeros([n_ant * (n_ant - 1) / 2 + n_ant, 3])
-    else:
-        bls = np.zeros([n_ant * (n_ant - 1) / 2, 3])
-
-    bls_idx = 0
-    for ii in range(n_ant):
-        for jj in range(n_ant):
-            if jj >= ii:
-                if autocorrs is False and ii == jj:
-                    pass
-                else:
-                    bls[bls_idx] = xyz[ii] - xyz[jj]
-                    bls_idx += 1
-    return bls
+    xyz = np.asarray(xyz)
+    if xyz.ndim != 2 or xyz.shape[1] != 3:
+        raise ValueError("Cannot understand input XYZ array")
+
+    ii, jj = np.triu_indices(xyz.shape[0], k=0 if autocorrs else 1)
+    return (xyz[ii] - xyz[jj]).astype('float64')
 
 def coordTransform(xyz, input='ENU', output='NED'):
     """ Coordinate frame transformations.
@@ -293,6 +433,21 @@ def ecef2geo(x, y, z):
 
     return lat, lon, elev
 
+def _toTimestamp(timestamp):
+    """ Convert a timestamp (float, time tuple, string or datetime) into a unix timestamp """
+    if type(timestamp) in (str, unicode):
+        tt = parse_timestring(timestamp)
+        ts = calendar.timegm(tt)
+    elif isinstance(timestamp, (float, int, long, np.number)):
+        ts = float(timestamp)
+    elif type(timestamp) in (tuple, time.struct_time):
+        ts = calendar.timegm(timestamp)
+    elif isinstance(timestamp, datetime):
+        ts = calendar.timegm(timestamp.timetuple())
+    else:
+        raise TypeError("Unknown timestamp type '%s'" % str(type(timestamp)))
+    return ts
+
 def convertToJulianTuple(timestamp):
     """ Convert a list of timestamps into DATE and TIME since julian midnight
 
@@ -302,32 +457,60 @@ def convertToJulianTuple(timestamp):
     timestamp (float): timestamp of type 'float' is preferred, but this should
                        handle time tuples, strings and datetime objects too.
     """
-    
-    # Figure out exactly what type of timestamp we've got.
-    if type(timestamp) in (str, unicode):
-        tt = parse_timestring(timestamp)
-        ts = calendar.timegm(tt)
-    elif type(timestamp) is float:
-        ts = timestamp
-    elif type(timestamp) is tuple:
-        ts = calendar.timegm(timestamp)
-    elif type(timestamp) is type(datetime.now):
-        date_str = timestamp.strftime("%Y-%m-%dT%H:%M:%S")
-        tt = time.strptime(date_str, "%Y-%m-%dT%H:%M:%S")
-        ts = calendar.timegm(tt)
-    else:
-        raise TypeError("Unknown timestamp type '%s'" % str(type(timestamp)))
-        
+    ts = int(_toTimestamp(timestamp)) # Whole seconds, as per time.gmtime
+
     # DATE is julian date at midnight that day
     # TIME is in DAYS since midnight
-    julian = ephem.julian_date(time.gmtime(ts)[:6])
-    # Ephem returns julian date at NOON, we need at MIDNIGHT
-    julian_midnight = int(julian) - 0.5
-
-    time_elapsed = ephem.julian_date(time.gmtime(ts)[:6]) - julian_midnight
+    days, seconds = divmod(ts, 86400)
+    julian_midnight = days + UNIX_EPOCH_JD
+    time_elapsed = seconds / 86400.0
 
     return julian_midnight, time_elapsed
 
+def convertToJulianArrays(timestamp, t_offsets=0, n_bls=1):
+    """ Compute FITS-IDI DATE and TIME columns for a run of integrations
+
+    DATE is the julian date at midnight on the day of the start timestamp, and
+    TIME the days since then (see convertToJulianTuple). TIME is not wrapped at
+    the next midnight, so DATE is the same for every row.
+
+    timestamp (float): start timestamp (or anything convertToJulianTuple accepts)
+    t_offsets (np.array): times of each integration (s) since timestamp
+    n_bls (int): number of UV_DATA rows per integration; each entry of t_offsets
+                 is repeated this many times.
+
+    Returns (date, time) float64 arrays of length len(t_offsets) * n_bls
+    """
+    jd, jt = convertToJulianTuple(timestamp)
+    t_offsets = np.atleast_1d(np.asarray(t_offsets, dtype='float64'))
+    date = np.empty(len(t_offsets) * n_bls, dtype='float64')
+    date.fill(jd)
+    jtime = np.repeat(jt + t_offsets / 86400.0, n_bls)
+    return date, jtime
+
+def computeLST(ts, site):
+    """ Compute the local (apparent) sidereal time for one or more timestamps
+
+    Only the first timestamp is passed through ephem; the others are advanced
+    from it at the sidereal rate, so an array of timestamps costs the same as one.
+
+    ts (float or np.array): unix timestamp(s), UTC
+    site (ephem.Observer): observer to compute LST for. It is not modified.
+
+    Returns LST in degrees, as a float or array matching ts.
+    """
+    ts  = np.asarray(ts, dtype='float64')
+    ts0 = float(ts.flat[0])
+
+    obs = site.copy()
+    obs.date = ephem.Date(ts0 / 86400.0 + UNIX_EPOCH_JD - EPHEM_EPOCH_JD)
+    lst0 = float(obs.sidereal_time()) / 2 / np.pi * 360
+
+    if ts.ndim == 0:
+        return lst0
+    lst_deg = lst0 + (ts - ts0) * SIDEREAL_RATE * 360.0 / 86400
+    return np.mod(lst_deg, 360.0)
+
 def parse_timestring(tstring):
     """ Convert timestring into timestamp """
     try:
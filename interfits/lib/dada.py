@@ -14,7 +14,22 @@ import os
 #from interfits.lib.timeit import timeit
 
 __version__ = '0.0'
-__all__ = ['DadaReader', 'lookup_warn', '__version__', '__all__']
+__all__ = ['DadaReader', 'lookup_warn', 'input_map_to_permutation', 'flux_input_pairs',
+           '__version__', '__all__']
+
+# Process-wide cache of (matrows, matcols) lookup tables,
+# keyed on (n_station, n_pol, data_order)
+_matrix_index_cache = {}
+
+# Process-wide cache of FLUX gather indexes, keyed on
+# (n_station, n_pol, data_order, input permutation)
+_flux_index_cache = {}
+
+# (pola, polb) of each polarization product in a FITS-IDI FLUX row (XX, YY, XY, YX)
+FLUX_POLS = np.array([[0, 0], [1, 1], [0, 1], [1, 0]])
+
+# Polarization labels, as used in input mappings (e.g. "255A")
+POL_LABELS = 'BA'
 
 
 def lookup_warn(table, key, default=None):
@@ -30,6 +45,73 @@ def lookup_warn(table, key, default=None):
             return None
 
 
+def input_map_to_permutation(input_map, n_station, n_pol=2):
+    """ Convert an input mapping into a correlator input permutation
+
+    Parameters
+    ----------
+    input_map: dict
+        Mapping of what the input should be to what it actually is, as
+        antenna number (1-indexed) and polarization, e.g. {"255A": "238A", ...}.
+        Inputs that are not listed are left where they are.
+    n_station: int
+        Number of stations (antennas)
+    n_pol: int
+        Number of polarizations per station
+
+    Returns
+    -------
+    perm: np.ndarray
+        Array of length n_station * n_pol, where perm[ii] is the correlator input
+        that holds logical input ii. Inputs are numbered ant * n_pol + pol.
+    """
+    perm = np.arange(n_station * n_pol)
+    for k, v in input_map.items():
+        idx_old = (int(k[:-1]) - 1) * n_pol + POL_LABELS.index(k[-1])
+        idx_new = (int(v[:-1]) - 1) * n_pol + POL_LABELS.index(v[-1])
+        perm[idx_old] = idx_new
+
+    if np.unique(perm).size != perm.size:
+        raise ValueError("Input mapping is not a permutation")
+    return perm
+
+
+def flux_input_pairs(n_station, n_pol=2, perm=None):
+    """ Find the correlator inputs that feed each FITS-IDI FLUX position
+
+    Baselines are ordered as per coords.generateBaselineIds (ant1 <= ant2), with
+    polarization products XX, YY, XY, YX.
+
+    Parameters
+    ----------
+    n_station: int
+        Number of stations (antennas)
+    n_pol: int
+        Number of polarizations per station. Must be 2.
+    perm: np.ndarray
+        Correlator input permutation (see input_map_to_permutation). Default None.
+
+    Returns
+    -------
+    (rows, cols, conj): tuple of np.ndarray, each with shape (n_bls, 4)
+        rows and cols are the correlator inputs of the lower triangle (i.e. with
+        ant(row) <= ant(col)) holding the data. If conj is True, the value found
+        there is the conjugate of the requested product.
+    """
+    if n_pol != 2:
+        raise ValueError("FLUX conversion requires NPOL = 2, not %i" % n_pol)
+
+    ant1, ant2 = np.triu_indices(n_station)
+    rows = ant1[:, np.newaxis] * n_pol + FLUX_POLS[:, 0]
+    cols = ant2[:, np.newaxis] * n_pol + FLUX_POLS[:, 1]
+    if perm is not None:
+        rows, cols = perm[rows], perm[cols]
+
+    conj = rows / n_pol > cols / n_pol
+    rows, cols = np.where(conj, cols, rows), np.where(conj, rows, cols)
+    return rows, cols, conj
+
+
 class DadaReader(object):
     """ Dada file reader for raw LEDA correlator data.
 
@@ -44,11 +126,22 @@ class DadaReader(object):
         number of integrations to read. If None, will only read header
     inspectOnly: bool
         If inspectOnly, will only read header and will not unpack data.
+    memmap: bool
+        If memmap, the data payload is memory-mapped (see map_raw_data) and is
+        not unpacked into a visibility matrix. Use read_raw / read_data to unpack
+        only the integrations that are required.
+    input_map: np.ndarray
+        Correlator input permutation to apply when converting to FLUX rows
+        (see input_map_to_permutation and read_flux). Default None.
     """
     DEFAULT_HEADER_SIZE = 4096
+    # Directory for persisting matrix index lookup tables (see compute_matrix_indexes)
+    index_cache_dir = None
 
-    def __init__(self, filename, n_int=None, inspectOnly=False):
+    def __init__(self, filename, n_int=None, inspectOnly=False, memmap=False, input_map=None):
         self.filename = filename
+        self.raw = None
+        self.input_map = input_map
         self.read_header()
 
         # Load entire file unless n_int is specified
@@ -62,7 +155,10 @@ class DadaReader(object):
                 n_int = file_size / bpa
 
             self.compute_matrix_indexes()
-            self.read_data(0, n_int=n_int)
+            if memmap:
+                self.raw = self.map_raw_data(n_int)
+            else:
+                self.read_data(0, n_int=n_int)
             self.datestamp = self.header['UTC_START']
 
             
@@ -151,27 +247,137 @@ class DadaReader(object):
                                       'REG_TILE_TRIANGULAR_2x2')
 
     #@timeit
-    def compute_matrix_indexes(self):
-        """ Compute the matrix indexes """
+    def compute_matrix_indexes(self, cache_dir=None):
+        """ Compute the matrix indexes
+
+        The lookup tables only depend on (n_station, n_pol, data_order), so they are
+        computed once per process and shared (read-only) between readers.
+
+        Parameters
+        ----------
+        cache_dir: str
+            Directory in which to persist the lookup tables as .npy files, so that
+            they are not rebuilt by later processes. Defaults to DadaReader.index_cache_dir.
+            If both are None, tables are only cached in memory.
+        """
         if self.data_order == 'REG_TILE_TRIANGULAR_2x2':
             reg_rows = 2
             reg_cols = 2
             self.matlen = self.reg_tile_triangular_matlen(reg_rows, reg_cols)
-            # Build lookup table to map matrix idx --> row/col
-            self.matrows = np.zeros(self.matlen, dtype=np.uint32)
-            self.matcols = np.zeros(self.matlen, dtype=np.uint32)
-            for i in xrange(self.matlen):
-                row, col = self.reg_tile_triangular_coords(i, reg_rows, reg_cols)
-                self.matrows[i] = row
-                self.matcols[i] = col
         else:
             raise KeyError("Unsupported data order '%s'" % self.data_order)
 
-    #@timeit
-    def read_data(self, first_int, n_int=1):
+        key = (self.n_station, self.n_pol, self.data_order)
+        if key not in _matrix_index_cache:
+            if cache_dir is None:
+                cache_dir = self.index_cache_dir
+
+            matidx = None
+            if cache_dir is not None:
+                filename = os.path.join(cache_dir, 'matidx_%s_%is_%ip.npy' % (
+                    self.data_order.lower(), self.n_station, self.n_pol))
+                if os.path.exists(filename):
+                    matidx = np.load(filename)
+                    if matidx.shape != (2, self.matlen):
+                        matidx = None
+
+            if matidx is None:
+                # Build lookup table to map matrix idx --> row/col
+                matrix_idx = np.arange(self.matlen, dtype=np.uint32)
+                rows, cols = self.reg_tile_triangular_coords(matrix_idx, reg_rows, reg_cols)
+                matidx = np.array([rows, cols], dtype=np.uint32)
+                if cache_dir is not None:
+                    try:
+                        np.save(filename, matidx)
+                    except IOError:
+                        print "#Warning: Could not write index cache %s" % filename
+
+            matidx.flags.writeable = False
+            _matrix_index_cache[key] = (matidx[0], matidx[1])
+
+        self.matrows, self.matcols = _matrix_index_cache[key]
+
+    def compute_flux_indexes(self):
+        """ Compute the gather index that maps raw data to FITS-IDI FLUX order
+
+        self.fluxidx has length n_bls * 4, and element (bl * 4 + stk) gives the raw
+        matrix index holding polarization product stk (XX, YY, XY, YX) of baseline bl.
+        Baselines are in the order given by coords.generateBaselineIds (ant1 <= ant2).
+        Elements of the register tiles that fall below the diagonal are not referenced.
+
+        If an input permutation is set (self.input_map), it is folded into the index.
+        Products that then come from the other triangle are flagged in self.fluxconj,
+        otherwise self.fluxconj is None.
         """
-        Returns the specified integrations as a numpy array with shape:
-        (nint, nchans, nstation, nstation, npol, npol), dtype=complex64
+        if not hasattr(self, 'matlen'):
+            self.compute_matrix_indexes()
+
+        perm = getattr(self, 'input_map', None)
+        if perm is not None:
+            perm = np.asarray(perm)
+        key = (self.n_station, self.n_pol, self.data_order,
+               None if perm is None else perm.tostring())
+
+        if key not in _flux_index_cache:
+            n_input = self.n_station * self.n_pol
+            rows, cols, conj = flux_input_pairs(self.n_station, self.n_pol, perm)
+
+            # Lookup table from (row, col) to raw matrix index
+            # Note cols then rows -- see transform_raw_data
+            matrows, matcols = self.matcols, self.matrows
+            ok = matrows / self.n_pol <= matcols / self.n_pol
+            lookup = np.zeros((n_input, n_input), dtype=np.int64) - 1
+            lookup[matrows[ok], matcols[ok]] = np.arange(self.matlen)[ok]
+
+            fluxidx = lookup[rows, cols].ravel()
+            if np.any(fluxidx < 0):
+                raise RuntimeError("Matrix indexes do not cover all baselines")
+            fluxidx = fluxidx.astype(np.uint32)
+            fluxconj = conj if conj.any() else None
+
+            fluxidx.flags.writeable = False
+            if fluxconj is not None:
+                fluxconj.flags.writeable = False
+            _flux_index_cache[key] = (fluxidx, fluxconj)
+
+        self.fluxidx, self.fluxconj = _flux_index_cache[key]
+
+    def map_raw_data(self, n_int=None):
+        """ Memory-map the data payload of the dada file (zero-copy)
+
+        Returns a read-only np.memmap with shape (n_int, 2, n_chans, matlen), where
+        axis 1 holds the real and imaginary components. Nothing is read from disk
+        until the array is indexed, so slicing out integrations or channels only
+        touches the corresponding parts of the file.
+
+        Parameters
+        ----------
+        n_int: int
+            Number of integrations to map. Defaults to all complete integrations
+            present on disk.
+        """
+        n_int_dsk = self.bytes_per_file / self.bytes_per_avg
+        if n_int is None:
+            n_int = self.n_int
+        n_int = min(n_int, n_int_dsk)
+        if n_int < 1:
+            raise IOError("No complete integrations in %s" % self.filename)
+
+        itemsize = np.dtype(self.dtype).itemsize
+        if 2 * self.n_chans * self.matlen * itemsize != self.bytes_per_avg:
+            raise ValueError("BYTES_PER_AVG (%i) does not match NCHAN / NSTATION / NBIT"
+                             % self.bytes_per_avg)
+
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.header_size,
+                         shape=(n_int, 2, self.n_chans, self.matlen))
+
+    def read_raw(self, first_int, n_int=1):
+        """
+        Returns the specified integrations as raw correlator data, with shape:
+        (nint, 2, nchans, matlen), dtype as given by NBIT
+
+        If the file is memory-mapped, a view into the map is returned, otherwise
+        only the requested integrations are read from disk.
 
         Parameters
         ----------
@@ -180,6 +386,9 @@ class DadaReader(object):
         n_int: int
             Number of integrations to read
         """
+        if self.raw is not None:
+            return self.raw[first_int:first_int + n_int]
+
         byte_offset = first_int * self.bytes_per_avg
         nbytes = n_int * self.bytes_per_avg
 
@@ -195,10 +404,125 @@ class DadaReader(object):
         data = np.fromfile(f, dtype=np.uint8, count=nbytes)
         f.close()
 
+        data = data.view(dtype=self.dtype)
+        return data.reshape((-1, 2, self.n_chans, self.matlen))
+
+    def iter_integrations(self, chunk=1, first_int=0, n_int=None, mode='vis'):
+        """ Iterate through the file, a block of integrations at a time
+
+        Yields (first_int, data) tuples, where data holds at most chunk integrations.
+        Only one block is held in memory at a time, so peak memory depends on the
+        chunk size rather than the length of the file.
+
+        Parameters
+        ----------
+        chunk: int
+            Maximum number of integrations per block
+        first_int: int
+            Integration to start from
+        n_int: int
+            Number of integrations to iterate over. Defaults to the rest of the file.
+        mode: str
+            'vis' yields visibility matrices (see read_data), 'raw' yields raw
+            correlator data (see read_raw) and 'flux' yields FITS-IDI FLUX rows
+            (see read_flux)
+        """
+        if mode not in ('vis', 'raw', 'flux'):
+            raise ValueError("Unknown iteration mode '%s'" % mode)
+        if not hasattr(self, 'matlen'):
+            self.compute_matrix_indexes()
+
+        n_int_dsk = self.bytes_per_file / self.bytes_per_avg
+        if n_int is None:
+            n_int = min(self.n_int, n_int_dsk) - first_int
+        last_int = min(first_int + n_int, n_int_dsk)
+
+        for ii in xrange(first_int, last_int, chunk):
+            n_blk = min(chunk, last_int - ii)
+            if mode == 'raw':
+                yield ii, self.read_raw(ii, n_blk)
+            elif mode == 'flux':
+                yield ii, self.read_flux(ii, n_blk)
+            else:
+                # Release the previous block before unpacking the next one
+                self.data = None
+                yield ii, self.read_data(ii, n_blk)
+
+    #@timeit
+    def read_data(self, first_int, n_int=1):
+        """
+        Returns the specified integrations as a numpy array with shape:
+        (nint, nchans, nstation, nstation, npol, npol), dtype=complex64
+
+        Parameters
+        ----------
+        first_int: int
+            Number of integrations to skip from start of file (i.e. offset)
+        n_int: int
+            Number of integrations to read
+        """
+        data = self.read_raw(first_int, n_int)
+
         # Transform data into a visibilty matrix
-        data = self.transform_raw_data(data, n_int)
+        data = self.transform_raw_data(data, data.shape[0])
         return data
 
+    def read_flux(self, first_int, n_int=1):
+        """
+        Returns the specified integrations in FITS-IDI FLUX order, with shape:
+        (nint * n_bls, nchans * 4 * 2), dtype=float32
+
+        Parameters
+        ----------
+        first_int: int
+            Number of integrations to skip from start of file (i.e. offset)
+        n_int: int
+            Number of integrations to read
+        """
+        data = self.read_raw(first_int, n_int)
+        return self.raw_to_flux(data, data.shape[0])
+
+    #@timeit
+    def raw_to_flux(self, data, n_int):
+        """ Reorder raw dada data straight into FITS-IDI FLUX rows
+
+        Unlike transform_raw_data, no visibility matrix is formed: the raw data is
+        gathered into place using fluxidx (see compute_flux_indexes).
+
+        Parameters
+        ----------
+        data: np.ndarray
+            raw data array, shape (n_int, 2, n_chans, matlen)
+        n_int:
+            number of integrations in data array
+
+        Notes
+        -----
+        FLUX rows are ordered (n_int, n_bls), and each row is (chan, stokes, re/im),
+        with stokes ordered (xx, yy, xy, yx). The imaginary part is conjugated, as
+        is done by transform_raw_data, unless the input permutation has moved the
+        product to the other triangle (see compute_flux_indexes).
+        """
+        if not hasattr(self, 'fluxidx'):
+            self.compute_flux_indexes()
+
+        data = data.view(dtype=self.dtype).reshape((n_int, 2, -1, self.matlen))
+        n_chans = data.shape[2]
+        n_stk   = self.n_pol ** 2
+        n_bls   = self.fluxidx.size / n_stk
+
+        flux = np.empty((n_int, n_bls, n_chans, n_stk, 2), dtype=np.float32)
+        for ii in (0, 1):
+            vv = data[:, ii].take(self.fluxidx, axis=-1)
+            vv = vv.reshape(n_int, n_chans, n_bls, n_stk).transpose(0, 2, 1, 3)
+            flux[..., ii] = vv
+        if self.fluxconj is None:
+            np.negative(flux[..., 1], flux[..., 1])
+        else:
+            flux[..., 1] *= np.where(self.fluxconj, 1, -1).astype(np.float32)[:, np.newaxis, :]
+
+        return flux.reshape(n_int * n_bls, n_chans * n_stk * 2)
+
     #@timeit
     def transform_raw_data(self, data, n_int, fill_conjugate=False):
         """ Transform dada data into a useful visibility matrix
@@ -226,10 +550,12 @@ class DadaReader(object):
 
         data = data.view(dtype=self.dtype).astype(np.float32)
         # Note: The real and imag components are stored separately
-        data = data.reshape((n_int, 2, self.n_chans, self.matlen))
+        # The channel axis may be a subset of the band (e.g. a slice of a memmap)
+        data = data.reshape((n_int, 2, -1, self.matlen))
+        n_chans = data.shape[2]
 
         # Scatter values into new full matrix
-        fullmatrix = np.zeros((n_int, self.n_chans, self.n_input, self.n_input),
+        fullmatrix = np.zeros((n_int, n_chans, self.n_input, self.n_input),
                               dtype=np.complex64)
 
         if not fill_conjugate:
@@ -246,11 +572,12 @@ class DadaReader(object):
             fullmatrix[..., cols, rows] = np.conj(fullmatrix[..., rows, cols])
 
         # Reorder so that pol products change fastest
-        fullmatrix = fullmatrix.reshape(n_int, self.n_chans,
+        fullmatrix = fullmatrix.reshape(n_int, n_chans,
                                         self.n_station, self.n_pol,
                                         self.n_station, self.n_pol)
         fullmatrix = fullmatrix.transpose([0, 2, 4, 1, 3, 5])
         self.data = fullmatrix
+        return fullmatrix
 
 
     def triangular_coords(self, matrix_idx):
@@ -265,18 +592,19 @@ class DadaReader(object):
                (self.n_station / reg_cols / 2) * self.n_pol ** 2 * reg_rows * reg_cols
 
     def reg_tile_triangular_coords(self, matrix_idx, reg_rows, reg_cols):
-        """ Compute row, col for a given matrix index, with given register tile sizes """
+        """ Compute row, col for a given matrix index (or array of indexes),
+        with given register tile sizes """
         npol = self.n_pol
         reg_tile_nbaseline = (self.n_station / reg_rows + 1) * (self.n_station / reg_cols / 2)
         rem = matrix_idx
         reg_col = rem / (reg_rows * reg_tile_nbaseline * npol * npol)
-        rem %= (reg_rows * reg_tile_nbaseline * npol * npol)
+        rem = rem % (reg_rows * reg_tile_nbaseline * npol * npol)
         reg_row = rem / (reg_tile_nbaseline * npol * npol)
-        rem %= (reg_tile_nbaseline * npol * npol)
+        rem = rem % (reg_tile_nbaseline * npol * npol)
         tile_row, tile_col = self.triangular_coords(rem / (npol * npol))
-        rem %= (npol * npol)
+        rem = rem % (npol * npol)
         pol_col = rem / npol
-        rem %= npol
+        rem = rem % npol
         pol_row = rem
 
         row = pol_col + npol * (reg_row + reg_cols * tile_row)
@@ -6,8 +6,14 @@ json_numpy.py
 
 Helper utilities from reading and writing JSON data with numpy arrays. The native JSON
 encoder cannot handle numpy arrays and will chuck a hissy-fit, hence these helper functions.
+
+Numeric arrays larger than SIDECAR_BYTES are not converted to lists, but written to a .npy
+"sidecar" file next to the JSON file (e.g. d_uv_data.FLUX.npy for d_uv_data.json). The JSON
+then holds the name of the sidecar file, with its dtype and shape in the "_key" entry.
 """
 
+import os
+
 try:
     import ujson as json
     USES_UJSON = True
@@ -18,7 +24,10 @@ except ImportError:
 import numpy as np
 
 __version__ = '0.0'
-__all__ = ['sanitize_json', 'dump_json', 'load_json', '__version__', '__all__']
+__all__ = ['sanitize_json', 'dump_json', 'load_json', 'SIDECAR_BYTES', '__version__', '__all__']
+
+# Arrays at least this large (in bytes) are written to .npy sidecar files by dump_json
+SIDECAR_BYTES = 2**20
 
 
 def sanitize_json(npDict):
@@ -41,24 +50,56 @@ def sanitize_json(npDict):
                     raise
         return npDict
 
-def dump_json(npDict_in, filename_out):
-    """ Dump a dictionary of numpy arrays to an output file """
+def dump_sidecars(npDict, filename_out, sidecar_bytes=SIDECAR_BYTES):
+    """ Write large numeric arrays to .npy files, replacing them with references
+
+    Arrays (or array-like objects, such as h5py datasets) of sidecar_bytes or more are
+    saved as <filename_out without extension>.<key>.npy. In npDict, the array is replaced
+    by the sidecar file name, and "_"+key is set to "npy <dtype> <shape>".
+    """
+    basename = os.path.splitext(filename_out)[0]
+    for key in npDict.keys():
+        arr = npDict[key]
+        if type(arr) is np.chararray or not hasattr(arr, 'dtype') or not hasattr(arr, 'shape'):
+            continue
+        if arr.dtype.kind not in 'biufc' or np.prod(arr.shape) * arr.dtype.itemsize < sidecar_bytes:
+            continue
+
+        filename_npy = "%s.%s.npy" % (basename, key)
+        np.save(filename_npy, np.asarray(arr))
+        npDict["_"+key] = "npy %s %s" % (arr.dtype, ",".join([str(n) for n in arr.shape]))
+        npDict[key] = os.path.basename(filename_npy)
+    return npDict
+
+def dump_json(npDict_in, filename_out, sidecar_bytes=SIDECAR_BYTES):
+    """ Dump a dictionary of numpy arrays to an output file
+
+    Numeric arrays of sidecar_bytes or more are written to .npy sidecar files (see
+    dump_sidecars). Set sidecar_bytes to None to always write arrays as JSON lists.
+    """
     npDict = npDict_in.copy()
     if type(filename_out) is file:
         outfile = filename_out
     else:
         outfile = open(filename_out, 'w')
+        if sidecar_bytes is not None:
+            npDict = dump_sidecars(npDict, filename_out, sidecar_bytes)
 
     npDict = sanitize_json(npDict)
     json.dump(npDict, outfile)
     npDict.clear()
 
-def load_json(filename):
-    """ Load a JSON file """
+def load_json(filename, mmap_mode=None):
+    """ Load a JSON file
+
+    mmap_mode: str
+        If not None, .npy sidecar files are memory-mapped with this mode (see np.load)
+    """
     if type(filename) is str:
         fileo = open(filename, 'r')
     else:
         fileo = filename
+    dirname = os.path.dirname(os.path.abspath(getattr(fileo, 'name', '.')))
 
     data = json.load(fileo)
 
@@ -80,6 +121,12 @@ def load_json(filename):
                 pass
             elif dtype_str.split(" ")[0] == 'ndarray':
                 data[okey] = np.array(data[okey], dtype=dtype_str.split(" ")[1])
+            elif dtype_str.split(" ")[0] == 'npy':
+                dtype, shape = dtype_str.split(" ")[1:]
+                shape = tuple([int(n) for n in shape.split(",") if n])
+                data[okey] = np.load(os.path.join(dirname, data[okey]), mmap_mode=mmap_mode)
+                if data[okey].dtype != np.dtype(dtype) or data[okey].shape != shape:
+                    raise IOError("Sidecar file for %s does not match %s" % (okey, dtype_str))
 
     [data.pop(key) for key in to_pop] # This line removes _dtype things
 
@@ -46,6 +46,7 @@ Module listing
 """
 
 import sys, os
+import hashlib
 import pyfits as pf, numpy as np
 from lxml import etree
 import lxml
@@ -54,7 +55,15 @@ __version__ = '0.0'
 __all__ = ['checkConfigType', 'parseConfig', 'make_primary', 'make_array_geometry', 'make_antenna', 
            'make_frequency', 'make_source', 'make_uv_data', 'make_interferometer_model', 'make_system_temperature', 
            'make_gain_curve', 'make_phase_cal', 'make_flag', 'make_bandpass', 'make_weather', 'make_baseline', 
-           'make_calibration', 'make_model_comps', '__version__', '__all__']
+           'make_calibration', 'make_model_comps', 'BinTableWriter', '__version__', '__all__']
+
+# Parsed XML root and config tags, keyed on the SHA1 of the XML content (see parseConfig)
+CONFIG_CACHE_SIZE = 64
+_config_cache = {}
+
+# Column definitions for the static table types, keyed on (table name, column shape
+# parameters, num_rows), see _newTable
+_coldefs_cache = {}
 
 
 def checkConfigType(config):
@@ -76,6 +85,15 @@ def checkConfigType(config):
         print type(config)
         raise
 
+def _configContent(config):
+    """ Return the XML content of config (a filename or lxml element tree) as a string """
+    if type(config) is lxml.etree._ElementTree:
+        return etree.tostring(config)
+    if type(config) in (str, unicode):
+        with open(config) as fh:
+            return fh.read()
+    return checkConfigType(config)
+
 def parseConfig(tagname, config='config.xml'):
     """ Finds tagname, in elementTree x, parses and returns dictionary of values
   This is a helper function, and is not usually called directly.
@@ -84,10 +102,30 @@ def parseConfig(tagname, config='config.xml'):
   -----
   This function uses eval() to evaluate the text string inside a child tag. As such,
   exercise caution! todo: block off certain modules to eval()
+
+  Parsed values are cached per process, keyed on a hash of the XML content, so
+  each tag of a given config is only parsed and evaluated once.
+  """
+
+    content = _configContent(config)
+    key = hashlib.sha1(content).hexdigest()
+    if key not in _config_cache:
+        if len(_config_cache) >= CONFIG_CACHE_SIZE:
+            _config_cache.clear()
+        _config_cache[key] = (etree.fromstring(content), {})
+    root, tags = _config_cache[key]
+
+    if tagname not in tags:
+        tags[tagname] = _parseConfigTag(tagname, root)
+
+    return dict(tags[tagname])
+
+def _parseConfigTag(tagname, x):
+    """ Parse the children of tagname in XML root element x, as a list of (tag, value) pairs
+  (see parseConfig). Pairs are kept in XML order, so dicts built from them match the
+  key order of an uncached parse.
   """
 
-    xmlData = checkConfigType(config)
-    x = xmlData.getroot()
     T = True # FITS just uses T for True, python (and pyFITS) uses True
 
     # As we reference 'parameters', we need to search for this first
@@ -95,17 +133,17 @@ def parseConfig(tagname, config='config.xml'):
 
     # This line makes me very happy, but will probably infuriate others:
     try:
-        vals = dict([(child.tag, eval(child.text.strip())) for child in x.find(tagname).getchildren()])
+        vals = [(child.tag, eval(child.text.strip())) for child in x.find(tagname).getchildren()]
     except SyntaxError:
         if type(child.text.strip()) == type(" "):
-            vals = dict([(child.tag, child.text.strip()) for child in x.find(tagname).getchildren()])
+            vals = [(child.tag, child.text.strip()) for child in x.find(tagname).getchildren()]
         else:
             print child.tag
             print child.text
             raise
     except NameError:
         if type(child.text.strip()) == type(" "):
-            vals = dict([(child.tag, child.text.strip()) for child in x.find(tagname).getchildren()])
+            vals = [(child.tag, child.text.strip()) for child in x.find(tagname).getchildren()]
         else:
             print child.tag
             print child.text
@@ -123,6 +161,28 @@ def parseConfig(tagname, config='config.xml'):
     return vals
 
 
+def _newTable(key, columns, num_rows):
+    """ Returns a new empty table HDU, built from cached column definitions
+  
+  The column definitions are created the first time key is seen; later calls skip
+  building the pf.Column list. pf.new_table copies the column arrays, so tables
+  never share data with the cache.
+
+  Parameters
+  ----------
+  key: tuple
+    table name, plus any config parameters that change the columns (e.g. NBAND)
+  columns: function
+    returns the list of pf.Column for the table, with num_rows rows
+  num_rows: int
+    number of rows in the table
+  """
+    key = key + (num_rows,)
+    if key not in _coldefs_cache:
+        _coldefs_cache[key] = pf.ColDefs(columns())
+    return pf.new_table(_coldefs_cache[key])
+
+
 def make_primary(config='config.xml'):
     """  Creates the primary header data unit (HDU).
   
@@ -182,36 +242,37 @@ def make_array_geometry(config='config.xml', num_rows=1):
     common = parseConfig('COMMON', config)
 
     # Generate the columns for the table header
-    c = []
+    def columns():
+        c = []
 
-    c.append(pf.Column(name='ANNAME', format='8A',
-                       array=np.zeros(num_rows, dtype='a8')))
+        c.append(pf.Column(name='ANNAME', format='8A',
+                           array=np.zeros(num_rows, dtype='a8')))
 
-    c.append(pf.Column(name='STABXYZ', format='3D',
-                       unit='METERS', array=np.zeros(num_rows, dtype='3float64')))
+        c.append(pf.Column(name='STABXYZ', format='3D',
+                           unit='METERS', array=np.zeros(num_rows, dtype='3float64')))
 
-    c.append(pf.Column(name='DERXYZ', format='3E',
-                       unit='METERS/SEC', array=np.zeros(num_rows, dtype='3float32')))
+        c.append(pf.Column(name='DERXYZ', format='3E',
+                           unit='METERS/SEC', array=np.zeros(num_rows, dtype='3float32')))
 
-    orb_format = '%iD' % params['NORB']
-    orb_dtype = '%ifloat64' % params['NORB']
-    c.append(pf.Column(name='ORBPARM', format=orb_format,
-                       array=np.zeros(num_rows, dtype=orb_dtype)))
+        orb_format = '%iD' % params['NORB']
+        orb_dtype = '%ifloat64' % params['NORB']
+        c.append(pf.Column(name='ORBPARM', format=orb_format,
+                           array=np.zeros(num_rows, dtype=orb_dtype)))
 
-    c.append(pf.Column(name='NOSTA', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='NOSTA', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='MNTSTA', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='MNTSTA', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='STAXOF', format='3E',
-                       unit='METERS', array=np.zeros(num_rows, dtype='3float32')))
+        c.append(pf.Column(name='STAXOF', format='3E',
+                           unit='METERS', array=np.zeros(num_rows, dtype='3float32')))
 
-    c.append(pf.Column(name='DIAMETER', format='1E',
-                       unit='METERS', array=np.zeros(num_rows, dtype='float32')))
+        c.append(pf.Column(name='DIAMETER', format='1E',
+                           unit='METERS', array=np.zeros(num_rows, dtype='float32')))
+        return c
 
-    coldefs = pf.ColDefs(c)
-    tblhdu = pf.new_table(coldefs)
+    tblhdu = _newTable(('ARRAY_GEOMETRY', params['NORB']), columns, num_rows)
 
     for key in array_geometry: tblhdu.header.update(key, array_geometry[key])
     for key in common: tblhdu.header.update(key, common[key])
@@ -258,53 +319,55 @@ def make_antenna(config='config.xml', num_rows=1):
     nband = params['NBAND']
     npcal = params['NPCAL']
 
-    c = []
+    # Generate the columns for the table header
+    def columns():
+        c = []
 
-    c.append(pf.Column(name='TIME', format='1D',
-                       unit='DAYS', array=np.zeros(num_rows, dtype='float32')))
+        c.append(pf.Column(name='TIME', format='1D',
+                           unit='DAYS', array=np.zeros(num_rows, dtype='float32')))
 
-    c.append(pf.Column(name='TIME_INTERVAL', format='1E',
-                       unit='DAYS', array=np.zeros(num_rows, dtype='float32')))
+        c.append(pf.Column(name='TIME_INTERVAL', format='1E',
+                           unit='DAYS', array=np.zeros(num_rows, dtype='float32')))
 
-    c.append(pf.Column(name='ANNAME', format='8A',
-                       array=np.zeros(num_rows, dtype='a8')))
+        c.append(pf.Column(name='ANNAME', format='8A',
+                           array=np.zeros(num_rows, dtype='a8')))
 
-    c.append(pf.Column(name='ANTENNA_NO', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='ANTENNA_NO', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='ARRAY', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='ARRAY', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='FREQID', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='FREQID', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='NO_LEVELS', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='NO_LEVELS', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='POLTYA', format='1A',
-                       array=np.zeros(num_rows, dtype='a1')))
+        c.append(pf.Column(name='POLTYA', format='1A',
+                           array=np.zeros(num_rows, dtype='a1')))
 
-    c.append(pf.Column(name='POLTYB', format='1A',
-                       array=np.zeros(num_rows, dtype='a1')))
+        c.append(pf.Column(name='POLTYB', format='1A',
+                           array=np.zeros(num_rows, dtype='a1')))
 
-    pol_format = '%iE' % nband
-    pol_dtype = '%ifloat32' % nband
-    c.append(pf.Column(name='POLAA', format=pol_format,
-                       unit='DEGREES', array=np.zeros(num_rows, dtype=pol_dtype)))
+        pol_format = '%iE' % nband
+        pol_dtype = '%ifloat32' % nband
+        c.append(pf.Column(name='POLAA', format=pol_format,
+                           unit='DEGREES', array=np.zeros(num_rows, dtype=pol_dtype)))
 
-    c.append(pf.Column(name='POLAB', format=pol_format,
-                       unit='DEGREES', array=np.zeros(num_rows, dtype=pol_dtype)))
+        c.append(pf.Column(name='POLAB', format=pol_format,
+                           unit='DEGREES', array=np.zeros(num_rows, dtype=pol_dtype)))
 
-    # nb: Was encontering errors with CASA with this column
-    #c.append(pf.Column(name='POLCALA', format='1E',\
-    #  array=np.zeros(32,dtype='float32')))
+        # nb: Was encontering errors with CASA with this column
+        #c.append(pf.Column(name='POLCALA', format='1E',\
+        #  array=np.zeros(32,dtype='float32')))
 
-    # nb: Was encontering errors with CASA with this column
-    #c.append(pf.Column(name='POLCALB', format='1E',\
-    #  array=np.zeros(32,dtype='float32')))
+        # nb: Was encontering errors with CASA with this column
+        #c.append(pf.Column(name='POLCALB', format='1E',\
+        #  array=np.zeros(32,dtype='float32')))
+        return c
 
-    coldefs = pf.ColDefs(c)
-    tblhdu = pf.new_table(coldefs)
+    tblhdu = _newTable(('ANTENNA', nband), columns, num_rows)
 
     for key in cards: tblhdu.header.update(key, cards[key])
     for key in common: tblhdu.header.update(key, common[key])
@@ -341,35 +404,37 @@ def make_frequency(config='config.xml', num_rows=1):
 
     nband = params['NBAND']
 
-    c = []
+    # Generate the columns for the table header
+    def columns():
+        c = []
 
-    c.append(pf.Column(name='FREQID', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='FREQID', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    ba_format = '%iD' % nband
-    ba_dtype = '%ifloat64' % nband
-    c.append(pf.Column(name='BANDFREQ', format=ba_format,
-                       unit='HZ', array=np.zeros(num_rows, dtype=ba_dtype)))
+        ba_format = '%iD' % nband
+        ba_dtype = '%ifloat64' % nband
+        c.append(pf.Column(name='BANDFREQ', format=ba_format,
+                           unit='HZ', array=np.zeros(num_rows, dtype=ba_dtype)))
 
-    ch_format = '%iE' % nband
-    ch_dtype = '%ifloat32' % nband
-    c.append(pf.Column(name='CH_WIDTH', format=ch_format,
-                       unit='HZ', array=np.zeros(num_rows, dtype=ch_dtype)))
+        ch_format = '%iE' % nband
+        ch_dtype = '%ifloat32' % nband
+        c.append(pf.Column(name='CH_WIDTH', format=ch_format,
+                           unit='HZ', array=np.zeros(num_rows, dtype=ch_dtype)))
 
-    c.append(pf.Column(name='TOTAL_BANDWIDTH', format='1E',
-                       unit='HZ', array=np.zeros(num_rows, dtype='float32')))
+        c.append(pf.Column(name='TOTAL_BANDWIDTH', format='1E',
+                           unit='HZ', array=np.zeros(num_rows, dtype='float32')))
 
-    si_format = '%iJ' % nband
-    si_dtype = '%iint32' % nband
-    c.append(pf.Column(name='SIDEBAND', format=si_format,
-                       array=np.zeros(num_rows, dtype=si_dtype)))
+        si_format = '%iJ' % nband
+        si_dtype = '%iint32' % nband
+        c.append(pf.Column(name='SIDEBAND', format=si_format,
+                           array=np.zeros(num_rows, dtype=si_dtype)))
 
-    # Not really sure what this does, so commented it out
-    #c.append(pf.Column(name='BB_CHAN',  format='1J',\
-    #  array=np.zeros(num_rows,dtype='int32')))
+        # Not really sure what this does, so commented it out
+        #c.append(pf.Column(name='BB_CHAN',  format='1J',\
+        #  array=np.zeros(num_rows,dtype='int32')))
+        return c
 
-    coldefs = pf.ColDefs(c)
-    tblhdu = pf.new_table(coldefs)
+    tblhdu = _newTable(('FREQUENCY', nband), columns, num_rows)
 
     for key in cards: tblhdu.header.update(key, cards[key])
     for key in common: tblhdu.header.update(key, common[key])
@@ -425,83 +490,85 @@ num_rows: int
     so_format = '%iE' % nband
     so_dtype = '%ifloat32' % nband
 
-    c = []
+    # Generate the columns for the table header
+    def columns():
+        c = []
 
-    c.append(pf.Column(name='SOURCE_ID', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='SOURCE_ID', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='SOURCE', format='16A',
-                       array=np.zeros(num_rows, dtype='16a')))
+        c.append(pf.Column(name='SOURCE', format='16A',
+                           array=np.zeros(num_rows, dtype='16a')))
 
-    c.append(pf.Column(name='QUAL', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='QUAL', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='CALCODE', format='4A',
-                       array=np.zeros(num_rows, dtype='4a')))
+        c.append(pf.Column(name='CALCODE', format='4A',
+                           array=np.zeros(num_rows, dtype='4a')))
 
-    c.append(pf.Column(name='FREQID', format='1J',
-                       array=np.zeros(num_rows, dtype='int32')))
+        c.append(pf.Column(name='FREQID', format='1J',
+                           array=np.zeros(num_rows, dtype='int32')))
 
-    c.append(pf.Column(name='IFLUX', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='IFLUX', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='QFLUX', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='QFLUX', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='UFLUX', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='UFLUX', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='VFLUX', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='VFLUX', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='ALPHA', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='ALPHA', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='FREQOFF', format=so_format,
-                       array=np.zeros(num_rows, dtype=so_dtype)))
+        c.append(pf.Column(name='FREQOFF', format=so_format,
+                           array=np.zeros(num_rows, dtype=so_dtype)))
 
-    c.append(pf.Column(name='RAEPO', format='1D',
-                       unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='RAEPO', format='1D',
+                           unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
 
-    c.append(pf.Column(name='DECEPO', format='1D',
-                       unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='DECEPO', format='1D',
+                           unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
 
-    c.append(pf.Column(name='EQUINOX', format='8A',
-                       array=np.zeros(num_rows, dtype='8a')))
+        c.append(pf.Column(name='EQUINOX', format='8A',
+                           array=np.zeros(num_rows, dtype='8a')))
 
-    c.append(pf.Column(name='RAAPP', format='1D',
-                       unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='RAAPP', format='1D',
+                           unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
 
-    c.append(pf.Column(name='DECAPP', format='1D',
-                       unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='DECAPP', format='1D',
+                           unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
 
-    sv_format = '%iD' % nband
-    sv_dtype = '%ifloat64' % nband
-    c.append(pf.Column(name='SYSVEL', format=sv_format,
-                       unit='METERS/SEC', array=np.zeros(num_rows, dtype=sv_dtype)))
+        sv_format = '%iD' % nband
+        sv_dtype = '%ifloat64' % nband
+        c.append(pf.Column(name='SYSVEL', format=sv_format,
+                           unit='METERS/SEC', array=np.zeros(num_rows, dtype=sv_dtype)))
 
-    c.append(pf.Column(name='VELTYP', format='8A',
-                       array=np.zeros(num_rows, dtype='8a')))
+        c.append(pf.Column(name='VELTYP', format='8A',
+                           array=np.zeros(num_rows, dtype='8a')))
 
-    c.append(pf.Column(name='VELDEF', format='8A',
-                       array=np.zeros(num_rows, dtype='8a')))
+        c.append(pf.Column(name='VELDEF', format='8A',
+                           array=np.zeros(num_rows, dtype='8a')))
 
-    rf_format = '%iD' % nband
-    rf_dtype = '%ifloat64' % nband
-    c.append(pf.Column(name='RESTFREQ', format=rf_format,
-                       unit='HZ', array=np.zeros(num_rows, dtype=rf_dtype)))
+        rf_format = '%iD' % nband
+        rf_dtype = '%ifloat64' % nband
+        c.append(pf.Column(name='RESTFREQ', format=rf_format,
+                           unit='HZ', array=np.zeros(num_rows, dtype=rf_dtype)))
 
-    c.append(pf.Column(name='PMRA', format='1D',
-                       unit='DEGREES/DAY', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='PMRA', format='1D',
+                           unit='DEGREES/DAY', array=np.zeros(num_rows, dtype='float64')))
 
-    c.append(pf.Column(name='PMDEC', format='1D',
-                       unit='DEGREES/DAY', array=np.zeros(num_rows, dtype='float64')))
+        c.append(pf.Column(name='PMDEC', format='1D',
+                           unit='DEGREES/DAY', array=np.zeros(num_rows, dtype='float64')))
 
-    c.append(pf.Column(name='PARALLAX', format='1E',
-                       unit='ARCSEC', array=np.zeros(num_rows, dtype='float32')))
+        c.append(pf.Column(name='PARALLAX', format='1E',
+                           unit='ARCSEC', array=np.zeros(num_rows, dtype='float32')))
+        return c
 
-    coldefs = pf.ColDefs(c)
-    tblhdu = pf.new_table(coldefs)
+    tblhdu = _newTable(('SOURCE', nband), columns, num_rows)
 
     for key in cards: tblhdu.header.update(key, cards[key])
     for key in common: tblhdu.header.update(key, common[key])
@@ -551,15 +618,15 @@ def make_uv_data(config='config.xml', num_rows=1, uu_data=None, vv_data=None, ww
     cards = parseConfig('UV_DATA', config)
     common = parseConfig('COMMON', config)
 
-    if uu_data == None: uu_data = np.zeros(num_rows, dtype='float32')
-    if vv_data == None: vv_data = np.zeros(num_rows, dtype='float32')
-    if ww_data == None: ww_data = np.zeros(num_rows, dtype='float32')
-    if date_data == None: date_data = np.zeros(num_rows, dtype='float64')
-    if time_data == None: time_data = np.zeros(num_rows, dtype='float64')
-    if baseline_data == None: baseline_data = np.zeros(num_rows, dtype='int32')
-    if source_data == None: source_data = np.zeros(num_rows, dtype='int32')
-    if freqid_data == None: freqid_data = np.zeros(num_rows, dtype='int32')
-    if inttim_data == None: inttim_data = np.zeros(num_rows, dtype='float32')
+    if uu_data is None: uu_data = np.zeros(num_rows, dtype='float32')
+    if vv_data is None: vv_data = np.zeros(num_rows, dtype='float32')
+    if ww_data is None: ww_data = np.zeros(num_rows, dtype='float32')
+    if date_data is None: date_data = np.zeros(num_rows, dtype='float64')
+    if time_data is None: time_data = np.zeros(num_rows, dtype='float64')
+    if baseline_data is None: baseline_data = np.zeros(num_rows, dtype='int32')
+    if source_data is None: source_data = np.zeros(num_rows, dtype='int32')
+    if freqid_data is None: freqid_data = np.zeros(num_rows, dtype='int32')
+    if inttim_data is None: inttim_data = np.zeros(num_rows, dtype='float32')
 
     c.append(pf.Column(name='UU', format='1E', unit='SECONDS', array=uu_data))
     c.append(pf.Column(name='VV', format='1E', unit='SECONDS', array=vv_data))
@@ -582,8 +649,8 @@ def make_uv_data(config='config.xml', num_rows=1, uu_data=None, vv_data=None, ww
     weights_format = '%iE' % weights_nbits
     weights_dtype = '%ifloat32' % weights_nbits
 
-    if flux_data == None:  flux_data = np.zeros(num_rows, dtype=flux_dtype)
-    if weights_data == None: weights_data = np.zeros(num_rows, dtype=weights_dtype)
+    if flux_data is None:  flux_data = np.zeros(num_rows, dtype=flux_dtype)
+    if weights_data is None: weights_data = np.zeros(num_rows, dtype=weights_dtype)
 
     c.append(pf.Column(name='FLUX', format=flux_format, unit='UNCALIB', array=flux_data))
 
@@ -599,6 +666,67 @@ def make_uv_data(config='config.xml', num_rows=1, uu_data=None, vv_data=None, ww
     return tblhdu
 
 
+class BinTableWriter(object):
+    """ Streams the rows of a binary table HDU to the end of a FITS file
+  
+  The table header is written first. Rows are then appended in chunks with write(),
+  so the full table never needs to be held in memory. On close(), the data are padded
+  to a whole number of 2880-byte FITS blocks and NAXIS2 in the header is updated to
+  the number of rows written.
+  
+  Parameters
+  ----------
+  fileobj: file
+    FITS file opened in 'r+b' mode. The table is appended after its last HDU.
+  tblhdu: pf.BinTableHDU
+    Table to take header and row format from, e.g. make_uv_data(num_rows=1).
+    Its data are not written.
+  chunk_bytes: int
+    Approximate size of each block of rows written to disk. Defaults to 64 MiB.
+  """
+    chunk_bytes = 64 * 2**20
+
+    def __init__(self, fileobj, tblhdu, chunk_bytes=None):
+        self.fileobj = fileobj
+        self.header  = tblhdu.header.copy()
+        self.dtype   = tblhdu.data.dtype.newbyteorder('>')
+        self.n_rows  = 0
+        if chunk_bytes is not None:
+            self.chunk_bytes = chunk_bytes
+        self.chunk_rows = max(1, self.chunk_bytes / self.dtype.itemsize)
+
+        self.fileobj.seek(0, os.SEEK_END)
+        self.header_offset = self.fileobj.tell()
+        self.fileobj.write(self.header.tostring())
+
+    def write(self, columns):
+        """ Append rows to the table
+    
+    columns: dict
+      Column name -> array of values, one entry per row. All columns must have the
+      same number of rows. Table columns that are missing are written as zeros.
+    """
+        n_rows = len(columns.values()[0])
+        for start in xrange(0, n_rows, self.chunk_rows):
+            stop = min(start + self.chunk_rows, n_rows)
+            rows = np.zeros(stop - start, dtype=self.dtype)
+            for k in self.dtype.names:
+                if k in columns:
+                    rows[k] = columns[k][start:stop]
+            self.fileobj.write(rows.tostring())
+            self.n_rows += stop - start
+
+    def close(self):
+        """ Pad the table to a FITS block boundary, update NAXIS2 and close the file """
+        n_bytes = self.n_rows * self.dtype.itemsize
+        self.fileobj.write('\0' * ((2880 - n_bytes % 2880) % 2880))
+
+        self.header['NAXIS2'] = self.n_rows
+        self.fileobj.seek(self.header_offset)
+        self.fileobj.write(self.header.tostring())
+        self.fileobj.close()
+
+
 def make_interferometer_model(config='config.xml', num_rows=1):
     """
   Creates a vanilla INTERFEROMETER_MODEL table HDU.
@@ -1130,15 +1258,15 @@ def make_calibration(config='config.xml', num_rows=1, date=None, delaya_data=Non
     params = parseConfig('PARAMETERS', config)
     cards = parseConfig('CALIBRATION', config)
     common = parseConfig('COMMON', config)
-    if date != None:
+    if date is not None:
         cards['DATE-GEN'] = date
     
     an_data = np.arange(1, num_rows+1)
     ar_data = np.ones(num_rows)
-    if delaya_data == None: delaya_data = np.zeros(num_rows)
-    if phasea_data == None: phasea_data = np.zeros(num_rows)
-    if delayb_data == None: delayb_data = np.zeros(num_rows)
-    if phaseb_data == None: phaseb_data = np.zeros(num_rows)
+    if delaya_data is None: delaya_data = np.zeros(num_rows)
+    if phasea_data is None: phasea_data = np.zeros(num_rows)
+    if delayb_data is None: delayb_data = np.zeros(num_rows)
+    if phaseb_data is None: phaseb_data = np.zeros(num_rows)
     
     c = []
     c.append(pf.Column(name='ANTENNA_NO', format='1J', array=an_data.astype(np.int32)))
@@ -8,10 +8,14 @@ also capable of grouping/combining files that were taken at the same time.
 
 import gc
 import os
+import errno
 import re
 import sys
 import numpy
 import getopt
+import resource
+import traceback
+import multiprocessing
 from datetime import datetime
 
 from interfits.lib import coords
@@ -45,6 +49,13 @@ Options:
                        option (Default = 2)
 -d, --disable-phasing  Disable applying the cable delays and phasing to zenith
                        (Default = apply both)
+-j, --jobs             Number of file groups to process in parallel, one worker
+                       process per group; 0 uses all CPUs (Default = 0)
+-m, --memory           Memory budget per worker process in MB; this also limits
+                       the number of workers to what fits in physical memory
+                       (Default = 4096)
+    --sequential       Process all groups one at a time in this process, the
+                       same as -j 1
                        
 Notes: 
   1) If none of -t/--total-power, -s/--switching, or -a/--average are specifed 
@@ -54,6 +65,16 @@ Notes:
   
   3) If cable delays are applied to the data then the resulting FITS IDI files
   will contain a CALIBRATION table that records what delays were applied.
+  
+  4) When running in parallel a group that exceeds the memory budget fails 
+  with an out of memory error, which is reported at the end, and the other 
+  groups carry on.  The budget caps the address space of the worker, so it 
+  is in addition to the size of the group's input files, which are memory-
+  mapped, and to the (shared) libraries already loaded.
+  
+  5) A group that fails, in parallel or in sequential mode, is reported at the
+  end and the other groups carry on.  The script then exits with status 1 if
+  any group failed.
 """
 	
 	if exitCode is not None:
@@ -72,11 +93,13 @@ def parseConfig(args):
 	config['tDecim'] = 5
 	config['sDecim'] = 2
 	config['applyPhasing'] = True
+	config['jobs'] = 0
+	config['memory'] = 4096
 	config['args'] = []
 	
 	# Read in and process the command line flags
 	try:
-		opts, arg = getopt.getopt(args, "htsap:f:d", ["help", "total-power", "switching", "average", "time-decimation=", "freq-decimation=", "disable-phasing"])
+		opts, arg = getopt.getopt(args, "htsap:f:dj:m:", ["help", "total-power", "switching", "average", "time-decimation=", "freq-decimation=", "disable-phasing", "jobs=", "memory=", "sequential"])
 	except getopt.GetoptError, err:
 		# Print help information and exit:
 		print str(err) # will print something like "option -a not recognized"
@@ -101,6 +124,12 @@ def parseConfig(args):
 			config['sDecim'] = int(value)
 		elif opt in ('-d', '--disable-phasing'):
 			config['applyPhasing'] = False
+		elif opt in ('-j', '--jobs'):
+			config['jobs'] = int(value)
+		elif opt in ('-m', '--memory'):
+			config['memory'] = int(value)
+		elif opt in ('--sequential',):
+			config['jobs'] = 1
 		else:
 			assert False
 			
@@ -225,16 +254,288 @@ def getStaticBaselines(ifi, stands=[35, 257, 259]):
 	return blsToKeep
 
 
+def inspectFile(filename):
+	"""
+	Return a (filename, metadata) tuple for the provided file.
+	"""
+	
+	uvw = LedaFits(verbose=False)
+	return (filename, uvw.inspectFile(filename))
+
+
+def processGroup(config, group):
+	"""
+	Read in, combine, and export the files in a group, where a group is a 
+	[start time, filenames, frequency ranges] list.  Returns a list of the 
+	FITS IDI files created.
+	"""
+	
+	outnames = []
+	
+	## Read in the files
+	uvws = []
+	for filename in group[1]:
+		uvws.append( LedaFits(filename, verbose=False) )
+		
+	## Build the output name
+	obsDate = datetime.strptime(uvws[0].date_obs, "%Y-%m-%dT%H:%M:%S")
+	if len(group[1]) > 1:
+		outname = "%s_%s_%s_comb%i.FITS_" % (uvws[0].instrument, uvws[0].telescope, obsDate.strftime("%Y%m%d%H%M%S"), len(uvws))
+	else:
+		obsFreq = int((uvws[0].formatFreqs()).mean() / 1e6)
+		outname = "%s_%s_%s_%iMHz.FITS_" % (uvws[0].instrument, uvws[0].telescope, obsDate.strftime("%Y%m%d%H%M%S"), obsFreq)
+	print "  -> group file basename will be '%s*'" % outname
+	
+	## Make a note of lowest frequency value
+	freq_min = numpy.min(uvws[0].formatFreqs())
+	
+	## Concatenate together the various FLUX sets
+	if len(uvws) > 1:
+		timeBL = uvws[0].d_uv_data["FLUX"].shape[0]
+		freqPolComp = uvws[0].d_uv_data["FLUX"].shape[1]
+		new_uv_data = numpy.zeros((timeBL, freqPolComp*len(group[1])), dtype=uvws[0].d_uv_data["FLUX"].dtype)
+		for i,uvw in enumerate(uvws):
+			new_uv_data[:,i*freqPolComp:(i+1)*freqPolComp] = uvw.d_uv_data["FLUX"]
+		uvws[0].d_uv_data["FLUX"] = new_uv_data
+		
+	## Overwrite frequency axis keywords so that we can export UV_DATA table correctly
+	uvws[0].h_common["REF_FREQ"] = freq_min
+	uvws[0].h_common["REF_PIXL"] = 1
+	uvws[0].h_common["NO_CHAN"]  *= len(group[1])
+	uvws[0].h_params["NCHAN"] = uvws[0].h_common["NO_CHAN"] 
+	uvws[0].d_frequency["TOTAL_BANDWIDTH"]  *= len(group[1])
+	
+	## Remove the other LedaFits instances since we only need the first one now
+	while len(uvws) > 1:
+		del uvws[-1]
+		
+	## Add in the UVW coordinates
+	uvws[0].generateUVW(src='ZEN', use_stored=False, update_src=True)
+	
+	if config['applyPhasing']:
+		## Apply the cable delays
+		uvws[0].apply_cable_delays()
+		
+		## Phase to zenith
+		uvws[0].phase_to_src(src='ZEN')
+	else:
+		## Update the outname to reflect the fact that no phasing as been applied
+		outname = "%sNoPhasing_" % outname
+		
+	## Save
+	if config['fullRes']:
+		### Extract all possible baselines
+		bls = getAllBaselines(uvws[0])
+		uvws[0].select_baselines(bls)
+		
+		### Verify
+		uvws[0].verify()
+		
+		### Save as FITS IDI
+		uvws[0].exportFitsidi(outname+'1')
+		outnames.append(outname+'1')
+		
+		### Cleanup the associated XML file
+		try:
+			xmlname = outname+'1.xml'
+			os.unlink(xmlname)
+		except OSError:
+			pass
+			
+	if config['totalPower']:
+		### Extract the total power at full resolution
+		bls = getTotalPowerBaselines(uvws[0])
+		uvws[0].select_baselines(bls)
+		
+		### Verify
+		uvws[0].verify()
+		
+		### Save as FITS IDI
+		uvws[0].exportFitsidi(outname+'TP')
+		outnames.append(outname+'TP')
+		
+		### Cleanup the associated XML file
+		try:
+			xmlname = outname+'TP.xml'
+			os.unlink(xmlname)
+		except OSError:
+			pass
+			
+	if config['switching']:
+		### Extract the switching baselines at full resolution
+		bls = getSwitchingBaselines(uvws[0])
+		uvws[0].select_baselines(bls)
+		
+		### Verify
+		uvws[0].verify()
+		
+		### Save as FITS IDI
+		uvws[0].exportFitsidi(outname+'SW')
+		outnames.append(outname+'SW')
+		
+		### Cleanup the associated XML file
+		try:
+			xmlname = outname+'SW.xml'
+			os.unlink(xmlname)
+		except OSError:
+			pass
+			
+	if config['average']:
+		### Extract the static baselines
+		bls = getStaticBaselines(uvws[0])
+		uvws[0].select_baselines(bls)
+		
+		### Decimate within a try...expect block to deal with bad decimation parameters
+		try:
+			uvws[0].average_time_frequency(config['tDecim'], config['sDecim'], mode='nearest', in_place=True)
+		except ValueError, e:
+			print "ERROR: %s, skipping" % str(e)
+			return outnames
+			
+		### Verify
+		uvws[0].verify()
+		
+		### Save as FITS IDI
+		uvws[0].exportFitsidi(outname+'AV')
+		outnames.append(outname+'AV')
+		
+		### Cleanup the associated XML file
+		try:
+			xmlname = outname+'AV.xml'
+			os.unlink(xmlname)
+		except OSError:
+			pass
+			
+	## Cleanup
+	del uvws[0]
+	gc.collect()
+	
+	return outnames
+
+
+def getWorkerCount(config, nTasks):
+	"""
+	Return the number of worker processes to use for nTasks tasks, based on the 
+	requested number of jobs and on how many per-worker memory budgets fit into 
+	the physical memory of the machine.
+	"""
+	
+	nWorkers = config['jobs']
+	if nWorkers <= 0:
+		nWorkers = multiprocessing.cpu_count()
+		
+	try:
+		physMem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+		nWorkers = min(nWorkers, max(1, physMem / (config['memory']*1024**2)))
+	except (AttributeError, ValueError, OSError):
+		## Cannot tell how much memory there is
+		pass
+		
+	return max(1, min(nWorkers, nTasks))
+
+
+# Set in pool worker processes (see _initWorker), where each group task runs 
+# with a capped address space
+_inWorker = False
+
+
+def _initWorker():
+	"""
+	Pool initializer that marks the process as a worker.
+	"""
+	
+	global _inWorker
+	_inWorker = True
+
+
+def _limitAddressSpace(config, group):
+	"""
+	Cap the address space (RLIMIT_AS) of a worker process so that a group that 
+	is too large fails with a MemoryError instead of taking the whole machine 
+	(and the other workers) down with it.
+	
+	RLIMIT_AS counts virtual memory rather than resident memory, so the cap is 
+	the per-worker budget plus the address space the process already uses (the 
+	interpreter and shared libraries) plus the size of the group's input files, 
+	which are memory-mapped when read.  The budget is therefore approximate.
+	"""
+	
+	try:
+		statm = open('/proc/self/statm').read().split()
+		inUse = int(statm[0]) * os.sysconf('SC_PAGE_SIZE')
+	except (IOError, IndexError, ValueError, OSError):
+		## Cannot tell (not Linux), so leave some room for the libraries
+		inUse = 1024**3
+	mapped = sum([os.path.getsize(filename) for filename in group[1]])
+	memoryLimit = config['memory']*1024**2 + inUse + mapped
+	
+	try:
+		soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+		if hard != resource.RLIM_INFINITY:
+			memoryLimit = min(memoryLimit, hard)
+		resource.setrlimit(resource.RLIMIT_AS, (memoryLimit, hard))
+	except (AttributeError, ValueError, resource.error):
+		## Not supported on this platform; rely on the worker count alone
+		pass
+
+
+def _processGroupTask(task):
+	"""
+	Wrapper around processGroup that returns a (group index, FITS IDI files, 
+	error) tuple.  Errors are returned rather than raised so that one bad group 
+	does not stop the others.
+	"""
+	
+	i, config, group = task
+	try:
+		if _inWorker:
+			## Each worker only processes one group (maxtasksperchild=1)
+			_limitAddressSpace(config, group)
+		return i, processGroup(config, group), None
+	except Exception, e:
+		## Running out of address space shows up as a MemoryError, or as ENOMEM 
+		## from things like mmap
+		if isinstance(e, MemoryError) or getattr(e, 'errno', None) == errno.ENOMEM:
+			return i, [], "out of memory (budget is %i MB per worker)" % config['memory']
+		return i, [], traceback.format_exc()
+
+
+def _startPool(config, nTasks, report=True, **kwds):
+	"""
+	Start a pool of worker processes for nTasks tasks (see getWorkerCount).  
+	Returns None if the tasks should be run sequentially instead, which is 
+	reported if report is True.
+	"""
+	
+	nWorkers = getWorkerCount(config, nTasks)
+	if nWorkers > 1:
+		try:
+			pool = multiprocessing.Pool(nWorkers, _initWorker, **kwds)
+			if report:
+				print "Using %i worker processes" % nWorkers
+			return pool
+		except (OSError, ValueError), e:
+			print "WARNING: cannot start worker processes (%s), running sequentially" % str(e)
+	elif report and config['jobs'] != 1 and nTasks > 1:
+		print "Running sequentially, only one %i MB worker fits in memory" % config['memory']
+	return None
+
+
 def main(args):
 	# Parse the command line
 	config = parseConfig(args)
 	filenames = config['args']
 	
 	# Inspect the files to try and figure out what is what
-	metadataList = []
-	for filename in filenames:
-		uvw = LedaFits(verbose=False)
-		metadataList.append( (filename, uvw.inspectFile(filename)) )
+	pool = _startPool(config, len(filenames), report=False)
+	if pool is not None:
+		try:
+			metadataList = pool.map(inspectFile, filenames)
+		finally:
+			pool.terminate()
+			pool.join()
+	else:
+		metadataList = [inspectFile(filename) for filename in filenames]
 		
 	# Group the files by start time and save the filenames and frequency ranges
 	groups = []
@@ -294,147 +595,42 @@ def main(args):
 	print " "
 	
 	# Combine
+	tasks = []
 	for i,(valid,group) in enumerate(zip(validity,groups)):
-		print "Combining group #%i..." % (i+1,)
-		
 		## Jump over invalid groups
 		if not valid:
+			print "Combining group #%i..." % (i+1,)
 			print "  -> invalid, skipping"
 			continue
-			
-		## Read in the files
-		uvws = []
-		for filename in group[1]:
-			uvws.append( LedaFits(filename, verbose=False) )
-			
-		## Build the output name
-		obsDate = datetime.strptime(uvws[0].date_obs, "%Y-%m-%dT%H:%M:%S")
-		if len(group[1]) > 1:
-			outname = "%s_%s_%s_comb%i.FITS_" % (uvws[0].instrument, uvws[0].telescope, obsDate.strftime("%Y%m%d%H%M%S"), len(uvws))
-		else:
-			obsFreq = int((uvws[0].formatFreqs()).mean() / 1e6)
-			outname = "%s_%s_%s_%iMHz.FITS_" % (uvws[0].instrument, uvws[0].telescope, obsDate.strftime("%Y%m%d%H%M%S"), obsFreq)
-		print "  -> group file basename will be '%s*'" % outname
-		
-		## Make a note of lowest frequency value
-		freq_min = numpy.min(uvws[0].formatFreqs())
+		tasks.append( (i, config, group) )
 		
-		## Concatenate together the various FLUX sets
-		if len(uvws) > 1:
-			timeBL = uvws[0].d_uv_data["FLUX"].shape[0]
-			freqPolComp = uvws[0].d_uv_data["FLUX"].shape[1]
-			new_uv_data = numpy.zeros((timeBL, freqPolComp*len(group[1])), dtype=uvws[0].d_uv_data["FLUX"].dtype)
-			for i,uvw in enumerate(uvws):
-				new_uv_data[:,i*freqPolComp:(i+1)*freqPolComp] = 1.0*uvw.d_uv_data["FLUX"]
-			uvws[0].d_uv_data["FLUX"] = new_uv_data
-			
-		## Overwrite frequency axis keywords so that we can export UV_DATA table correctly
-		uvws[0].h_common["REF_FREQ"] = freq_min
-		uvws[0].h_common["REF_PIXL"] = 1
-		uvws[0].h_common["NO_CHAN"]  *= len(group[1])
-		uvws[0].h_params["NCHAN"] = uvws[0].h_common["NO_CHAN"] 
-		uvws[0].d_frequency["TOTAL_BANDWIDTH"]  *= len(group[1])
-		
-		## Remove the other LedaFits instances since we only need the first one now
-		while len(uvws) > 1:
-			del uvws[-1]
-			
-		## Add in the UVW coordinates
-		uvws[0].generateUVW(src='ZEN', use_stored=False, update_src=True)
-		
-		if config['applyPhasing']:
-			## Apply the cable delays
-			uvws[0].apply_cable_delays()
+	# Process the valid groups, in a pool sized for the number of groups
+	pool = _startPool(config, len(tasks), maxtasksperchild=1)
+	if pool is not None:
+		## One fresh worker process per group
+		try:
+			print "Combining %i groups in parallel with %i MB per worker..." % (len(tasks), config['memory'])
+			results = pool.map_async(_processGroupTask, tasks, chunksize=1).get(86400*365)
+		finally:
+			pool.terminate()
+			pool.join()
+	else:
+		results = []
+		for task in tasks:
+			print "Combining group #%i..." % (task[0]+1,)
+			results.append( _processGroupTask(task) )
 			
-			## Phase to zenith
-			uvws[0].phase_to_src(src='ZEN')
+	print " "
+	print "Summary:"
+	for i,outnames,error in sorted(results):
+		if error is None:
+			print "  Group #%i -> %s" % (i+1, ', '.join(outnames))
 		else:
-			## Update the outname to reflect the fact that no phasing as been applied
-			outname = "%sNoPhasing_" % outname
-			
-		## Save
-		if config['fullRes']:
-			### Extract all possible baselines
-			bls = getAllBaselines(uvws[0])
-			uvws[0].select_baselines(bls)
-			
-			### Verify
-			uvws[0].verify()
+			print "  Group #%i -> FAILED: %s" % (i+1, error)
 			
-			### Save as FITS IDI
-			uvws[0].exportFitsidi(outname+'1')
-			
-			### Cleanup the associated XML file
-			try:
-				xmlname = outname+'1.xml'
-				os.unlink(xmlname)
-			except OSError:
-				pass
-				
-		if config['totalPower']:
-			### Extract the total power at full resolution
-			bls = getTotalPowerBaselines(uvws[0])
-			uvws[0].select_baselines(bls)
-			
-			### Verify
-			uvws[0].verify()
-			
-			### Save as FITS IDI
-			uvws[0].exportFitsidi(outname+'TP')
-			
-			### Cleanup the associated XML file
-			try:
-				xmlname = outname+'TP.xml'
-				os.unlink(xmlname)
-			except OSError:
-				pass
-				
-		if config['switching']:
-			### Extract the switching baselines at full resolution
-			bls = getSwitchingBaselines(uvws[0])
-			uvws[0].select_baselines(bls)
-			
-			### Verify
-			uvws[0].verify()
-			
-			### Save as FITS IDI
-			uvws[0].exportFitsidi(outname+'SW')
-			
-			### Cleanup the associated XML file
-			try:
-				xmlname = outname+'SW.xml'
-				os.unlink(xmlname)
-			except OSError:
-				pass
-				
-		if config['average']:
-			### Extract the static baselines
-			bls = getStaticBaselines(uvws[0])
-			uvws[0].select_baselines(bls)
-			
-			### Decimate within a try...expect block to deal with bad decimation parameters
-			try:
-				uvws[0].average_time_frequency(config['tDecim'], config['sDecim'], mode='nearest')
-			except ValueError, e:
-				print "ERROR: %s, skipping" % str(e)
-				continue
-				
-			### Verify
-			uvws[0].verify()
-			
-			### Save as FITS IDI
-			uvws[0].exportFitsidi(outname+'AV')
-			
-			### Cleanup the associated XML file
-			try:
-				xmlname = outname+'AV.xml'
-				os.unlink(xmlname)
-			except OSError:
-				pass
-				
-		## Cleanup
-		del uvws[0]
-		gc.collect()
+	# Make failures visible to whatever is driving the conversion
+	if [error for i,outnames,error in results if error is not None]:
+		sys.exit(1)
 
 
 if __name__ == "__main__":
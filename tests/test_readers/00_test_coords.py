@@ -3,6 +3,8 @@
 from test_main import *
 
 import time
+import ephem
+from datetime import datetime
 from interfits.lib import coords
 import numpy as np
 
@@ -48,6 +50,88 @@ def test_computeBaselineVectors():
     bls = coords.computeBaselineVectors(xyz, autocorrs=False)
     assert bls.shape == (5 * (5 - 1) / 2, 3)    
          
+def test_computeUVW_batched():
+    """ UVW for an array of hour angles should match one-at-a-time computation """
+    xyz = np.array([
+        [1, 2, 3],
+        [2, 3, 3],
+        [2, 1, 4],
+        [8, 1, 2],
+        [7,1, 8.1]
+        ], dtype='float64')
+    bls = coords.computeBaselineVectors(xyz)
+
+    H, d = np.linspace(-1, 1, 7), np.deg2rad(4.56)
+    uvw = coords.computeUVW(bls, H, d)
+    assert uvw.shape == (len(H), len(bls), 3)
+    for ii in range(len(H)):
+        assert np.allclose(uvw[ii], coords.computeUVW(bls, H[ii], d))
+
+    # Per-integration declinations broadcast against the hour angles
+    d = np.linspace(0.1, 0.5, 7)
+    uvw = coords.computeUVW(bls, H, d, conjugate=True)
+    assert uvw.shape == (len(H), len(bls), 3)
+    for ii in range(len(H)):
+        assert np.allclose(uvw[ii], coords.computeUVW(bls, H[ii], d[ii], conjugate=True))
+    assert np.allclose(bls[1], xyz[0] - xyz[1])
+
+def test_baseline_conversion():
+    """ Vectorized baseline ID <-> antenna conversion, including MIRIAD IDs """
+    bls, ant_arr = coords.generateBaselineIds(260)
+    ant1, ant2 = coords.baselineToAntennas(bls)
+    assert np.all(ant1 == np.array(ant_arr)[:, 0])
+    assert np.all(ant2 == np.array(ant_arr)[:, 1])
+    assert np.all(coords.antennasToBaseline(ant1, ant2) == bls)
+    assert coords.baselineToAntennas(256 * 2048 + 257 + 65536) == (256, 257)
+    assert coords.antennasToBaseline(3, 4) == 3 * 256 + 4
+
+def test_generateBaselineIds():
+    """ Baseline IDs come back as cached, read-only arrays """
+    for autocorrs in (True, False):
+        bls, ant_arr = coords.generateBaselineIds(260, autocorrs=autocorrs)
+        n_bl = 260 * 259 / 2 + (260 if autocorrs else 0)
+        assert bls.shape == (n_bl,) and ant_arr.shape == (n_bl, 2)
+        assert np.all(ant_arr[:, 0] <= ant_arr[:, 1])
+        assert not bls.flags.writeable and not ant_arr.flags.writeable
+        assert coords.generateBaselineIds(260, autocorrs=autocorrs)[0] is bls
+
+        bl_list, ant_list = coords.generateBaselineIdList(260, autocorrs=autocorrs)
+        assert bl_list == bls.tolist() and ant_list[-1] == tuple(ant_arr[-1])
+
+def test_baseline_index():
+    bls, ant_arr = coords.generateBaselineIds(8)
+    table = np.tile(bls, 4)
+    index = coords.BaselineIndex(table)
+    assert index.n_bls == len(bls) and index.n_int == 4 and index.regular
+    rows = index.antenna_rows(3)
+    assert np.all(rows == np.flatnonzero(np.in1d(table, index.search(3))))
+    assert np.all(table[index.rows([3 * 256 + 5])] == 3 * 256 + 5)
+    assert index.get_offset(2 * 256 + 2) == np.flatnonzero(bls == 2 * 256 + 2)[0]
+
+def test_julian_dates():
+    """ DATE should be midnight on the day of the timestamp, with TIME in days since """
+    for tstring in ("2014-05-13T03:00:01", "2014-05-13T16:53:20"):
+        jd, jt = coords.convertToJulianTuple(tstring)
+        assert jd == 2456790.5 and 0 <= jt < 1
+
+    t_offsets = np.arange(10) * 9.0
+    date, jtime = coords.convertToJulianArrays("2014-05-13T16:53:20", t_offsets, 3)
+    assert date.dtype == jtime.dtype == np.float64
+    assert len(date) == len(jtime) == 30 and np.all(date == jd)
+    assert np.allclose(jtime[::3], jt + t_offsets / 86400.0)
+
+def test_computeLST():
+    """ Vectorized LST should track ephem, stepped one timestamp at a time """
+    site = ephem.Observer()
+    site.lon, site.lat = '-118.28', '37.24'
+    ts = 1400000000.0 + np.arange(0, 86400, 3600.0)
+    lst = coords.computeLST(ts, site)
+    assert lst.shape == ts.shape and np.isscalar(coords.computeLST(ts[0], site))
+    for ii in range(len(ts)):
+        site.date = datetime.utcfromtimestamp(ts[ii])
+        lst_ephem = np.rad2deg(float(site.sidereal_time()))
+        assert abs((lst[ii] - lst_ephem + 180) % 360 - 180) < 1e-4
+
 def test_coordTransform():
     """ Test of coordTransform() function
     """
@@ -79,6 +163,12 @@ def test_coordTransform():
 if __name__ == "__main__":
     test_coords()
     test_computeBaselineVectors()
+    test_computeUVW_batched()
+    test_baseline_conversion()
+    test_generateBaselineIds()
+    test_baseline_index()
+    test_julian_dates()
+    test_computeLST()
     test_coordTransform()
     
 
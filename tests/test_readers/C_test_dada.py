@@ -0,0 +1,249 @@
+#! /usr/bin/env python
+# encoding: utf-8
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+import pyfits as pf
+import h5py
+from interfits.lib import dada, coords
+from interfits.lib.dada import DadaReader
+
+class DummyReader(DadaReader):
+    """ DadaReader with header values set directly (no file needed) """
+    def __init__(self, n_station, n_pol=2):
+        self.n_station  = n_station
+        self.n_pol      = n_pol
+        self.n_input    = n_station * n_pol
+        self.n_ant      = n_station
+        self.data_order = 'REG_TILE_TRIANGULAR_2x2'
+        self.dtype      = np.float32
+
+def test_compute_matrix_indexes():
+    for n_station in (8, 32, 64):
+        d = DummyReader(n_station)
+        d.compute_matrix_indexes()
+
+        rows = np.zeros(d.matlen, dtype=np.uint32)
+        cols = np.zeros(d.matlen, dtype=np.uint32)
+        for ii in range(d.matlen):
+            rows[ii], cols[ii] = d.reg_tile_triangular_coords(ii, 2, 2)
+
+        assert np.all(d.matrows == rows)
+        assert np.all(d.matcols == cols)
+        assert not d.matrows.flags.writeable
+
+def test_matrix_index_cache():
+    cache_dir = tempfile.mkdtemp()
+    dada._matrix_index_cache.clear()
+    d = DummyReader(16)
+    d.compute_matrix_indexes(cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Should now be reloaded from disk
+    dada._matrix_index_cache.clear()
+    d2 = DummyReader(16)
+    d2.compute_matrix_indexes(cache_dir=cache_dir)
+    assert np.all(d.matrows == d2.matrows)
+    assert np.all(d.matcols == d2.matcols)
+
+    # And then from memory
+    d3 = DummyReader(16)
+    d3.compute_matrix_indexes()
+    assert d3.matrows is d2.matrows
+
+def test_raw_to_flux():
+    d = DummyReader(16)
+    d.compute_matrix_indexes()
+    raw = np.random.random((3, 2, 4, d.matlen)).astype('float32')
+
+    # Compare against conversion via the full visibility matrix
+    vis = d.transform_raw_data(raw.copy(), 3)
+    l = LedaFits()
+    l.n_ant = d.n_ant
+    flux_vis = l._vis_matrix_to_flux(vis)
+
+    flux = d.raw_to_flux(raw, 3)
+    assert flux.shape == flux_vis.shape
+    assert np.all(flux == flux_vis)
+
+def test_input_map():
+    d = DummyReader(16)
+    d.compute_matrix_indexes()
+    raw = np.random.random((2, 2, 4, d.matlen)).astype('float32')
+    vis = d.transform_raw_data(raw.copy(), 2)
+    l = LedaFits()
+    l.n_ant = d.n_ant
+
+    # Swapping two antennas (both pols) should just swap their baselines
+    input_map = {"2A": "9A", "2B": "9B", "9A": "2A", "9B": "2B"}
+    d.input_map = dada.input_map_to_permutation(input_map, d.n_station)
+    d.compute_flux_indexes()
+    flux = d.raw_to_flux(raw, 2)
+    assert np.allclose(flux, l._vis_matrix_to_flux(vis, input_map=input_map))
+
+    bls = coords.generateBaselineIdList(d.n_ant)[0]
+    flux_orig = l._vis_matrix_to_flux(vis)
+    assert np.all(flux[bls.index(5 * 256 + 5)] == flux_orig[bls.index(5 * 256 + 5)])
+    assert np.all(flux[bls.index(2 * 256 + 2)] == flux_orig[bls.index(9 * 256 + 9)])
+    assert np.all(flux[bls.index(1 * 256 + 9)] == flux_orig[bls.index(1 * 256 + 2)])
+
+def test_memmap_read():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=5)
+
+    d_mm = DadaReader(filename, memmap=True)
+    d_ea = DadaReader(filename)
+    assert isinstance(d_mm.raw, np.memmap)
+    assert d_ea.raw is None
+    assert d_mm.raw.shape[0] == 5
+
+    # The eagerly unpacked visibility matrix should match the mapped data
+    assert np.all(d_mm.read_data(0, 5) == d_ea.data)
+    for first_int, n_int in ((0, 5), (0, 1), (2, 2), (4, 1)):
+        assert np.all(d_mm.read_raw(first_int, n_int) == d_ea.read_raw(first_int, n_int))
+        assert np.all(d_mm.read_flux(first_int, n_int) == d_ea.read_flux(first_int, n_int))
+
+def test_iter_integrations():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=5)
+    d = DadaReader(filename, memmap=True)
+
+    for mode, read in (('raw', d.read_raw), ('vis', d.read_data), ('flux', d.read_flux)):
+        blocks = list(d.iter_integrations(chunk=2, mode=mode))
+        # Last block holds the single remaining integration
+        assert [ii for ii, data in blocks] == [0, 2, 4]
+        assert np.all(blocks[-1][1] == read(4, 1))
+        full = read(0, 5)
+        assert np.all(np.concatenate([data for ii, data in blocks]) == full)
+
+    # Iterating over a sub-range stops at the end of the range
+    blocks = list(d.iter_integrations(chunk=2, first_int=1, n_int=3, mode='raw'))
+    assert [ii for ii, data in blocks] == [1, 3]
+    assert np.all(np.concatenate([data for ii, data in blocks]) == d.read_raw(1, 3))
+
+def test_iter_dada():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=5)
+
+    full = LedaFits(filename, verbose=False)
+    l = LedaFits(verbose=False)
+    l.filename = filename
+    flux, tt = [], []
+    for first_int, n_int in l.iterDada(chunk=2):
+        assert n_int == (1 if first_int == 4 else 2)
+        flux.append(l.d_uv_data["FLUX"])
+        tt.append(l.d_uv_data["DATE"] + l.d_uv_data["TIME"])
+
+    assert np.all(np.concatenate(flux) == full.d_uv_data["FLUX"])
+    assert np.allclose(np.concatenate(tt), full.d_uv_data["DATE"] + full.d_uv_data["TIME"],
+                       rtol=0, atol=1e-3 / 86400)
+
+def test_convert_dada_hdf5():
+    dirname = os.path.join(tempfile.mkdtemp())
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=5)
+
+    full = LedaFits(filename, verbose=False)
+    l = LedaFits(verbose=False)
+    l.filename = filename
+    l.convertDada(os.path.join(dirname, 'test.h5'), chunk=2)
+
+    h = LedaFits(os.path.join(dirname, 'test.h5'), verbose=False)
+    assert np.all(h.d_uv_data["FLUX"] == full.d_uv_data["FLUX"])
+    assert np.all(h.d_uv_data["BASELINE"] == full.d_uv_data["BASELINE"])
+    assert np.allclose(h.d_uv_data["DATE"] + h.d_uv_data["TIME"],
+                       full.d_uv_data["DATE"] + full.d_uv_data["TIME"], rtol=0, atol=1e-3 / 86400)
+
+def test_convert_dada_fitsidi_flags():
+    dirname = os.path.join(tempfile.mkdtemp())
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=5)
+
+    full = LedaFits(filename, verbose=False)
+    full.write_flags = True
+    full.flag_antenna(3)
+    full.exportFitsidi(os.path.join(dirname, 'full.fitsidi'))
+
+    l = LedaFits(verbose=False)
+    l.filename = filename
+    l.write_flags = True
+    l.flag_antenna(3)
+    l.convertDada(os.path.join(dirname, 'test.fitsidi'), chunk=2)
+
+    # FLAG follows UV_DATA, as written by exportFitsidi
+    hdus = pf.open(os.path.join(dirname, 'test.fitsidi'))
+    hdus_full = pf.open(os.path.join(dirname, 'full.fitsidi'))
+    assert [h.name for h in hdus] == [h.name for h in hdus_full]
+    assert hdus[-1].name == 'FLAG'
+    assert np.all(hdus['FLAG'].data['ANTS'] == hdus_full['FLAG'].data['ANTS'])
+    assert np.all(hdus['UV_DATA'].data['FLUX'] == hdus_full['UV_DATA'].data['FLUX'])
+
+def test_convert_dada_hdf5_selection():
+    dirname = os.path.join(tempfile.mkdtemp())
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=5)
+    bls = [1 * 256 + 1, 1 * 256 + 2, 2 * 256 + 5]
+
+    full = LedaFits(filename, verbose=False)
+    full.select_baselines(bls)
+    full.exportHdf5(os.path.join(dirname, 'full.h5'))
+
+    # Every streamed block (not just the first) should have the selection applied
+    l = LedaFits(filename, verbose=False)
+    l.select_baselines(bls)
+    l.convertDada(os.path.join(dirname, 'test.h5'), chunk=2)
+
+    h = h5py.File(os.path.join(dirname, 'test.h5'), 'r')['d_uv_data']
+    h_full = h5py.File(os.path.join(dirname, 'full.h5'), 'r')['d_uv_data']
+    assert h['BASELINE'].shape == (5 * len(bls),)
+    assert np.all(h['BASELINE'][:] == np.tile(bls, 5))
+    for key in ('FLUX', 'UU', 'VV', 'WW'):
+        assert np.all(h[key][:] == h_full[key][:])
+
+def test_append_hdf5_non_row_keys():
+    dirname = os.path.join(tempfile.mkdtemp())
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=2)
+
+    # Scalar and other non-row d_uv_data entries are written once, not appended to
+    l = LedaFits(filename, verbose=False)
+    n_rows = len(l.d_uv_data["BASELINE"])
+    l.d_uv_data["NOTE"] = 7
+    l.d_uv_data["POLS"] = np.arange(4)
+    hdf = l._createHdf5(os.path.join(dirname, 'test.h5'), resizable=True)
+    del l.d_uv_data["NOTE"]
+    l._appendHdf5UvData(hdf["d_uv_data"])
+    hdf.close()
+
+    h = h5py.File(os.path.join(dirname, 'test.h5'), 'r')['d_uv_data']
+    assert h['NOTE'][:] == [7]
+    assert np.all(h['POLS'][:] == np.arange(4))
+    assert h['BASELINE'].shape == (2 * n_rows,)
+    assert np.all(h['FLUX'][n_rows:] == l.d_uv_data["FLUX"])
+
+    # Missing row keys are reported, rather than leaving the datasets with unequal lengths
+    hdf = l._createHdf5(os.path.join(dirname, 'test.h5'), clobber=True, resizable=True)
+    del l.d_uv_data["WW"]
+    try:
+        l._appendHdf5UvData(hdf["d_uv_data"])
+        assert False
+    except KeyError:
+        pass
+    assert hdf["d_uv_data"]["FLUX"].shape[0] == n_rows
+    hdf.close()
+
+if __name__ == '__main__':
+    test_compute_matrix_indexes()
+    test_matrix_index_cache()
+    test_raw_to_flux()
+    test_input_map()
+    test_memmap_read()
+    test_iter_integrations()
+    test_iter_dada()
+    test_convert_dada_hdf5()
+    test_convert_dada_fitsidi_flags()
+    test_convert_dada_hdf5_selection()
+    test_append_hdf5_non_row_keys()
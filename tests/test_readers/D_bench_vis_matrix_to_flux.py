@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark LedaFits._vis_matrix_to_flux against the original per-baseline loop,
+on a synthetic 256-antenna, 109-channel visibility matrix.
+"""
+from test_main import *
+
+import time
+import numpy as np
+from interfits.lib import coords
+
+def vis_matrix_to_flux_loop(vis):
+    """ Original implementation: a Python loop over integrations and baselines """
+    n_int   = vis.shape[0]
+    n_ant   = vis.shape[1]
+    n_chans = vis.shape[3]
+    n_stk   = 4
+    n_bls   = n_ant * (n_ant - 1) / 2 + n_ant
+
+    bls, ant_arr = coords.generateBaselineIds(n_ant)
+    ant_arr0     = np.array(ant_arr) - 1
+    flux         = np.zeros([n_bls * n_int, n_chans * n_stk * 2], dtype='float32')
+
+    for int_num in xrange(n_int):
+        idx = int_num * n_bls
+        vis_int = vis[int_num, ...]
+        for ii in xrange(n_bls):
+            ant1, ant2 = ant_arr0[ii]
+            vv = vis_int[ant1, ant2, ...]
+            xx = vv[:, 0, 0]
+            yy = vv[:, 1, 1]
+            xy = vv[:, 0, 1]
+            yx = vv[:, 1, 0]
+            flux[idx + ii] = np.column_stack((xx, yy, xy, yx)).flatten().view('float32')
+    return flux
+
+def make_vis(n_int=1, n_ant=256, n_chans=109):
+    shape = (n_int, n_ant, n_ant, n_chans, 2, 2)
+    vis = np.random.random(shape).astype('float32') + 1j * np.random.random(shape).astype('float32')
+    return vis.astype('complex64')
+
+def test_vis_matrix_to_flux(n_int=1, n_ant=256, n_chans=109):
+    vis = make_vis(n_int, n_ant, n_chans)
+    l = LedaFits()
+    l.n_ant = n_ant
+
+    t0 = time.time()
+    flux_loop = vis_matrix_to_flux_loop(vis)
+    t1 = time.time()
+    flux = l._vis_matrix_to_flux(vis)
+    t2 = time.time()
+
+    assert np.all(flux == flux_loop)
+    print "Loop:       %2.3fs" % (t1 - t0)
+    print "Vectorized: %2.3fs" % (t2 - t1)
+    print "Speedup:    %2.1fx" % ((t1 - t0) / (t2 - t1))
+
+if __name__ == '__main__':
+    test_vis_matrix_to_flux()
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Compare vectorized geometric phasing and cable delay corrections against the
+original per-row loops, on a small synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+from interfits import ledafits_config
+from interfits.lib import coords
+
+def phase_loop(flux, tgs, freqs, unapply=False):
+    """ Original implementation: a Python loop over UV_DATA rows """
+    w    = 2 * np.pi * freqs # Angular freq
+    flux = flux.copy().view('complex64')
+    for ii in range(len(flux)):
+        p = np.exp(-1j * w * tgs[ii])
+        phase_corrs = np.column_stack((p, p, p, p)).flatten()
+        if unapply:
+            flux[ii] = flux[ii] / phase_corrs
+        else:
+            flux[ii] = flux[ii] * phase_corrs
+    return flux.view('float32')
+
+def cable_delays_loop(flux, tdelts, freqs, n_ant):
+    """ Original implementation: a Python loop over integrations and baselines """
+    bls, ant_arr = coords.generateBaselineIdList(n_ant)
+    w    = 2 * np.pi * freqs # Angular freq
+    flux = flux.copy().view('complex64')
+    delayCorrs = np.zeros((4, len(bls), len(freqs)), dtype=flux.dtype)
+    for ii in range(len(bls)):
+        ant1, ant2 = ant_arr[ii]
+        td1, td2   = tdelts[ant1-1,:], tdelts[ant2-1,:]
+        pxa, pya, pxb, pyb = w * td1[0], w * td1[1], w * td2[0], w * td2[1]
+        delayCorrs[0,ii,:] = np.exp(1j * (pxa - pxb))	# XX
+        delayCorrs[1,ii,:] = np.exp(1j * (pya - pyb))	# YY
+        delayCorrs[2,ii,:] = np.exp(1j * (pxa - pyb))	# XY
+        delayCorrs[3,ii,:] = np.exp(1j * (pya - pxb))	# YX
+
+    n_int = len(flux) / len(bls)
+    for nn in range(n_int):
+        for ii in range(len(bls)):
+            phase_corrs = np.column_stack(delayCorrs[:, ii, :]).flatten()
+            flux[nn*len(bls) + ii] = flux[nn*len(bls) + ii] * phase_corrs
+    return flux.view('float32')
+
+def load_dada():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=3)
+    return LedaFits(filename, verbose=False)
+
+def test_phase_to_src():
+    l = load_dada()
+    flux0 = l.d_uv_data["FLUX"].copy()
+    ww0   = l.d_uv_data["WW"].copy()
+
+    l.phase_to_src('CYG')
+    flux = l.d_uv_data["FLUX"]
+    assert np.any(flux != flux0)
+    assert np.all(flux == phase_loop(flux0, l.d_uv_data["WW"] - ww0, l.formatFreqs()))
+
+    flux1 = flux.copy()
+    ww1   = l.d_uv_data["WW"].copy()
+    l.unphase_to_src('ZEN')
+    assert np.all(l.d_uv_data["FLUX"] ==
+                  phase_loop(flux1, l.d_uv_data["WW"] - ww1, l.formatFreqs(), unapply=True))
+
+def test_unphase_roundtrip():
+    l = load_dada()
+    flux0 = l.d_uv_data["FLUX"].copy()
+    ww0   = l.d_uv_data["WW"].copy()
+
+    # Unphasing applies the inverse of the delays from the current WW to the source
+    l.phase_to_src('CYG')
+    l.d_uv_data["WW"] = ww0
+    l.unphase_to_src('CYG')
+    assert np.allclose(l.d_uv_data["FLUX"], flux0, rtol=1e-5, atol=1e-5)
+
+def test_phase_noncontiguous():
+    l = load_dada()
+    flux0 = l.d_uv_data["FLUX"].copy()
+    ww0   = l.d_uv_data["WW"].copy()
+
+    # Phasing must still update FLUX when it is not a C-contiguous array
+    l.d_uv_data["FLUX"] = np.asfortranarray(flux0)
+    l.phase_to_src('CYG')
+    assert np.all(l.d_uv_data["FLUX"] == phase_loop(flux0, l.d_uv_data["WW"] - ww0, l.formatFreqs()))
+
+def test_apply_cable_delays():
+    l = load_dada()
+    flux0  = l.d_uv_data["FLUX"].copy()
+    tdelts = np.array(l.z_elength["EL"]) / ledafits_config.SPEED_OF_LIGHT
+    flux_loop = cable_delays_loop(flux0, tdelts, l.formatFreqs(), l.n_ant)
+
+    l.apply_cable_delays(debug=False)
+    assert np.any(l.d_uv_data["FLUX"] != flux0)
+    assert np.all(l.d_uv_data["FLUX"] == flux_loop)
+
+    # A non-contiguous FLUX must be corrected too, not a temporary copy of it
+    l = load_dada()
+    l.d_uv_data["FLUX"] = np.asfortranarray(flux0)
+    l.apply_cable_delays(debug=False)
+    assert np.all(l.d_uv_data["FLUX"] == flux_loop)
+
+if __name__ == '__main__':
+    test_phase_to_src()
+    test_unphase_roundtrip()
+    test_phase_noncontiguous()
+    test_apply_cable_delays()
@@ -0,0 +1,84 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Compare the memory-mapped L-file reader against the original loop, on a small
+synthetic .LA / .LC file pair.
+"""
+from test_main import *
+
+import os
+import tempfile
+import numpy as np
+from interfits.lib import coords
+
+N_ANT, N_POL, N_CHANS, N_DUMPS = 4, 2, 5, 6
+
+def make_lfile(filename, seed=1):
+    """ Write random .LA and .LC files, with a partial dump at the end of each """
+    n_antpol = N_ANT * N_POL
+    n_blcc   = n_antpol * (n_antpol - 1) / 2
+    rng = np.random.RandomState(seed)
+    lfa = rng.randn(N_DUMPS * n_antpol * N_CHANS + 3).astype('float32')
+    lfc = rng.randn(N_DUMPS * n_blcc * N_CHANS * 2 + 7).astype('float32')
+    lfa.tofile(filename + '.LA')
+    lfc.tofile(filename + '.LC')
+
+def read_lfile_loop(filename):
+    """ Original implementation: form a visibility matrix, then loop over baselines """
+    n_antpol = N_ANT * N_POL
+    n_blcc   = n_antpol * (n_antpol - 1) / 2
+
+    lfa = np.fromfile(filename + '.LA', dtype='float32')[:N_DUMPS * n_antpol * N_CHANS]
+    lfa = lfa.reshape([N_DUMPS, n_antpol, N_CHANS, 1])
+    lfa = np.concatenate((lfa, np.zeros_like(lfa)), axis=3)
+    lfc = np.fromfile(filename + '.LC', dtype='float32')[:N_DUMPS * n_blcc * N_CHANS * 2]
+    lfc = lfc.reshape([N_DUMPS, n_blcc, N_CHANS, 2])
+
+    vis = np.zeros([N_DUMPS, n_antpol, n_antpol, N_CHANS, 2], dtype='float32')
+    iup = np.triu_indices(n_antpol, 1)
+    idiag = (np.arange(0, n_antpol), np.arange(0, n_antpol))
+    for ii in range(0, vis.shape[0]):
+        vis[ii][iup] = lfc[ii]
+        vis[ii][idiag] = lfa[ii]
+
+    bls, ant_arr = coords.generateBaselineIdList(N_ANT)
+    flux = np.zeros([N_DUMPS * len(bls), N_CHANS * 4 * 2], dtype='float32')
+    for ii in range(len(flux)):
+        dd = ii / len(bls)
+        ant1, ant2 = ant_arr[ii % len(ant_arr)]
+        idx1, idx2 = 2 * (ant1 - 1), 2 * (ant2 - 1)
+        xx = vis[dd, idx1, idx2]
+        yy = vis[dd, idx1 + 1, idx2 + 1]
+        xy = vis[dd, idx1, idx2 + 1]
+        yx = vis[dd, idx1 + 1, idx2]
+        flux[ii] = np.column_stack((xx, yy, xy, yx)).flatten()
+    return flux
+
+def test_read_lfile():
+    filename = os.path.join(tempfile.mkdtemp(), 'test')
+    make_lfile(filename)
+    flux_loop = read_lfile_loop(filename)
+    n_bls = N_ANT * (N_ANT + 1) / 2
+
+    l = LedaFits(verbose=False)
+    l.filename = filename + '.LA'
+    flux, n_dumps = l._readLfile(N_ANT, N_POL, N_CHANS)
+    assert n_dumps == N_DUMPS
+    assert np.all(flux == flux_loop)
+
+    # Sub-ranges, including the first and last dumps, and ranges that overrun the file
+    for first_dump, n_req, n_exp in ((0, 1, 1), (0, 2, 2), (2, 3, 3), (5, 1, 1), (4, 10, 2),
+                                     (3, None, 3), (0, N_DUMPS, N_DUMPS)):
+        flux, n_dumps = l._readLfile(N_ANT, N_POL, N_CHANS, first_dump=first_dump, n_dumps=n_req)
+        assert n_dumps == n_exp
+        assert np.all(flux == flux_loop[first_dump * n_bls:(first_dump + n_exp) * n_bls])
+
+    # Nothing left to read past the last dump
+    try:
+        l._readLfile(N_ANT, N_POL, N_CHANS, first_dump=N_DUMPS)
+        assert False
+    except IOError:
+        pass
+
+if __name__ == '__main__':
+    test_read_lfile()
@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Compare blocked time/frequency averaging (with weights, in_place and block_size)
+against the original unblocked averaging, on a small synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+
+def average_unblocked(uvd, nBL, nFreq, tDec, sDec, weights=None):
+    """ Original implementation: average all integrations at once """
+    nInt  = len(uvd["BASELINE"]) / nBL
+    nOut  = nInt / tDec
+    nRows = nOut * tDec * nBL
+    fKeep = (nFreq / sDec) * sDec
+    shape = (nOut, tDec, nBL)
+
+    out = {}
+    for k in ("UU", "VV", "WW"):
+        out[k] = uvd[k][:nRows].reshape(shape).mean(axis=1).ravel()
+    for k in ("BASELINE", "SOURCE", "FREQID", "DATE", "TIME"):
+        out[k] = np.asarray(uvd[k])[:nRows].reshape(shape)[:, 0, :].ravel()
+    out["INTTIM"] = uvd["INTTIM"][:nRows].reshape(shape).sum(axis=1).ravel()
+
+    flux = uvd["FLUX"][:nRows].reshape(shape + (nFreq, -1, 2))
+    if weights is None:
+        flux = flux.mean(axis=1)
+    else:
+        w = weights[:nRows].reshape(shape)
+        w_sum = w.sum(axis=1)
+        flux = (flux * w[..., np.newaxis, np.newaxis, np.newaxis]).sum(axis=1)
+        flux /= np.where(w_sum > 0, w_sum, 1)[..., np.newaxis, np.newaxis, np.newaxis]
+        flux[w_sum == 0] = 0
+    flux = flux[:, :, :fKeep]
+    flux = flux.reshape(nOut, nBL, nFreq / sDec, sDec, flux.shape[-2], 2).sum(axis=3)
+    out["FLUX"] = flux.reshape(nOut * nBL, -1)
+    return out
+
+def load_dada(n_int):
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=n_int)
+    return LedaFits(filename, verbose=False)
+
+def check_average(n_int, tDec, sDec, mode='exact', weights=False, **kwargs):
+    l = load_dada(n_int)
+    nBL   = l.n_ant * (l.n_ant + 1) / 2
+    nFreq = l.formatFreqs().size
+    w = None
+    if weights:
+        # Flag (zero weight) every row of the first integration, and one baseline throughout
+        w = np.random.RandomState(2).random_sample(len(l.d_uv_data["BASELINE"])).astype('float32')
+        w[:nBL] = 0
+        w[3::nBL] = 0
+
+    uvd = dict((k, np.array(v)) for k, v in l.d_uv_data.items())
+    ref = average_unblocked(uvd, nBL, nFreq, tDec, sDec, weights=w)
+    l.average_time_frequency(tDec, sDec, mode=mode, weights=w, **kwargs)
+    for k in ref:
+        assert l.d_uv_data[k].shape == ref[k].shape
+        if weights and k == "FLUX":
+            assert np.allclose(l.d_uv_data[k], ref[k], rtol=1e-6, atol=1e-6)
+        else:
+            assert np.all(l.d_uv_data[k] == ref[k])
+    assert l.h_common["NO_CHAN"] == nFreq / sDec
+    return l
+
+def test_average():
+    check_average(6, 2, 2)
+    check_average(6, 3, 4, block_size=1)
+    check_average(6, 2, 1, block_size=2)
+    check_average(5, 2, 3, mode='nearest', block_size=2)
+
+def test_average_weights():
+    check_average(6, 2, 2, weights=True)
+    check_average(6, 3, 2, weights=True, block_size=1)
+    check_average(6, 1, 1, weights=True)
+
+def test_average_in_place():
+    check_average(6, 2, 2, in_place=True)
+    check_average(6, 3, 2, in_place=True, block_size=1)
+    check_average(5, 2, 3, mode='nearest', in_place=True, block_size=1)
+    check_average(6, 2, 2, weights=True, in_place=True, block_size=2)
+
+    # FLUX from a dada file is a (phased) view; its buffer is reused and shrunk
+    l = load_dada(6)
+    owner = l.d_uv_data["FLUX"]
+    assert not owner.flags.owndata
+    while owner.base is not None:
+        owner = owner.base
+    n_bytes = owner.nbytes
+    del owner
+    l.average_time_frequency(2, 2, in_place=True)
+    flux = l.d_uv_data["FLUX"]
+    owner = flux
+    while owner.base is not None:
+        owner = owner.base
+    assert owner.nbytes == flux.nbytes == n_bytes / 4
+
+    # The buffer is still written over when other references prevent shrinking it
+    l = load_dada(6)
+    flux_in = l.d_uv_data["FLUX"]
+    l.average_time_frequency(2, 2, in_place=True)
+    assert np.may_share_memory(l.d_uv_data["FLUX"], flux_in)
+
+if __name__ == '__main__':
+    test_average()
+    test_average_weights()
+    test_average_in_place()
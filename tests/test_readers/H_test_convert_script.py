@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Smoke test scripts/convertLEDA64NM.py, sequentially and in parallel, on two
+synthetic dada file groups.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import sys
+import subprocess
+import multiprocessing
+import tempfile
+import numpy as np
+import pyfits as pf
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+import convertLEDA64NM
+
+def make_groups(dirname):
+    """ Two groups (start times) of one file each """
+    filenames = []
+    for i, utc_start in enumerate(('2014-02-23-11:06:51', '2014-02-23-11:07:01')):
+        filename = os.path.join(dirname, 'g%i.dada' % i)
+        make_dada(filename, n_int=2, seed=i, utc_start=utc_start)
+        filenames.append(filename)
+    return filenames
+
+def run_main(args):
+    """ Run the script in a fresh directory, returning (exit status, output files) """
+    cwd = os.getcwd()
+    dirname = tempfile.mkdtemp()
+    os.chdir(dirname)
+    try:
+        try:
+            convertLEDA64NM.main(args)
+            status = 0
+        except SystemExit, e:
+            status = e.code
+    finally:
+        os.chdir(cwd)
+    return status, dict((f, os.path.join(dirname, f)) for f in os.listdir(dirname))
+
+def test_convert_sequential_parallel():
+    filenames = make_groups(tempfile.mkdtemp())
+
+    status, seq = run_main(['--sequential'] + filenames)
+    assert status == 0
+    assert sorted(seq) == ['LEDA_LWA1_20140223110651_49MHz.FITS_1',
+                           'LEDA_LWA1_20140223110701_49MHz.FITS_1']
+
+    status, par = run_main(['-j', '2', '-m', '1'] + filenames)
+    assert status == 0
+    assert sorted(par) == sorted(seq)
+    for f in seq:
+        assert np.all(pf.open(seq[f])['UV_DATA'].data['FLUX'] == pf.open(par[f])['UV_DATA'].data['FLUX'])
+
+def test_convert_failure_status():
+    filenames = make_groups(tempfile.mkdtemp())
+
+    # One bad group is reported, the other is still converted, and the exit status is 1
+    processGroup = convertLEDA64NM.processGroup
+    def failingGroup(config, group):
+        if group[1][0].endswith('g1.dada'):
+            raise RuntimeError("bad group")
+        return processGroup(config, group)
+    convertLEDA64NM.processGroup = failingGroup
+    try:
+        for args in (['--sequential'], ['-j', '2', '-m', '1']):
+            status, files = run_main(args + filenames)
+            assert status == 1
+            assert sorted(files) == ['LEDA_LWA1_20140223110651_49MHz.FITS_1']
+    finally:
+        convertLEDA64NM.processGroup = processGroup
+
+def test_worker_count():
+    config = {'jobs': 3, 'memory': 1}
+    assert convertLEDA64NM.getWorkerCount(config, 10) == 3
+    assert convertLEDA64NM.getWorkerCount(config, 2) == 2
+    config = {'jobs': 0, 'memory': 1}
+    assert convertLEDA64NM.getWorkerCount(config, 1000) <= multiprocessing.cpu_count()
+    # A budget larger than physical memory leaves a single worker
+    config = {'jobs': 8, 'memory': 2**40}
+    assert convertLEDA64NM.getWorkerCount(config, 10) == 1
+
+def test_limit_address_space():
+    # Run in a child process, so the limit does not apply to this one
+    filename = os.path.join(tempfile.mkdtemp(), 'g.dada')
+    make_dada(filename, n_int=2)
+    code = """
+import sys, resource
+sys.path.insert(0, %r)
+import convertLEDA64NM
+config = {'memory': 64}
+group = [0, [%r], []]
+i, outnames, error = convertLEDA64NM._processGroupTask((0, config, group))
+print resource.getrlimit(resource.RLIMIT_AS)[0] == resource.RLIM_INFINITY
+convertLEDA64NM._inWorker = True
+convertLEDA64NM.processGroup = lambda config, group: bytearray(512 * 1024**2)
+print convertLEDA64NM._processGroupTask((0, config, group))
+""" % (os.path.dirname(convertLEDA64NM.__file__), filename)
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        out = subprocess.check_output([sys.executable, '-c', code], stderr=open(os.devnull, 'w'))
+    finally:
+        os.chdir(cwd)
+    lines = out.strip().split('\n')
+    # No limit outside of pool workers; in a worker a 512 MB allocation exceeds a 64 MB budget
+    assert lines[-2] == 'True'
+    assert lines[-1] == "(0, [], 'out of memory (budget is 64 MB per worker)')"
+
+if __name__ == '__main__':
+    test_convert_sequential_parallel()
+    test_convert_failure_status()
+    test_worker_count()
+    test_limit_address_space()
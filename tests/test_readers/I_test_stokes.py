@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Check the Stokes views of FLUX (InterFits.stokes) on synthetic data, including
+FLUX read lazily from FITS-IDI and HDF5.
+"""
+from test_main import *
+from test_main import make_dada
+
+import gc
+import os
+import weakref
+import tempfile
+import numpy as np
+
+def export_dada(dirname):
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=2)
+    l = LedaFits(filename, verbose=False)
+    l.exportFitsidi(os.path.join(dirname, 'test.fitsidi'))
+    l.exportHdf5(os.path.join(dirname, 'test.h5'))
+    return l
+
+def expected_stokes(flux, n_stk=4):
+    flux = np.array(flux, dtype='float32')
+    return flux.view('complex64').reshape(flux.shape[0], -1, n_stk).transpose(2, 0, 1)
+
+def test_stokes_view():
+    l = export_dada(tempfile.mkdtemp())
+    flux = l.d_uv_data["FLUX"]
+    stokes = l.stokes
+    assert np.all(stokes == expected_stokes(flux))
+    assert np.may_share_memory(stokes, flux)
+    assert l.stokes is stokes
+    assert np.all(l.formatStokes() == stokes)
+
+    # Replacing FLUX gives new views, and the cache does not keep the old FLUX alive
+    ref = weakref.ref(flux)
+    l.d_uv_data["FLUX"] = flux * 2
+    del flux, stokes
+    gc.collect()
+    assert ref() is None
+    assert np.all(l.stokes == expected_stokes(l.d_uv_data["FLUX"]))
+
+def test_stokes_lazy():
+    dirname = tempfile.mkdtemp()
+    l = export_dada(dirname)
+    ref = expected_stokes(l.d_uv_data["FLUX"])
+
+    # Lazily read FITS FLUX is a strided, big-endian column: it is viewed, not copied
+    lazy = LedaFits(os.path.join(dirname, 'test.fitsidi'), verbose=False, lazy=True)
+    flux = lazy.d_uv_data["FLUX"]
+    assert not flux.flags.c_contiguous
+    stokes = lazy.stokes
+    assert np.may_share_memory(stokes, flux)
+    assert np.all(stokes == ref)
+    assert lazy.stokes is stokes
+
+    # Lazily read HDF5 FLUX has to be read; the copy is not cached
+    lazy = LedaFits(os.path.join(dirname, 'test.h5'), verbose=False, lazy=True)
+    stokes = lazy.stokes
+    assert np.all(stokes == ref)
+    assert getattr(lazy, '_stokes_cache', None) is None
+
+if __name__ == '__main__':
+    test_stokes_view()
+    test_stokes_lazy()
@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Compare the UV_DATA table streamed by exportFitsidi (pyFitsidi.BinTableWriter)
+against the table built in memory by pyFitsidi.make_uv_data, on a small
+synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+import pyfits as pf
+from interfits.lib import pyFitsidi
+
+UV_COLS = ['UU', 'VV', 'WW', 'DATE', 'TIME', 'BASELINE', 'SOURCE', 'FREQID', 'INTTIM', 'FLUX']
+
+def make_uv_data_ref(l):
+    """ Original implementation: fill the whole UV_DATA table in memory """
+    mask = l._selectionMask()
+    uvd = {}
+    for k in UV_COLS:
+        uvd[k] = np.asarray(l.d_uv_data[k])
+        if mask is not None:
+            uvd[k] = uvd[k][mask]
+    return pyFitsidi.make_uv_data(config=l.xmlData, num_rows=uvd['FLUX'].shape[0],
+                                  uu_data=uvd['UU'], vv_data=uvd['VV'], ww_data=uvd['WW'],
+                                  date_data=uvd['DATE'], time_data=uvd['TIME'],
+                                  baseline_data=uvd['BASELINE'].astype('int32'),
+                                  source_data=uvd['SOURCE'].astype('int32'),
+                                  freqid_data=uvd['FREQID'].astype('int32'),
+                                  inttim_data=uvd['INTTIM'],
+                                  weights_data=None, flux_data=uvd['FLUX'], weights_col=False)
+
+def check_stream(bls=None, chunk_bytes=None):
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=3)
+    l = LedaFits(filename, verbose=False)
+    if bls is not None:
+        l.select_baselines(bls)
+
+    # A small chunk size writes UV_DATA in several blocks
+    filename_out = os.path.join(dirname, 'test.fitsidi')
+    chunk_bytes_default = pyFitsidi.BinTableWriter.chunk_bytes
+    if chunk_bytes is not None:
+        pyFitsidi.BinTableWriter.chunk_bytes = chunk_bytes
+    try:
+        l.exportFitsidi(filename_out)
+    finally:
+        pyFitsidi.BinTableWriter.chunk_bytes = chunk_bytes_default
+
+    # Written to file as before, so both tables are compared as read back
+    filename_ref = os.path.join(dirname, 'ref.fitsidi')
+    pf.HDUList([pf.PrimaryHDU(), make_uv_data_ref(l)]).writeto(filename_ref)
+    ref = pf.open(filename_ref)['UV_DATA']
+    n_rows = len(ref.data)
+    assert os.path.getsize(filename_out) % 2880 == 0
+
+    hdus = pf.open(filename_out)
+    tbl = hdus['UV_DATA']
+    assert tbl.header['NAXIS2'] == n_rows
+    assert len(tbl.data) == n_rows
+    for key in ref.header.keys():
+        assert tbl.header[key] == ref.header[key]
+    for k in UV_COLS:
+        assert tbl.data[k].dtype == ref.data[k].dtype
+        assert tbl.data[k].shape == ref.data[k].shape
+        assert np.all(tbl.data[k] == ref.data[k])
+
+    # The table is the last HDU, and fills the file up to the final (padded) block
+    info = tbl.fileinfo()
+    n_bytes = info['datLoc'] + n_rows * tbl.header['NAXIS1']
+    assert os.path.getsize(filename_out) == n_bytes + (2880 - n_bytes % 2880) % 2880
+    hdus.close()
+
+def test_stream_uv_data():
+    check_stream()
+    check_stream(chunk_bytes=1)
+    check_stream(chunk_bytes=5000)
+
+def test_stream_uv_data_selection():
+    bls = [1 * 256 + 1, 1 * 256 + 2, 2 * 256 + 5]
+    check_stream(bls=bls)
+    check_stream(bls=bls, chunk_bytes=5000)
+
+if __name__ == '__main__':
+    test_stream_uv_data()
+    test_stream_uv_data_selection()
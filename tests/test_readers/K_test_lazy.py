@@ -0,0 +1,69 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Compare lazily (memory-mapped) and eagerly loaded FITS-IDI files, written from
+a small synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+
+def export_fitsidi(dirname):
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=3)
+    l = LedaFits(filename, verbose=False)
+    filename_out = os.path.join(dirname, 'test.fitsidi')
+    l.exportFitsidi(filename_out)
+    return filename_out
+
+def check_uv_data(eager, lazy):
+    assert sorted(lazy.d_uv_data) == sorted(eager.d_uv_data)
+    for k in eager.d_uv_data:
+        assert np.asarray(lazy.d_uv_data[k]).shape == np.asarray(eager.d_uv_data[k]).shape
+        assert np.all(lazy.d_uv_data[k] == eager.d_uv_data[k])
+
+def test_lazy_fitsidi():
+    filename = export_fitsidi(tempfile.mkdtemp())
+    eager = LedaFits(filename, verbose=False)
+    lazy = LedaFits(filename, verbose=False, lazy=True)
+    assert len(eager._lazy_columns) == 0
+    assert 'FLUX' in lazy._lazy_columns
+
+    # Lazy columns are views into the file, with the same values
+    check_uv_data(eager, lazy)
+    assert np.all(lazy.formatStokes() == eager.formatStokes())
+
+    # Loading a single column leaves the others as they are
+    lazy._loadUvColumns(['UU'])
+    assert 'UU' not in lazy._lazy_columns
+    assert 'FLUX' in lazy._lazy_columns
+
+    lazy._loadUvColumns()
+    assert len(lazy._lazy_columns) == 0
+    check_uv_data(eager, lazy)
+    for k in eager.d_uv_data:
+        # Loaded columns are native-endian, eagerly read ones are as stored in the file
+        assert lazy.d_uv_data[k].dtype == eager.d_uv_data[k].dtype.newbyteorder('=')
+        assert lazy.d_uv_data[k].dtype.isnative
+        assert lazy.d_uv_data[k].flags.writeable
+    assert lazy.d_uv_data['FLUX'].dtype == 'float32'
+
+def test_lazy_fitsidi_modify():
+    filename = export_fitsidi(tempfile.mkdtemp())
+    eager = LedaFits(filename, verbose=False)
+    lazy = LedaFits(filename, verbose=False, lazy=True)
+
+    # Operations that change UV_DATA give the same result, and do not write to the file
+    for l in (eager, lazy):
+        l.phase_to_src('CYG')
+        l.average_time_frequency(1, 2)
+    check_uv_data(eager, lazy)
+    assert np.all(LedaFits(filename, verbose=False).d_uv_data['FLUX'] ==
+                  LedaFits(filename, verbose=False, lazy=True).d_uv_data['FLUX'])
+
+if __name__ == '__main__':
+    test_lazy_fitsidi()
+    test_lazy_fitsidi_modify()
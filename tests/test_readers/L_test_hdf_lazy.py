@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Check chunked, compressed HDF5 export and lazy HDF5 loading, on a small
+synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+
+def load_dada(dirname):
+    filename = os.path.join(dirname, 'test.dada')
+    make_dada(filename, n_int=4)
+    return LedaFits(filename, verbose=False)
+
+def test_hdf_compressed_lazy():
+    dirname = tempfile.mkdtemp()
+    idi = load_dada(dirname)
+    filename = os.path.join(dirname, 'test.h5')
+    idi.exportHdf5(filename, compression='gzip', shuffle=True)
+
+    hdf = LedaFits(filename, verbose=False, lazy=True)
+    n_bls = hdf.baseline_index.n_bls
+    flux = hdf.hdf['d_uv_data']['FLUX']
+    assert flux.compression == 'gzip'
+    assert flux.shuffle
+    # Chunks should hold whole integrations
+    assert flux.chunks[0] % n_bls == 0
+    assert 'FLUX' in hdf._lazy_columns
+
+    # Lazy and eager loads give the same data
+    eager = LedaFits(filename, verbose=False)
+    hdf._loadUvColumns()
+    assert len(hdf._lazy_columns) == 0
+    for k in eager.d_uv_data:
+        assert np.all(hdf.d_uv_data[k] == eager.d_uv_data[k])
+        assert np.all(hdf.d_uv_data[k] == idi.d_uv_data[k])
+    hdf.hdf.close()
+
+def test_hdf_lazy_select():
+    dirname = tempfile.mkdtemp()
+    idi = load_dada(dirname)
+    filename = os.path.join(dirname, 'test.h5')
+    idi.exportHdf5(filename, compression='gzip')
+
+    # Only the selected rows are read from lazy columns
+    hdf = LedaFits(filename, verbose=False, lazy=True)
+    n_bls = hdf.baseline_index.n_bls
+    bls = idi.d_uv_data['BASELINE']
+    hdf.select_baselines([257, 258])
+    uvd = hdf._selectedUvData()
+    assert len(uvd['FLUX']) == 2 * 4
+    assert np.all(uvd['FLUX'] == idi.d_uv_data['FLUX'][np.in1d(bls, [257, 258])])
+
+    hdf.extract_integrations(1, 2)
+    assert np.all(hdf.d_uv_data['FLUX'] == idi.d_uv_data['FLUX'][n_bls:2*n_bls])
+    hdf.hdf.close()
+
+if __name__ == '__main__':
+    test_hdf_compressed_lazy()
+    test_hdf_lazy_select()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Check .npy sidecar files for large JSON arrays (json_numpy.dump_json), and a
+JSON export of UV_DATA from a small synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import json
+import tempfile
+import numpy as np
+from interfits.lib.json_numpy import dump_json, load_json, SIDECAR_BYTES
+
+def test_json_sidecar():
+    npDict_orig = {
+        'FLUX'  : np.random.random((1000, 64)).astype('float32'),
+        'SMALL' : np.arange(16),
+        }
+
+    # Dump to file, with FLUX large enough to go to a .npy sidecar
+    dirname = tempfile.mkdtemp()
+    npDict_filename = os.path.join(dirname, 'jsontest.json')
+    dump_json(npDict_orig, npDict_filename, sidecar_bytes=1000)
+    assert sorted(os.listdir(dirname)) == ['jsontest.FLUX.npy', 'jsontest.json']
+    assert json.load(open(npDict_filename))['_FLUX'] == 'npy float32 1000,64'
+
+    npDict_ff = load_json(npDict_filename)
+    assert type(npDict_ff['FLUX']) is np.ndarray
+    npDict_mm = load_json(npDict_filename, mmap_mode='r')
+    assert type(npDict_mm['FLUX']) is np.memmap
+    for npDict in (npDict_ff, npDict_mm):
+        assert npDict['FLUX'].dtype == npDict_orig['FLUX'].dtype
+        assert np.all(npDict['FLUX'] == npDict_orig['FLUX'])
+        assert np.all(npDict['SMALL'] == npDict_orig['SMALL'])
+
+    # Without sidecars, all arrays are written to the JSON file
+    npDict_filename = os.path.join(dirname, 'jsontest_inline.json')
+    dump_json(npDict_orig, npDict_filename, sidecar_bytes=None)
+    assert not os.path.exists(os.path.join(dirname, 'jsontest_inline.FLUX.npy'))
+    assert np.allclose(load_json(npDict_filename)['FLUX'], npDict_orig['FLUX'])
+
+def test_json_uv_data():
+    dirname = tempfile.mkdtemp()
+    filename = os.path.join(dirname, 'test.dada')
+    # Enough channels for FLUX to exceed SIDECAR_BYTES
+    make_dada(filename, n_chans=32, n_int=2)
+    l = LedaFits(filename, verbose=False)
+    assert l.d_uv_data['FLUX'].nbytes >= SIDECAR_BYTES
+    dirname_out = os.path.join(dirname, 'json')
+    l.exportJson(dirname_out, dump_uv_data=True)
+    assert os.path.exists(os.path.join(dirname_out, 'd_uv_data.FLUX.npy'))
+
+    # Read back eagerly, and lazily with the sidecar files memory-mapped
+    eager = LedaFits(os.path.join(dirname_out, 'd_uv_data.json'), verbose=False)
+    lazy = LedaFits(os.path.join(dirname_out, 'd_uv_data.json'), verbose=False, lazy=True)
+    assert type(lazy.d_uv_data['FLUX']) is np.memmap
+    assert 'FLUX' in lazy._lazy_columns
+    assert len(eager._lazy_columns) == 0
+    for k in ('FLUX', 'UU', 'VV', 'WW', 'BASELINE'):
+        assert np.all(eager.d_uv_data[k] == l.d_uv_data[k])
+        assert np.all(lazy.d_uv_data[k] == l.d_uv_data[k])
+
+    lazy._loadUvColumns()
+    assert type(lazy.d_uv_data['FLUX']) is np.ndarray
+    assert np.all(lazy.d_uv_data['FLUX'] == l.d_uv_data['FLUX'])
+
+if __name__ == '__main__':
+    test_json_sidecar()
+    test_json_uv_data()
@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Check the verification suite (InterFits.verify and verify_*), on a small
+synthetic dada file.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+from interfits.interfits import VerificationError, _baselineOrderTemplates
+
+def baseline_order_ref(n_ant):
+    """ Lower (1-1, 1-2, ..., 2-2, 2-3, ...) and upper (1-1, 1-2, 2-2, 1-3, ...) triangular
+    baseline IDs, one at a time. (The original loop left the autocorrelations out of the
+    upper triangular order, so it never matched a whole dump.) """
+    bl_lower = [256 * i + j for i in range(1, n_ant + 1) for j in range(i, n_ant + 1)]
+    bl_upper = [256 * i + j for j in range(1, n_ant + 1) for i in range(1, j + 1)]
+    return bl_lower, bl_upper
+
+def load_dada():
+    filename = os.path.join(tempfile.mkdtemp(), 'test.dada')
+    make_dada(filename, n_int=3)
+    return LedaFits(filename, verbose=False)
+
+def assert_fails(func):
+    try:
+        func()
+    except VerificationError, e:
+        return str(e)
+    raise AssertionError("%s did not fail" % func.__name__)
+
+def test_baseline_templates():
+    for n_ant in (1, 2, 7, 32):
+        bl_lower, bl_upper = _baselineOrderTemplates(n_ant)
+        bl_lower_ref, bl_upper_ref = baseline_order_ref(n_ant)
+        assert list(bl_lower) == bl_lower_ref
+        assert list(bl_upper) == bl_upper_ref
+
+def test_verify():
+    l = load_dada()
+    l.verify(check_time=True, check_inttim=True, check_finite=True)
+    assert l.verify_baseline_order()
+
+    # Upper triangular order is accepted too
+    bl_upper = _baselineOrderTemplates(l.n_ant)[1]
+    l.d_uv_data['BASELINE'] = np.tile(bl_upper, 3)
+    assert l.verify_baseline_order()
+
+def test_verify_baseline_order():
+    l = load_dada()
+    n_bls = l.baseline_index.n_bls
+    bls = l.d_uv_data['BASELINE'].copy()
+
+    # A bad dump is found, even after good ones
+    bad = bls.copy()
+    bad[n_bls + 1], bad[n_bls + 2] = bls[n_bls + 2], bls[n_bls + 1]
+    l.d_uv_data['BASELINE'] = bad
+    assert '(dump 1)' in assert_fails(l.verify_baseline_order)
+
+    # Each dump must be wholly in one order (the orders differ from the third baseline)
+    bad = bls.copy()
+    bad[2 * n_bls:] = _baselineOrderTemplates(l.n_ant)[1]
+    bad[2 * n_bls + 2] = bls[2]
+    l.d_uv_data['BASELINE'] = bad
+    assert '(dump 2)' in assert_fails(l.verify_baseline_order)
+
+    # Partial dumps
+    l.d_uv_data['BASELINE'] = bls[:-1]
+    assert_fails(l.verify_baseline_order)
+
+def with_value(uvd, key, idx, value):
+    """ Copy of a UV_DATA column with one value changed (columns may share memory) """
+    col = np.array(uvd[key])
+    col[idx] = value
+    return col
+
+def test_verify_optional():
+    l = load_dada()
+    uvd = l.d_uv_data
+    n_rows = len(uvd['BASELINE'])
+
+    for key, idx, value, check in (('TIME', -1, uvd['TIME'][0] - 1, l.verify_time),
+                                   ('INTTIM', 5, 2 * uvd['INTTIM'][5], l.verify_inttim),
+                                   ('FREQID', 4, 0, l.verify_uv_table),
+                                   ('SOURCE', 4, 0, l.verify_uv_table),
+                                   ('BASELINE', 4, 0, l.verify_uv_table)):
+        col = uvd[key]
+        uvd[key] = with_value(uvd, key, idx, value)
+        msg = assert_fails(check)
+        if key == 'TIME':
+            assert '(row %i)' % (n_rows - 1) in msg
+        uvd[key] = col
+
+    # Non-finite values are found in any block of rows
+    l.average_block_bytes = 1
+    flux = uvd['FLUX']
+    for value in (np.nan, np.inf, -np.inf):
+        uvd['FLUX'] = with_value(uvd, 'FLUX', (7, 3), value)
+        assert '(row 7)' in assert_fails(l.verify_flux_finite)
+    uvd['FLUX'] = flux
+
+    l.verify(check_time=True, check_inttim=True, check_finite=True)
+
+if __name__ == '__main__':
+    test_baseline_templates()
+    test_verify()
+    test_verify_baseline_order()
+    test_verify_optional()
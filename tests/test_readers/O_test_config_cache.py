@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# encoding: utf-8
+"""
+Check the per-process cache of parsed FITS-IDI config and table templates
+(pyFitsidi.parseConfig, pyFitsidi._newTable), and FITS-IDI exports of small
+synthetic dada files that use it.
+"""
+from test_main import *
+from test_main import make_dada
+
+import os
+import tempfile
+import numpy as np
+import pyfits as pf
+from lxml import etree
+from interfits.lib import pyFitsidi
+
+CONFIG_XML = os.path.join(os.path.dirname(pyFitsidi.__file__), '..', 'config', 'config.xml')
+
+def test_cached_config():
+    # Cached config values and table templates are not shared between calls
+    pyFitsidi._config_cache.clear()
+    cards = pyFitsidi.parseConfig('ANTENNA', CONFIG_XML)
+    cards['NOPCAL'] = -1
+    assert pyFitsidi.parseConfig('ANTENNA', CONFIG_XML)['NOPCAL'] != -1
+    assert len(pyFitsidi._config_cache) == 1
+
+    tbl = pyFitsidi.make_antenna(CONFIG_XML, num_rows=4)
+    tbl.data['ANTENNA_NO'][:] = 7
+    tbl2 = pyFitsidi.make_antenna(CONFIG_XML, num_rows=4)
+    assert np.all(tbl2.data['ANTENNA_NO'] == 0)
+    assert tbl2.header == tbl.header
+
+def test_cached_config_content():
+    # Entries are keyed on content, so a changed tree is parsed again
+    pyFitsidi._config_cache.clear()
+    tree = etree.parse(CONFIG_XML)
+    assert pyFitsidi.parseConfig('UV_DATA', tree) == pyFitsidi.parseConfig('UV_DATA', CONFIG_XML)
+    n_cached = len(pyFitsidi._config_cache)
+    assert pyFitsidi.parseConfig('UV_DATA', tree) == pyFitsidi.parseConfig('UV_DATA', CONFIG_XML)
+    assert len(pyFitsidi._config_cache) == n_cached
+
+    tree.find('UV_DATA').find('TELESCOP').text = "'TEST'"
+    assert pyFitsidi.parseConfig('UV_DATA', tree)['TELESCOP'] == 'TEST'
+    assert pyFitsidi.parseConfig('UV_DATA', CONFIG_XML)['TELESCOP'] != 'TEST'
+    assert len(pyFitsidi._config_cache) == n_cached + 1
+
+    # The cache does not grow without bound
+    for i in range(pyFitsidi.CONFIG_CACHE_SIZE + 1):
+        tree.find('UV_DATA').find('TELESCOP').text = "'TEST%i'" % i
+        assert pyFitsidi.parseConfig('UV_DATA', tree)['TELESCOP'] == 'TEST%i' % i
+    assert len(pyFitsidi._config_cache) <= pyFitsidi.CONFIG_CACHE_SIZE
+
+def export_dada(dirname, name, **kwargs):
+    filename = os.path.join(dirname, name + '.dada')
+    make_dada(filename, n_int=2, **kwargs)
+    filename_out = os.path.join(dirname, name + '.fitsidi')
+    LedaFits(filename, verbose=False).exportFitsidi(filename_out)
+    return pf.open(filename_out)
+
+def test_cached_export():
+    # Exports of different data in one process do not pick up each other's config
+    dirname = tempfile.mkdtemp()
+    hdus1 = export_dada(dirname, 'a', seed=1, utc_start='2014-02-23-11:06:51')
+    hdus2 = export_dada(dirname, 'b', seed=2, utc_start='2014-03-01-01:00:00')
+    hdus3 = export_dada(dirname, 'c', seed=1, utc_start='2014-02-23-11:06:51')
+    assert hdus1['UV_DATA'].header['DATE-OBS'] != hdus2['UV_DATA'].header['DATE-OBS']
+    assert hdus1['ARRAY_GEOMETRY'].header['RDATE'] != hdus2['ARRAY_GEOMETRY'].header['RDATE']
+
+    # and exporting the same data again gives the same tables
+    assert [h.name for h in hdus1] == [h.name for h in hdus3]
+    for h1, h3 in zip(hdus1[1:], hdus3[1:]):
+        assert h1.header == h3.header
+        for k in h1.columns.names:
+            assert np.all(h1.data[k] == h3.data[k])
+
+if __name__ == '__main__':
+    test_cached_config()
+    test_cached_config_content()
+    test_cached_export()
@@ -61,4 +61,37 @@ def compare_dicts(dict_a, dict_b):
     else:
         print "ERROR"
 
-    return all_ok
\ No newline at end of file
+    return all_ok
+
+def make_dada(filename, n_station=32, n_chans=8, n_int=5, telescope='LWA1', seed=1,
+              utc_start='2014-02-23-11:06:51'):
+    """ Write a small synthetic dada file of random float32 data.
+
+    Returns the number of bytes per integration.
+    """
+    from interfits.lib.dada import DadaReader
+
+    class _Reader(DadaReader):
+        def __init__(self):
+            self.n_station  = n_station
+            self.n_pol      = 2
+            self.n_input    = 2 * n_station
+            self.data_order = 'REG_TILE_TRIANGULAR_2x2'
+
+    matlen = _Reader().reg_tile_triangular_matlen(2, 2)
+    bpa = 2 * n_chans * matlen * 4
+    header = [
+        ('HDR_VERSION', '1.0'), ('TELESCOPE', telescope), ('INSTRUMENT', 'LEDA'),
+        ('CFREQ', '50.0'), ('BW', '2.4'), ('CHAN_WIDTH', '0.024'), ('NCHAN', n_chans),
+        ('NPOL', 2), ('NSTATION', n_station), ('NDIM', 2), ('NBIT', 32), ('NAVG', 25000),
+        ('TSAMP', '40.0'), ('BYTES_PER_AVG', bpa), ('FILE_SIZE', bpa * n_int), ('OBS_OFFSET', 0),
+        ('UTC_START', utc_start), ('DATA_ORDER', 'REG_TILE_TRIANGULAR_2x2'),
+    ]
+    hdr = ''.join('%s %s\n' % (k, v) for k, v in header)
+    data = np.random.RandomState(seed).randn(n_int * bpa / 4).astype('float32')
+
+    f = open(filename, 'wb')
+    f.write(hdr + '\0' * (DadaReader.DEFAULT_HEADER_SIZE - len(hdr)))
+    f.write(data.tostring())
+    f.close()
+    return bpa